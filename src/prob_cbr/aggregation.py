@@ -0,0 +1,168 @@
+import numpy as np
+from typing import *
+
+AGGR_TYPES1 = ["none", "sum"]
+AGGR_TYPES2 = ["sum", "max", "noisy_or", "logsumexp"]
+
+
+def get_path_answer_scores(list_answers: List[Tuple[Tuple[np.ndarray, np.ndarray], float, int]],
+                           aggr_type1: str = "none") -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Flattens the answers of the executed programs into one (entity id, score) pair per answer of a program.
+    :param list_answers: (answers as (entity ids, counts), program score, program), as returned by execute_programs
+    :param aggr_type1: none: a program gives its score to each of its answers, sum: score X number of paths
+    :return: entity ids and scores, in the order of list_answers
+    """
+    if aggr_type1 not in AGGR_TYPES1:
+        raise NotImplementedError("{} aggr_type1 is invalid".format(aggr_type1))
+    if len(list_answers) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    ent_ids = np.concatenate([np.asarray(ans_ids, dtype=np.int64) for (ans_ids, _), _, _ in list_answers])
+    if aggr_type1 == "none":
+        # just count once for a path type.
+        lengths = [len(ans_ids) for (ans_ids, _), _, _ in list_answers]
+        scores = np.repeat(np.array([path_score for _, path_score, _ in list_answers], dtype=np.float64), lengths)
+    else:
+        # aggregate for each path
+        scores = np.concatenate([path_score * np.asarray(ans_counts, dtype=np.float64)
+                                 for (_, ans_counts), path_score, _ in list_answers])
+    return ent_ids, scores
+
+
+def aggregate_answers(list_answers: List[Tuple[Tuple[np.ndarray, np.ndarray], float, int]], aggr_type1: str = "none",
+                      aggr_type2: str = "sum") -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """
+    Aggregates the scores of the programs which reach an entity, in entity id space.
+    :param aggr_type2: sum/max/noisy_or/logsumexp of the scores of the programs reaching an entity
+    :return: entity ids in order of first appearance in list_answers, their score and, for max only, their second
+    highest program score (-1 if a single program reaches it), used to break ties
+    """
+    if aggr_type2 not in AGGR_TYPES2:
+        raise NotImplementedError("{} aggr_type2 is invalid".format(aggr_type2))
+    path_ent_ids, path_scores = get_path_answer_scores(list_answers, aggr_type1)
+    if path_ent_ids.shape[0] == 0:
+        return path_ent_ids, path_scores, np.zeros(0) if aggr_type2 == "max" else None
+    uniq_ids, first_idx, inverse = np.unique(path_ent_ids, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    second_scores = None
+    if aggr_type2 == "sum":
+        scores = np.bincount(inverse, weights=path_scores, minlength=uniq_ids.shape[0])
+    else:
+        # group the scores of an entity, highest first
+        grouped = path_scores[np.lexsort((-path_scores, inverse))]
+        counts = np.bincount(inverse, minlength=uniq_ids.shape[0])
+        starts = np.cumsum(counts) - counts
+        if aggr_type2 == "max":
+            scores = grouped[starts]
+            second_scores = np.where(counts > 1, grouped[np.minimum(starts + 1, grouped.shape[0] - 1)], -1.0)
+        elif aggr_type2 == "noisy_or":
+            scores = 1 - np.multiply.reduceat(1 - grouped, starts)
+        else:
+            max_scores = grouped[starts]
+            scores = max_scores + np.log(np.bincount(inverse, weights=np.exp(path_scores - max_scores[inverse]),
+                                                     minlength=uniq_ids.shape[0]))
+    # back to the order in which the entities were first reached, as ties are kept in that order
+    appearance = np.argsort(first_idx, kind="stable")
+    return uniq_ids[appearance], scores[appearance], \
+        second_scores[appearance] if second_scores is not None else None
+
+
+def get_top_k(scores: np.ndarray, second_scores: Optional[np.ndarray] = None, top_k: Optional[int] = None) \
+        -> np.ndarray:
+    """
+    :return: positions of the top_k (all if None) scores, by decreasing score, then decreasing second score, then
+    position. Only the entities tied with the k-th score or above it are sorted.
+    """
+    candidates = np.arange(scores.shape[0])
+    if top_k is not None and top_k < scores.shape[0]:
+        if top_k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        kth_score = scores[np.argpartition(-scores, top_k - 1)[top_k - 1]]
+        candidates = np.nonzero(scores >= kth_score)[0]
+    keys = (-scores[candidates],) if second_scores is None else (-second_scores[candidates], -scores[candidates])
+    return candidates[np.lexsort(keys)][:top_k]
+
+
+class AnytimeTopK(object):
+    """
+    Scores of the entities reached by the programs executed so far, for aggr_type1 none and aggr_type2 sum or max,
+    and an upper bound on what the programs not executed yet can add to them. Once the k-th best entity cannot be
+    overtaken by any other, the remaining programs cannot change which entities are in the top-k (their scores and
+    order within the top-k can still change, for sum).
+    """
+
+    def __init__(self, path_scores: np.ndarray, num_entities: int, top_k: int, aggr_type2: str = "sum",
+                 max_programs: Optional[int] = None):
+        """
+        :param path_scores: scores of the ranked programs, in execution order
+        :param max_programs: at most this many more programs with answers will be executed
+        """
+        if aggr_type2 not in ["sum", "max"]:
+            raise NotImplementedError("Early stopping needs aggr_type2 sum or max, got {}".format(aggr_type2))
+        self.path_scores = np.asarray(path_scores, dtype=np.float64)
+        self.top_k = top_k
+        self.aggr_type2 = aggr_type2
+        self.max_programs = max_programs if max_programs is not None else self.path_scores.shape[0]
+        num_programs = self.path_scores.shape[0]
+        # remaining[i]: bound on what programs i.. can add to an entity
+        if aggr_type2 == "max":
+            self.suffix_max = np.concatenate([np.maximum.accumulate(self.path_scores[::-1])[::-1], [0.0]])
+        else:
+            self.cum_scores = np.concatenate([[0.0], np.cumsum(self.path_scores)])
+            # programs are usually ranked by their score, then the next max_programs ones bound the remaining mass
+            self.is_sorted = num_programs < 2 or bool(np.all(np.diff(self.path_scores) <= 0))
+            # bound on the rounding errors of the prefix sums and of the entity scores, which are sums of at most
+            # num_programs of the scores (nonnegative), so that a bound is never below the exact remaining mass
+            self.rounding_error = 4 * (num_programs + 1) * np.finfo(np.float64).eps * float(self.cum_scores[-1])
+        self.scores = np.zeros(num_entities)
+        self.reached = np.zeros(num_entities, dtype=bool)
+        self.reached_ids = []
+        self.best_score = 0.0
+
+    def add(self, ent_ids: np.ndarray, path_score: float):
+        """
+        Adds the answers of an executed program.
+        """
+        if ent_ids.shape[0] == 0:
+            return
+        if self.aggr_type2 == "sum":
+            self.scores[ent_ids] += path_score
+        else:
+            self.scores[ent_ids] = np.maximum(self.scores[ent_ids], path_score)
+        new_ids = ent_ids[~self.reached[ent_ids]]
+        if new_ids.shape[0] > 0:
+            self.reached[new_ids] = True
+            self.reached_ids.append(new_ids)
+        self.best_score = max(self.best_score, float(self.scores[ent_ids].max()))
+
+    def remaining_bound(self, next_program: int, num_executed: int) -> float:
+        """
+        :param next_program: position of the first program not executed yet
+        :param num_executed: number of programs which returned answers so far
+        :return: upper bound on what the remaining programs can add to the score of an entity
+        """
+        if self.aggr_type2 == "max":
+            return float(self.suffix_max[next_program])
+        num_programs = self.path_scores.shape[0]
+        end = min(next_program + max(self.max_programs - num_executed, 0), num_programs) if self.is_sorted \
+            else num_programs
+        return float(self.cum_scores[end] - self.cum_scores[next_program]) + self.rounding_error
+
+    def is_settled(self, next_program: int, num_executed: int) -> bool:
+        """
+        :return: True if the programs from next_program on cannot change the top-k entities
+        """
+        bound = self.remaining_bound(next_program, num_executed)
+        if bound >= self.best_score:
+            return False
+        if len(self.reached_ids) > 1:
+            self.reached_ids = [np.concatenate(self.reached_ids)]
+        reached_scores = self.scores[self.reached_ids[0]] if len(self.reached_ids) > 0 else np.zeros(0)
+        if reached_scores.shape[0] < self.top_k:
+            return False
+        # k-th and (k + 1)-th best scores, entities not reached yet have 0
+        top_scores = -np.partition(-np.concatenate([reached_scores, [0.0]]), self.top_k)[:self.top_k + 1]
+        kth_score, next_score = top_scores[:self.top_k].min(), top_scores[self.top_k]
+        if self.aggr_type2 == "max":
+            return kth_score > max(next_score, bound)
+        return kth_score > next_score + bound
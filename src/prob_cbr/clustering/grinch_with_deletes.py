@@ -1,5 +1,6 @@
 import time
 import numpy as np
+import scipy.sparse
 import wandb
 import logging
 from scipy.spatial.distance import cdist
@@ -16,10 +17,15 @@ logger.addHandler(ch)
 
 class GrinchWithDeletes(object):
 
-    def __init__(self, points, rotate_cap=100, graft_cap=100, norm='l2', sim='dot'):
+    def __init__(self, points, rotate_cap=100, graft_cap=100, norm='l2', sim='dot', block_size=4096):
+        """
+        :param points: num_points X dim dense array or scipy.sparse matrix. A sparse matrix is kept as csr, only the
+        rows compared in a nearest neighbor search are made dense, block_size rows at a time.
+        """
         logger.info('[GrinchWithDeletes] points %s', str(points.shape))
         self.point_counter = 0  # largest index of any point
-        self.points = points
+        self.points = scipy.sparse.csr_matrix(points) if scipy.sparse.issparse(points) else points
+        self.block_size = block_size
         self.deleted_points = []
         self.deleted_points_set = set()
         self.dim = points.shape[1]
@@ -34,7 +40,7 @@ class GrinchWithDeletes(object):
         # self.new_node[0:self.points.shape[0]] = 0
         self.needs_update_desc = np.zeros(self.max_nodes, dtype=np.bool_)
         self.parent = -1 * np.ones(self.max_nodes, dtype=np.int32)
-        self.next_node_id = len(points)
+        self.next_node_id = points.shape[0]
         self.centroids = np.zeros((self.max_nodes, self.dim), dtype=np.float32)
         self.sums = np.zeros((self.max_nodes, self.dim), dtype=np.float32)
         self.num_descendants = -1 * np.ones(self.max_nodes, dtype=np.int32)
@@ -421,8 +427,25 @@ class GrinchWithDeletes(object):
         self.num_descendants[new_node_id] = self.num_descendants[n1] + self.num_descendants[n2]
         return new_node_id
 
+    def get_point(self, i):
+        if scipy.sparse.issparse(self.points):
+            return self.points[i].toarray()[0]
+        return self.points[i]
+
+    def get_points(self, st, en):
+        if scipy.sparse.issparse(self.points):
+            return self.points[st:en].toarray()
+        return self.points[st:en]
+
+    def set_point(self, i, i_vec):
+        if not scipy.sparse.issparse(self.points):
+            self.points[i] = i_vec.toarray()[0] if scipy.sparse.issparse(i_vec) else i_vec
+            return
+        row = scipy.sparse.csr_matrix(i_vec.reshape(1, -1), dtype=self.points.dtype)
+        self.points = scipy.sparse.vstack([self.points[:i], row, self.points[i + 1:]], format='csr')
+
     def add_pt(self, i):
-        self.sums[i] += self.points[i]
+        self.sums[i] += self.get_point(i)
         self.num_descendants[i] = 1
         if i not in self.deleted_points_set:
             self.point_counter += 1
@@ -432,14 +455,14 @@ class GrinchWithDeletes(object):
 
     def insert(self, i, i_vec=None):
         if i_vec is not None:
-            self.points[i] = i_vec
+            self.set_point(i, i_vec)
         s = time.time()
         logger.debug('[insert] insert(%s)', i)
         # first point
         if self.point_counter == 0:
             self.add_pt(i)
         else:
-            i_vec = np.expand_dims(self.points[i], 0)
+            i_vec = np.expand_dims(self.get_point(i), 0)
             dists, nns = self.cknn(i_vec, self.k, None, None)
             self.add_pt(i)
             sib = self.find_rotate(i, nns[0])
@@ -480,9 +503,9 @@ class GrinchWithDeletes(object):
         # import pdb; pdb.set_trace()
         if pc is None:
             pc = self.point_counter
-        point_vecs = self.points[0:pc]
         # sims = np.matmul(i_vec, point_vecs.transpose(1, 0))
-        sims = self.csim(i_vec, point_vecs)
+        sims = np.concatenate([self.csim(i_vec, self.get_points(st, min(st + self.block_size, pc)))
+                               for st in range(0, pc, self.block_size)], axis=1)
         sims[:, self.deleted_points] = -np.inf
         if offlimits1 is not None:
             sims[:, offlimits1] = -np.inf
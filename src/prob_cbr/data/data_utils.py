@@ -1,6 +1,7 @@
 from tqdm import tqdm
 from collections import defaultdict
 import numpy as np
+import scipy.sparse
 import tempfile
 from typing import DefaultDict, List, Tuple, Dict, Set
 import os
@@ -156,26 +157,41 @@ def load_vocab(data_dir):
 #     return vocab, rev_vocab
 
 
-def read_graph(file_name: str, entity_vocab: Dict[str, int], rel_vocab: Dict[str, int]) -> np.ndarray:
-    adj_mat = np.zeros((len(entity_vocab), len(rel_vocab)))
+def read_graph(file_name: str, entity_vocab: Dict[str, int], rel_vocab: Dict[str, int]) -> scipy.sparse.csr_matrix:
+    """
+    :return: N X R sparse matrix, number of edges of every relation (and its inverse) of every entity
+    """
+    rows, cols = [], []
     with open(file_name) as fin:
         for line in tqdm(fin):
             line = line.strip()
             e1, r, e2 = line.split("\t")
-            adj_mat[entity_vocab[e1], rel_vocab[r]] += 1
+            rows.append(entity_vocab[e1])
+            cols.append(rel_vocab[r])
             r_inv = r + "_inv"
-            adj_mat[entity_vocab[e2], rel_vocab[r_inv]] += 1
-    return adj_mat
+            rows.append(entity_vocab[e2])
+            cols.append(rel_vocab[r_inv])
+    return _count_matrix(rows, cols, (len(entity_vocab), len(rel_vocab)))
 
 
-# def read_graph_from_triples(triples: List[Tuple[str, str, str]], entity_vocab: Dict[str, int],
-#                             rel_vocab: Dict[str, int]) -> np.ndarray:
-#     adj_mat = np.zeros((len(entity_vocab), len(rel_vocab)))
-#     for edge in tqdm(triples):
-#         e1, r, _ = edge
-#         adj_mat[entity_vocab[e1], rel_vocab[r]] = 1
-#
-#     return adj_mat
+def read_graph_from_triples(triples: List[Tuple[str, str, str]], entity_vocab: Dict[str, int],
+                            rel_vocab: Dict[str, int]) -> scipy.sparse.csr_matrix:
+    """
+    :return: N X R sparse matrix, number of edges of every relation of every entity
+    """
+    rows, cols = [], []
+    for edge in tqdm(triples):
+        e1, r, _ = edge
+        rows.append(entity_vocab[e1])
+        cols.append(rel_vocab[r])
+    return _count_matrix(rows, cols, (len(entity_vocab), len(rel_vocab)))
+
+
+def _count_matrix(rows: List[int], cols: List[int], shape: Tuple[int, int]) -> scipy.sparse.csr_matrix:
+    adj_mat = scipy.sparse.csr_matrix((np.ones(len(rows)), (np.array(rows, dtype=np.int64),
+                                                             np.array(cols, dtype=np.int64))), shape=shape)
+    adj_mat.sum_duplicates()  # duplicate (entity, relation) entries are added up
+    return adj_mat
 
 
 # def read_graph_wikidata(file_name: str) -> coo_matrix:
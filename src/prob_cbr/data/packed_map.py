@@ -0,0 +1,97 @@
+import numpy as np
+from collections.abc import MutableMapping
+from typing import *
+
+
+def pack_list_map(list_map: Dict[Hashable, List[str]], encode_key: Callable[[Hashable], int],
+                  value_index: Dict[str, int]) -> Dict[str, np.ndarray]:
+    """
+    Packs a map of key -> list of names (e.g. train_map, (e1, r) -> list of e2) into arrays. Keys are kept in
+    insertion order, the values of key k are values[indptr[k]:indptr[k + 1]].
+    :param encode_key: key -> non negative int code, unique per key
+    :param value_index: name -> id of the values
+    :return: key_codes, indptr, values and sorted_order (key_codes[sorted_order] is sorted, for lookups)
+    """
+    key_codes = np.array([encode_key(k) for k in list_map.keys()], dtype=np.int64)
+    lengths = np.array([len(v) for v in list_map.values()], dtype=np.int64)
+    indptr = np.zeros(key_codes.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    values = np.array([value_index[e] for v in list_map.values() for e in v], dtype=np.int64)
+    sorted_order = np.argsort(key_codes, kind="stable")
+    return {"key_codes": key_codes, "indptr": indptr, "values": values, "sorted_order": sorted_order}
+
+
+class PackedListMap(MutableMapping):
+    """
+    Map of key -> list of names backed by the arrays of pack_list_map, which can be memory-mapped.
+    A list is decoded the first time it is read and kept, so the map behaves like the dict it was packed from
+    (a defaultdict if default_factory is given) without having to build that dict at load time.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], encode_key: Callable[[Hashable], int],
+                 decode_key: Callable[[int], Hashable], value_names: List[str],
+                 default_factory: Optional[Callable[[], list]] = None):
+        self.key_codes = arrays["key_codes"]
+        self.indptr = arrays["indptr"]
+        self.values = arrays["values"]
+        self.sorted_order = arrays["sorted_order"]
+        self.sorted_codes = np.asarray(self.key_codes)[self.sorted_order]
+        self.encode_key = encode_key
+        self.decode_key = decode_key
+        self.value_names = value_names
+        self.default_factory = default_factory
+        self._decoded = {}  # key -> list, every key read or written since load
+        self._deleted = set()
+
+    def _find(self, key: Hashable) -> int:
+        """
+        :return: position of key in the packed arrays, -1 if it was not packed
+        """
+        code = self.encode_key(key)
+        if code < 0 or self.sorted_codes.shape[0] == 0:
+            return -1
+        pos = int(np.searchsorted(self.sorted_codes, code))
+        if pos == self.sorted_codes.shape[0] or self.sorted_codes[pos] != code:
+            return -1
+        return int(self.sorted_order[pos])
+
+    def __getitem__(self, key: Hashable) -> list:
+        if key in self._decoded:
+            return self._decoded[key]
+        k_ctr = self._find(key) if key not in self._deleted else -1
+        if k_ctr < 0:
+            if self.default_factory is None:
+                raise KeyError(key)
+            value = self.default_factory()
+        else:
+            value = [self.value_names[e] for e in self.values[self.indptr[k_ctr]:self.indptr[k_ctr + 1]].tolist()]
+        self._deleted.discard(key)
+        self._decoded[key] = value
+        return value
+
+    def __setitem__(self, key: Hashable, value: list):
+        self._deleted.discard(key)
+        self._decoded[key] = value
+
+    def __delitem__(self, key: Hashable):
+        if key not in self:
+            raise KeyError(key)
+        self._decoded.pop(key, None)
+        if self._find(key) >= 0:
+            self._deleted.add(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._decoded or (key not in self._deleted and self._find(key) >= 0)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for code in self.key_codes.tolist():
+            key = self.decode_key(code)
+            if key not in self._deleted:
+                yield key
+        for key in list(self._decoded.keys()):
+            if self._find(key) < 0:
+                yield key
+
+    def __len__(self) -> int:
+        return self.key_codes.shape[0] - len(self._deleted) + \
+            len([key for key in self._decoded if self._find(key) < 0])
@@ -0,0 +1,165 @@
+import numpy as np
+from typing import *
+from numpy.random import default_rng
+
+
+class CSRAdjList(object):
+    """
+    Integer CSR view of the adjacency list returned by create_adj_list.
+    The outgoing edges of entity id i are (rel_ids[indptr[i]:indptr[i + 1]], ent_ids[indptr[i]:indptr[i + 1]]),
+    in the same order (and with the same multiplicity) as in the adjacency list.
+    """
+
+    def __init__(self, indptr: np.ndarray, rel_ids: np.ndarray, ent_ids: np.ndarray, entity_vocab: Dict[str, int],
+                 rev_entity_vocab: Dict[int, str], rel_vocab: Dict[str, int], rev_rel_vocab: Dict[int, str]):
+        self.indptr = indptr
+        self.rel_ids = rel_ids
+        self.ent_ids = ent_ids
+        self.entity_vocab, self.rev_entity_vocab = entity_vocab, rev_entity_vocab
+        self.rel_vocab, self.rev_rel_vocab = rel_vocab, rev_rel_vocab
+
+    @property
+    def num_entities(self) -> int:
+        return self.indptr.shape[0] - 1
+
+    def degree(self, ent_ids: np.ndarray) -> np.ndarray:
+        return self.indptr[ent_ids + 1] - self.indptr[ent_ids]
+
+    @classmethod
+    def from_adj_list(cls, adj_list: DefaultDict[str, List[Tuple[str, str]]],
+                      entity_vocab: Optional[Dict[str, int]] = None,
+                      rel_vocab: Optional[Dict[str, int]] = None) -> "CSRAdjList":
+        """
+        :param adj_list: map from e1 to list of (r, e2), as returned by create_adj_list
+        :param entity_vocab: optional entity vocab to use for the ids. Entities missing from it are appended.
+        :param rel_vocab: optional relation vocab to use for the ids. Relations missing from it are appended.
+        :return:
+        """
+        entity_vocab = {} if entity_vocab is None else dict(entity_vocab)
+        rel_vocab = {} if rel_vocab is None else dict(rel_vocab)
+        for e1, edges in adj_list.items():
+            if e1 not in entity_vocab:
+                entity_vocab[e1] = len(entity_vocab)
+            for r, e2 in edges:
+                if e2 not in entity_vocab:
+                    entity_vocab[e2] = len(entity_vocab)
+                if r not in rel_vocab:
+                    rel_vocab[r] = len(rel_vocab)
+        num_entities = max(entity_vocab.values()) + 1 if len(entity_vocab) > 0 else 0
+        degrees = np.zeros(num_entities, dtype=np.int64)
+        for e1, edges in adj_list.items():
+            degrees[entity_vocab[e1]] = len(edges)
+        indptr = np.zeros(num_entities + 1, dtype=np.int64)
+        np.cumsum(degrees, out=indptr[1:])
+        rel_ids = np.empty(indptr[-1], dtype=np.int32)
+        ent_ids = np.empty(indptr[-1], dtype=np.int32)
+        for e1, edges in adj_list.items():
+            st = indptr[entity_vocab[e1]]
+            for ctr, (r, e2) in enumerate(edges):
+                rel_ids[st + ctr] = rel_vocab[r]
+                ent_ids[st + ctr] = entity_vocab[e2]
+        rev_entity_vocab = {v: k for k, v in entity_vocab.items()}
+        rev_rel_vocab = {v: k for k, v in rel_vocab.items()}
+        return cls(indptr, rel_ids, ent_ids, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab)
+
+
+def _choose_edges_exact(csr_adj: CSRAdjList, curr: np.ndarray, visited: np.ndarray, rng) -> np.ndarray:
+    """
+    For every walk, pick one outgoing edge of curr uniformly among the edges whose target is not in visited.
+    :return: index of the chosen edge into csr_adj.rel_ids/ent_ids, -1 if every outgoing edge leads to a loop
+    """
+    st = csr_adj.indptr[curr]
+    deg = csr_adj.indptr[curr + 1] - st
+    walk_of_edge = np.repeat(np.arange(curr.shape[0]), deg)
+    first_edge_of_walk = np.cumsum(deg) - deg
+    edge_idx = np.repeat(st, deg) + np.arange(walk_of_edge.shape[0]) - np.repeat(first_edge_of_walk, deg)
+    valid = ~(visited[walk_of_edge] == csr_adj.ent_ids[edge_idx][:, None]).any(axis=1)
+    num_valid = np.bincount(walk_of_edge, weights=valid, minlength=curr.shape[0]).astype(np.int64)
+    pick = np.floor(rng.random(curr.shape[0]) * num_valid).astype(np.int64)
+    # rank of each valid edge among the valid edges of its walk
+    valid_rank = np.cumsum(valid) - 1 - np.repeat(np.cumsum(num_valid) - num_valid, deg)
+    chosen = np.full(curr.shape[0], -1, dtype=np.int64)
+    hit = valid & (valid_rank == pick[walk_of_edge])
+    chosen[walk_of_edge[hit]] = edge_idx[hit]
+    return chosen
+
+
+def sample_paths(csr_adj: CSRAdjList, start_ids: np.ndarray, num_paths: int, max_len: int = 3,
+                 prevent_loops: bool = True, rng=None, num_rejection_rounds: int = 4) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Vectorized version of preprocessing.get_paths. Runs num_paths random walks of at most max_len steps from each
+    start entity; all walks are advanced together. At every step a walk picks one of the outgoing edges of its current
+    node uniformly at random (only edges that do not revisit an entity on the path, if prevent_loops) and stops when
+    there is no such edge.
+    Loop prevention first uses a few rounds of rejection sampling (which keeps the choice uniform over valid edges)
+    and resolves the walks which are still rejected by enumerating their outgoing edges.
+    :param csr_adj:
+    :param start_ids: entity ids to start the walks from
+    :param num_paths: number of walks per start entity
+    :param max_len:
+    :param prevent_loops:
+    :param rng: numpy Generator
+    :param num_rejection_rounds:
+    :return: rel_paths, ent_paths (num_walks X max_len, padded with -1) and owner (num_walks,), the index into
+    start_ids of the entity each walk started from.
+    """
+    if rng is None:
+        rng = default_rng()
+    start_ids = np.asarray(start_ids, dtype=np.int64)
+    owner = np.repeat(np.arange(start_ids.shape[0]), num_paths)
+    num_walks = owner.shape[0]
+    rel_paths = np.full((num_walks, max_len), -1, dtype=np.int32)
+    ent_paths = np.full((num_walks, max_len), -1, dtype=np.int32)
+    visited = np.empty((num_walks, max_len + 1), dtype=np.int64)
+    visited[:, 0] = start_ids[owner]
+    curr = start_ids[owner]
+    active = np.arange(num_walks)
+    for l in range(max_len):
+        deg = csr_adj.degree(curr[active])
+        active = active[deg > 0]
+        if active.shape[0] == 0:
+            break
+        a_curr = curr[active]
+        a_st = csr_adj.indptr[a_curr]
+        a_deg = csr_adj.indptr[a_curr + 1] - a_st
+        chosen = a_st + np.floor(rng.random(active.shape[0]) * a_deg).astype(np.int64)
+        if prevent_loops:
+            a_visited = visited[active, :l + 1]
+            pending = (a_visited == csr_adj.ent_ids[chosen][:, None]).any(axis=1).nonzero()[0]
+            for _ in range(num_rejection_rounds):
+                if pending.shape[0] == 0:
+                    break
+                retry = a_st[pending] + np.floor(rng.random(pending.shape[0]) * a_deg[pending]).astype(np.int64)
+                chosen[pending] = retry
+                loops = (a_visited[pending] == csr_adj.ent_ids[retry][:, None]).any(axis=1)
+                pending = pending[loops]
+            if pending.shape[0] > 0:
+                chosen[pending] = _choose_edges_exact(csr_adj, a_curr[pending], a_visited[pending], rng)
+            keep = chosen >= 0
+            active, chosen = active[keep], chosen[keep]
+        next_ent = csr_adj.ent_ids[chosen]
+        rel_paths[active, l] = csr_adj.rel_ids[chosen]
+        ent_paths[active, l] = next_ent
+        visited[active, l + 1] = next_ent
+        curr[active] = next_ent
+    return rel_paths, ent_paths, owner
+
+
+def get_paths_vectorized(args, csr_adj: CSRAdjList, start_nodes: List[str], max_len: int = 3, rng=None) \
+        -> Dict[str, Set[Tuple[Tuple[str, str], ...]]]:
+    """
+    Drop-in replacement of get_paths for a batch of start nodes.
+    :return: map from start node to the set of sampled paths, each path a tuple of (r, e) pairs
+    """
+    start_ids = np.array([csr_adj.entity_vocab[e] for e in start_nodes], dtype=np.int64)
+    rel_paths, ent_paths, owner = sample_paths(csr_adj, start_ids, args.num_paths_to_collect, max_len,
+                                               prevent_loops=bool(args.prevent_loops), rng=rng)
+    # de-duplicate before going back to strings
+    uniq_rows = np.unique(np.hstack([owner[:, None], rel_paths, ent_paths]), axis=0)
+    all_paths = {e: set() for e in start_nodes}
+    for row in uniq_rows.tolist():
+        rels, ents = row[1:max_len + 1], row[max_len + 1:]
+        path = tuple((csr_adj.rev_rel_vocab[r], csr_adj.rev_entity_vocab[e]) for r, e in zip(rels, ents) if r >= 0)
+        all_paths[start_nodes[row[0]]].add(path)
+    return all_paths
@@ -0,0 +1,318 @@
+import os
+import pickle
+from collections import OrderedDict
+import numpy as np
+from tqdm import tqdm
+from typing import *
+from src.prob_cbr.data.program_vocab import ProgramVocab
+
+
+def _encode_paths(paths_map: Dict[str, Iterable[Tuple[Tuple[str, str], ...]]], entity_vocab: Dict[str, int],
+                  rel_vocab: Dict[str, int], max_len: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Encode a map from head entity to a collection of (r, e) tuple paths into id arrays.
+    Paths of an entity are sorted so that the encoding does not depend on set iteration order.
+    Relations and entities missing from the vocabs are added to them.
+    :return: head ids, number of paths per head, rel ids and ent ids (num_paths X max_len, padded with -1)
+    """
+    heads, counts = [], []
+    rows = []
+    for e1, paths in paths_map.items():
+        if e1 not in entity_vocab:
+            entity_vocab[e1] = len(entity_vocab)
+        paths = sorted(set(paths))
+        heads.append(entity_vocab[e1])
+        counts.append(len(paths))
+        rows += paths
+    rel_ids = np.full((len(rows), max_len), -1, dtype=np.int32)
+    ent_ids = np.full((len(rows), max_len), -1, dtype=np.int32)
+    for row_ctr, path in enumerate(rows):
+        for l, (r, e) in enumerate(path):
+            if r not in rel_vocab:
+                rel_vocab[r] = len(rel_vocab)
+            if e not in entity_vocab:
+                entity_vocab[e] = len(entity_vocab)
+            rel_ids[row_ctr, l] = rel_vocab[r]
+            ent_ids[row_ctr, l] = entity_vocab[e]
+    return np.array(heads, dtype=np.int64), np.array(counts, dtype=np.int64), rel_ids, ent_ids
+
+
+class PathStore(object):
+    """
+    Columnar store of the paths sampled around every entity (the all_paths map).
+    The paths of entity id i are the rows offsets[i]:offsets[i + 1] of
+        rel_ids: num_paths X max_len int32 relation ids
+        ent_ids: num_paths X max_len int32 entity ids
+    where a path shorter than max_len is padded with -1.
+    The store also behaves like the old all_paths dict, i.e. all_paths[e] gives the paths around e as tuples of
+    (r, e) pairs.
+    When loaded with mmap_mode, the arrays stay on disk and only the rows of the requested entities are read.
+    The rows (paths, programs and answer index) of the last cache_size entities read are kept in memory, so that
+    repeated lookups around the same neighbour do not go back to the memory-mapped arrays.
+    For every head entity, the store also keeps an inverted index from the entities reached by its paths to their
+    positions, so that the paths ending at an answer are found without scanning all paths around the head:
+        inv_ent_ids[inv_offsets[i]:inv_offsets[i + 1]]: reached entity ids, sorted
+        inv_pos[inv_offsets[i]:inv_offsets[i + 1]]: flat position (path * max_len + hop) into rel_ids/ent_ids
+    Programs (relation sequences) are interned in program_vocab: prog_ids[p, l] is the program id of the first l + 1
+    relations of path p.
+    """
+    FILE_NAMES = ["rel_ids", "ent_ids", "offsets", "entity_names", "relation_names"]
+    INDEX_FILE_NAMES = ["inv_offsets", "inv_ent_ids", "inv_pos"]
+
+    def __init__(self, rel_ids: np.ndarray, ent_ids: np.ndarray, offsets: np.ndarray, entity_names: np.ndarray,
+                 relation_names: np.ndarray, entity_vocab: Optional[Dict[str, int]] = None, cache_size: int = 0,
+                 answer_index: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+                 programs: Optional[Tuple[ProgramVocab, np.ndarray]] = None):
+        self.rel_ids = rel_ids
+        self.ent_ids = ent_ids
+        self.offsets = offsets
+        if answer_index is None:
+            answer_index = self.build_answer_index(ent_ids, offsets)
+        self.inv_offsets, self.inv_ent_ids, self.inv_pos = answer_index
+        self.entity_names = entity_names
+        self.relation_names = relation_names.tolist()
+        if programs is None:
+            programs = ProgramVocab.from_path_arrays(rel_ids, self.relation_names)
+        self.program_vocab, self.prog_ids = programs
+        self._entity_vocab = entity_vocab
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # LRU of entity id -> rows of _get_entity
+
+    @property
+    def entity_vocab(self) -> Dict[str, int]:
+        # built on first use, so that a memory-mapped store does not have to read all entity names at load time
+        if self._entity_vocab is None:
+            self._entity_vocab = {e: e_ctr for e_ctr, e in enumerate(self.entity_names.tolist())}
+        return self._entity_vocab
+
+    @staticmethod
+    def build_answer_index(ent_ids: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Build the per-head inverted index (inv_offsets, inv_ent_ids, inv_pos) from the path arrays.
+        """
+        num_paths, max_len = ent_ids.shape
+        flat_ent_ids = np.asarray(ent_ids).reshape(-1)
+        flat_pos = np.nonzero(flat_ent_ids >= 0)[0]
+        head_of_path = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+        # sort by head and then by the reached entity. lexsort is stable, so positions of the same entity stay in
+        # (path, hop) order
+        order = np.lexsort((flat_ent_ids[flat_pos], head_of_path[flat_pos // max_len]))
+        inv_pos = flat_pos[order]
+        inv_ent_ids = flat_ent_ids[inv_pos].astype(np.int32)
+        hops_per_path = (np.asarray(ent_ids) >= 0).sum(axis=1)
+        cum_hops = np.zeros(num_paths + 1, dtype=np.int64)
+        np.cumsum(hops_per_path, out=cum_hops[1:])
+        inv_offsets = cum_hops[offsets]
+        return inv_offsets, inv_ent_ids, inv_pos
+
+    @property
+    def max_len(self) -> int:
+        return self.rel_ids.shape[1]
+
+    @property
+    def num_entities(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    @classmethod
+    def from_path_splits(cls, file_names: List[str], entity_vocab: Dict[str, int], rel_vocab: Dict[str, int],
+                         max_len: int) -> "PathStore":
+        """
+        Build the store from the pickled path splits written by get_paths_parallel, one split at a time.
+        :param file_names: path splits
+        :param entity_vocab: ids to use for entities. Entities missing from it are appended (on a copy).
+        :param rel_vocab: ids to use for relations. Relations missing from it are appended (on a copy).
+        :param max_len: max path length
+        :return:
+        """
+        entity_vocab, rel_vocab = dict(entity_vocab), dict(rel_vocab)
+        all_heads, all_counts, all_rel_ids, all_ent_ids = [], [], [], []
+        for file_name in tqdm(file_names):
+            with open(file_name, "rb") as fin:
+                paths_map = pickle.load(fin)
+            heads, counts, rel_ids, ent_ids = _encode_paths(paths_map, entity_vocab, rel_vocab, max_len)
+            del paths_map
+            all_heads.append(heads)
+            all_counts.append(counts)
+            all_rel_ids.append(rel_ids)
+            all_ent_ids.append(ent_ids)
+        return cls._from_blocks(all_heads, all_counts, all_rel_ids, all_ent_ids, entity_vocab, rel_vocab, max_len)
+
+    @classmethod
+    def from_path_map(cls, paths_map: Dict[str, Iterable[Tuple[Tuple[str, str], ...]]], entity_vocab: Dict[str, int],
+                      rel_vocab: Dict[str, int], max_len: int) -> "PathStore":
+        entity_vocab, rel_vocab = dict(entity_vocab), dict(rel_vocab)
+        heads, counts, rel_ids, ent_ids = _encode_paths(paths_map, entity_vocab, rel_vocab, max_len)
+        return cls._from_blocks([heads], [counts], [rel_ids], [ent_ids], entity_vocab, rel_vocab, max_len)
+
+    @classmethod
+    def _from_blocks(cls, all_heads, all_counts, all_rel_ids, all_ent_ids, entity_vocab, rel_vocab, max_len):
+        heads = np.concatenate(all_heads) if len(all_heads) > 0 else np.zeros(0, dtype=np.int64)
+        counts = np.concatenate(all_counts) if len(all_counts) > 0 else np.zeros(0, dtype=np.int64)
+        rel_ids = np.vstack(all_rel_ids) if len(all_rel_ids) > 0 else np.zeros((0, max_len), dtype=np.int32)
+        ent_ids = np.vstack(all_ent_ids) if len(all_ent_ids) > 0 else np.zeros((0, max_len), dtype=np.int32)
+        # a later split overrides an earlier one for the same entity (same as combine_path_splits)
+        _, last = np.unique(heads[::-1], return_index=True)
+        keep = np.zeros(heads.shape[0], dtype=bool)
+        keep[heads.shape[0] - 1 - last] = True
+        block_st = np.cumsum(counts) - counts
+        order = np.argsort(heads, kind="stable")
+        order = order[keep[order]]
+        sel_counts = counts[order]
+        rows = np.repeat(block_st[order] - (np.cumsum(sel_counts) - sel_counts), sel_counts) + \
+            np.arange(sel_counts.sum())
+        num_entities = max(entity_vocab.values()) + 1 if len(entity_vocab) > 0 else 0
+        entity_counts = np.zeros(num_entities, dtype=np.int64)
+        entity_counts[heads[order]] = counts[order]
+        offsets = np.zeros(num_entities + 1, dtype=np.int64)
+        np.cumsum(entity_counts, out=offsets[1:])
+        entity_names = np.array([e for e, _ in sorted(entity_vocab.items(), key=lambda item: item[1])])
+        relation_names = np.array([r for r, _ in sorted(rel_vocab.items(), key=lambda item: item[1])])
+        return cls(rel_ids[rows], ent_ids[rows], offsets, entity_names, relation_names, entity_vocab)
+
+    def save(self, dir_name: str):
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        for name, arr in [("rel_ids", self.rel_ids), ("ent_ids", self.ent_ids), ("offsets", self.offsets),
+                          ("entity_names", self.entity_names), ("relation_names", np.array(self.relation_names)),
+                          ("inv_offsets", self.inv_offsets), ("inv_ent_ids", self.inv_ent_ids),
+                          ("inv_pos", self.inv_pos), ("prog_ids", self.prog_ids)]:
+            np.save(os.path.join(dir_name, name + ".npy"), arr, allow_pickle=False)
+        self.program_vocab.save(dir_name)
+
+    @classmethod
+    def load(cls, dir_name: str, entity_vocab: Optional[Dict[str, int]] = None, mmap_mode: Optional[str] = None,
+             cache_size: int = 0) -> "PathStore":
+        """
+        :param dir_name:
+        :param entity_vocab: entity vocab the store was built with. If None, it is built from the stored names. A
+        vocab in which a stored entity has another id raises a ValueError.
+        :param mmap_mode: passed to np.load, e.g. "r" to memory-map the arrays instead of reading them
+        :param cache_size: number of recently used entities to keep decoded in memory
+        :return:
+        """
+        arrays = {name: np.load(os.path.join(dir_name, name + ".npy"), mmap_mode=mmap_mode, allow_pickle=False)
+                  for name in cls.FILE_NAMES + cls.INDEX_FILE_NAMES + ["prog_ids"]
+                  if os.path.exists(os.path.join(dir_name, name + ".npy"))}
+        answer_index = None
+        if all([name in arrays for name in cls.INDEX_FILE_NAMES]):
+            answer_index = arrays["inv_offsets"], arrays["inv_ent_ids"], arrays["inv_pos"]
+        if entity_vocab is not None:
+            cls._check_entity_vocab(arrays["entity_names"], entity_vocab, dir_name)
+        programs = None
+        if "prog_ids" in arrays and ProgramVocab.exists(dir_name):
+            programs = ProgramVocab.load(dir_name), arrays["prog_ids"]
+        return cls(arrays["rel_ids"], arrays["ent_ids"], arrays["offsets"], arrays["entity_names"],
+                   arrays["relation_names"], entity_vocab, cache_size, answer_index, programs)
+
+    @staticmethod
+    def _check_entity_vocab(entity_names: np.ndarray, entity_vocab: Dict[str, int], dir_name: str):
+        """
+        Raises a ValueError unless every stored entity has its position in entity_names as id in entity_vocab. The
+        vocab can have more entities than the store, they have no paths.
+        """
+        names = entity_names.tolist()
+        ids = np.array([entity_vocab.get(e, -1) for e in names], dtype=np.int64)
+        mismatch = np.nonzero(ids != np.arange(len(names)))[0]
+        if mismatch.shape[0] > 0:
+            e = names[mismatch[0]]
+            raise ValueError("Entity {} has id {} in the path store at {}, but {} in the entity vocab ({} entities "
+                             "differ). The paths were stored for another graph, please build the path store "
+                             "again".format(e, mismatch[0], dir_name, entity_vocab.get(e), mismatch.shape[0]))
+
+    @staticmethod
+    def exists(dir_name: str) -> bool:
+        return all([os.path.exists(os.path.join(dir_name, name + ".npy")) for name in PathStore.FILE_NAMES])
+
+    def _get_entity(self, e_id: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Read the rows of entity e_id, through the LRU of the last cache_size entities read.
+        :return: rel ids, ent ids and prog ids of the paths around e_id (num_paths_e X max_len), the entity ids they
+        reach (sorted) and the flat positions (path * max_len + hop) where they reach them, relative to the first path
+        of e_id
+        """
+        if e_id in self._cache:
+            self._cache.move_to_end(e_id)
+            return self._cache[e_id]
+        st, en = self.offsets[e_id], self.offsets[e_id + 1]
+        inv_st, inv_en = self.inv_offsets[e_id], self.inv_offsets[e_id + 1]
+        inv_pos = np.asarray(self.inv_pos[inv_st:inv_en]) - st * self.max_len
+        entity = (np.array(self.rel_ids[st:en]), np.array(self.ent_ids[st:en]), np.array(self.prog_ids[st:en]),
+                  np.array(self.inv_ent_ids[inv_st:inv_en]), inv_pos)
+        if self.cache_size > 0:
+            self._cache[e_id] = entity
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entity
+
+    def get_path_arrays(self, e: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: rel ids and ent ids of the paths around e (num_paths_e X max_len)
+        """
+        e_id = self.entity_vocab.get(e, -1)
+        if e_id < 0 or e_id >= self.num_entities:
+            return self.rel_ids[:0], self.ent_ids[:0]
+        rel_ids, ent_ids, _, _, _ = self._get_entity(e_id)
+        return rel_ids, ent_ids
+
+    def get_programs(self, e: str, ans: str) -> List[List[str]]:
+        """
+        Same as utils.get_programs(e, ans, all_paths[e]): the relation sequences of all paths around e,
+        cut at every position where they reach ans.
+        """
+        path_idx, hops = self._get_local_answer_positions(e, ans)
+        if path_idx.shape[0] == 0:
+            return []
+        rel_ids = self._get_entity(self.entity_vocab[e])[0][path_idx]
+        return [[self.relation_names[r] for r in rel_ids[p_ctr, :l + 1]] for p_ctr, l in enumerate(hops.tolist())]
+
+    def get_program_ids(self, e: str, ans: str) -> np.ndarray:
+        """
+        Same as get_programs, but returns the ids of the programs in program_vocab.
+        """
+        path_idx, hops = self._get_local_answer_positions(e, ans)
+        if path_idx.shape[0] == 0:
+            return np.zeros(0, dtype=self.prog_ids.dtype)
+        return self._get_entity(self.entity_vocab[e])[2][path_idx, hops]
+
+    def get_answer_positions(self, e: str, ans: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up the answer index of e.
+        :return: (path row, hop) of every position where a path around e reaches ans, in (path, hop) order
+        """
+        path_idx, hops = self._get_local_answer_positions(e, ans)
+        if path_idx.shape[0] > 0:
+            path_idx = path_idx + self.offsets[self.entity_vocab[e]]
+        return path_idx, hops
+
+    def _get_local_answer_positions(self, e: str, ans: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (path row relative to the first path of e, hop) of every position where a path around e reaches ans
+        """
+        e_id, ans_id = self.entity_vocab.get(e, -1), self.entity_vocab.get(ans, -1)
+        if e_id < 0 or e_id >= self.num_entities or ans_id < 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        _, _, _, reached, pos = self._get_entity(e_id)
+        lo, hi = np.searchsorted(reached, ans_id, side="left"), np.searchsorted(reached, ans_id, side="right")
+        pos = pos[lo:hi]
+        return pos // self.max_len, pos % self.max_len
+
+    def __contains__(self, e: str) -> bool:
+        return self.get_path_arrays(e)[0].shape[0] > 0
+
+    def __getitem__(self, e: str) -> List[Tuple[Tuple[str, str], ...]]:
+        rel_ids, ent_ids = self.get_path_arrays(e)
+        paths = []
+        for rels, ents in zip(rel_ids.tolist(), ent_ids.tolist()):
+            paths.append(tuple((self.relation_names[r], str(self.entity_names[e_dash]))
+                               for r, e_dash in zip(rels, ents) if r >= 0))
+        return paths
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(np.diff(self.offsets)))
+
+    def keys(self) -> List[str]:
+        return [str(self.entity_names[e_id]) for e_id in np.nonzero(np.diff(self.offsets))[0]]
+
+    def items(self):
+        for e in self.keys():
+            yield e, self[e]
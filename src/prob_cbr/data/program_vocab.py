@@ -0,0 +1,206 @@
+import os
+import json
+import hashlib
+import numpy as np
+from typing import *
+
+VOCAB_FINGERPRINT_FILE_NAME = "program_vocab_fingerprint.json"
+
+
+class ProgramVocab(object):
+    """
+    Dictionary of programs (relation sequences) with dense integer ids.
+    rel_ids[p] holds the relation ids of program p, padded with -1 to max_len.
+    """
+
+    def __init__(self, rel_ids: np.ndarray, relation_names: List[str]):
+        self.rel_ids = rel_ids
+        self.relation_names = list(relation_names)
+        self.rel_vocab = {r: r_ctr for r_ctr, r in enumerate(self.relation_names)}
+        self.lengths = (np.asarray(rel_ids) >= 0).sum(axis=1)
+        self._lookup = None  # tuple of relation ids -> program id, built on first use
+        self._added = []  # rel id tuples of programs interned after construction
+        self._fingerprints = {}  # number of programs -> their fingerprint
+
+    def __len__(self) -> int:
+        return self.rel_ids.shape[0] + len(self._added)
+
+    @property
+    def max_len(self) -> int:
+        return self.rel_ids.shape[1]
+
+    @property
+    def lookup(self) -> Dict[Tuple[int, ...], int]:
+        if self._lookup is None:
+            self._lookup = {}
+            for p_ctr, (rels, l) in enumerate(zip(np.asarray(self.rel_ids).tolist(), self.lengths.tolist())):
+                self._lookup[tuple(rels[:l])] = p_ctr
+        return self._lookup
+
+    @classmethod
+    def from_path_arrays(cls, path_rel_ids: np.ndarray, relation_names: List[str]) \
+            -> Tuple["ProgramVocab", np.ndarray]:
+        """
+        Build the vocab of all programs in a set of sampled paths. Every prefix of a path is a program.
+        Ids are assigned by length and then lexicographically, so they only depend on the set of paths.
+        :param path_rel_ids: num_paths X max_len relation ids of the paths, padded with -1
+        :param relation_names:
+        :return: the vocab and a num_paths X max_len matrix with the program id of every path prefix
+        (-1 for padding)
+        """
+        path_rel_ids = np.asarray(path_rel_ids)
+        num_paths, max_len = path_rel_ids.shape
+        prog_ids = np.full((num_paths, max_len), -1, dtype=np.int32)
+        all_programs = []
+        num_programs = 0
+        for l in range(max_len):
+            has_hop = path_rel_ids[:, l] >= 0
+            if not np.any(has_hop):
+                break
+            programs, inverse = np.unique(path_rel_ids[has_hop, :l + 1], axis=0, return_inverse=True)
+            prog_ids[has_hop, l] = num_programs + inverse.reshape(-1)
+            padded = np.full((programs.shape[0], max_len), -1, dtype=np.int32)
+            padded[:, :l + 1] = programs
+            all_programs.append(padded)
+            num_programs += programs.shape[0]
+        rel_ids = np.vstack(all_programs) if len(all_programs) > 0 else np.zeros((0, max_len), dtype=np.int32)
+        return cls(rel_ids, relation_names), prog_ids
+
+    def get_rel_ids(self, p: int) -> Tuple[int, ...]:
+        if p >= self.rel_ids.shape[0]:
+            return self._added[p - self.rel_ids.shape[0]]
+        return tuple(self.rel_ids[p, :self.lengths[p]].tolist())
+
+    def get_program(self, p: int) -> Tuple[str, ...]:
+        """
+        :return: the relation names of program p
+        """
+        return tuple(self.relation_names[r] for r in self.get_rel_ids(p))
+
+    def get_id(self, program: Sequence[str]) -> int:
+        """
+        :return: id of the program, -1 if it is not in the vocab
+        """
+        try:
+            return self.lookup.get(tuple(self.rel_vocab[r] for r in program), -1)
+        except KeyError:
+            return -1
+
+    def intern(self, program: Sequence[str]) -> int:
+        """
+        :return: id of the program, adding it to the vocab if needed
+        """
+        p = self.get_id(program)
+        if p >= 0:
+            return p
+        for r in program:
+            if r not in self.rel_vocab:
+                self.rel_vocab[r] = len(self.relation_names)
+                self.relation_names.append(r)
+        rels = tuple(self.rel_vocab[r] for r in program)
+        p = len(self)
+        self._added.append(rels)
+        self.lookup[rels] = p
+        return p
+
+    def is_query_relation(self, p: int, r: str) -> bool:
+        """
+        :return: True if p is the one-hop program which is the query relation itself
+        """
+        rels = self.get_rel_ids(p)
+        return len(rels) == 1 and self.relation_names[rels[0]] == r
+
+    def _get_all_rel_ids(self) -> np.ndarray:
+        """
+        :return: rel_ids followed by the programs interned after construction
+        """
+        rel_ids = np.asarray(self.rel_ids)
+        if len(self._added) == 0:
+            return rel_ids
+        # interned programs can be longer than the paths the vocab was built from
+        max_len = max([self.max_len] + [len(rels) for rels in self._added])
+        rel_ids = np.hstack([rel_ids, np.full((rel_ids.shape[0], max_len - self.max_len), -1, dtype=np.int32)])
+        added = np.full((len(self._added), max_len), -1, dtype=np.int32)
+        for p_ctr, rels in enumerate(self._added):
+            added[p_ctr, :len(rels)] = rels
+        return np.vstack([rel_ids, added])
+
+    def get_fingerprint(self, num_programs: Optional[int] = None) -> Dict:
+        """
+        Fingerprint of the first num_programs programs (all of them by default), saved next to the tables keyed by
+        program ids of this vocab. Programs interned later get new ids, so they do not change the fingerprint of the
+        ones before them.
+        :return: {"sha1": hash of the programs and of the names of their relations, "num_programs": num_programs}
+        """
+        num_programs = len(self) if num_programs is None else num_programs
+        if num_programs not in self._fingerprints:
+            rel_ids = self._get_all_rel_ids()[:num_programs]
+            max_len = int(((rel_ids >= 0).sum(axis=1)).max()) if num_programs > 0 else 0
+            rel_ids = np.ascontiguousarray(rel_ids[:, :max_len], dtype=np.int32)
+            num_relations = int(rel_ids.max()) + 1 if rel_ids.size > 0 else 0
+            sha = hashlib.sha1()
+            sha.update(json.dumps(self.relation_names[:num_relations]).encode("utf-8"))
+            sha.update(json.dumps(rel_ids.shape).encode("utf-8"))
+            sha.update(rel_ids.tobytes())
+            self._fingerprints[num_programs] = {"sha1": sha.hexdigest(), "num_programs": num_programs}
+        return self._fingerprints[num_programs]
+
+    def matches(self, fingerprint: Dict) -> bool:
+        """
+        :return: True if the program ids of a table saved with fingerprint refer to the same programs in this vocab
+        """
+        return fingerprint["num_programs"] <= len(self) and \
+            self.get_fingerprint(fingerprint["num_programs"])["sha1"] == fingerprint["sha1"]
+
+    def save(self, dir_name: str):
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        np.save(os.path.join(dir_name, "program_rel_ids.npy"), self._get_all_rel_ids(), allow_pickle=False)
+        np.save(os.path.join(dir_name, "program_relation_names.npy"), np.array(self.relation_names),
+                allow_pickle=False)
+
+    @classmethod
+    def load(cls, dir_name: str, mmap_mode: Optional[str] = None) -> "ProgramVocab":
+        rel_ids = np.load(os.path.join(dir_name, "program_rel_ids.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+        relation_names = np.load(os.path.join(dir_name, "program_relation_names.npy"), allow_pickle=False)
+        return cls(rel_ids, relation_names.tolist())
+
+    @staticmethod
+    def exists(dir_name: str) -> bool:
+        return os.path.exists(os.path.join(dir_name, "program_rel_ids.npy"))
+
+
+def to_program_ids(nested_map: Dict, program_vocab: ProgramVocab) -> Dict:
+    """
+    Convert a cluster -> relation -> program map keyed by relation tuples (the old pickle format) into one keyed by
+    program ids. Maps already keyed by program ids are returned as is.
+    """
+    converted = {}
+    for c, r_map in nested_map.items():
+        converted[c] = {}
+        for r, p_map in r_map.items():
+            converted[c][r] = {(program_vocab.intern(p) if isinstance(p, tuple) else p): v for p, v in p_map.items()}
+    return converted
+
+
+def write_vocab_fingerprint(dir_name: str, fingerprint: Optional[Dict]):
+    """
+    Records the fingerprint of the program vocab the tables (or per entity maps) in dir_name are keyed by.
+    """
+    if fingerprint is None:
+        return
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    with open(os.path.join(dir_name, VOCAB_FINGERPRINT_FILE_NAME), "w") as fout:
+        json.dump(fingerprint, fout)
+
+
+def read_vocab_fingerprint(dir_name: str) -> Optional[Dict]:
+    """
+    :return: the fingerprint written by write_vocab_fingerprint, None if the tables were written without one
+    """
+    file_name = os.path.join(dir_name, VOCAB_FINGERPRINT_FILE_NAME)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as fin:
+        return json.load(fin)
@@ -0,0 +1,221 @@
+import os
+import logging
+import numpy as np
+from typing import *
+from src.prob_cbr.data.score_table import get_segments, score_programs, PartitionedTable
+from src.prob_cbr.data.program_vocab import ProgramVocab
+
+logger = logging.getLogger()
+
+NO_CLUSTER = -1  # segment of a relation used for the clusters which have no statistics for it
+
+
+def _get_clusters(table, r: str) -> List[int]:
+    """
+    :return: clusters which have rows for relation r in a ScoreTable or PartitionedScoreTable
+    """
+    if isinstance(table, PartitionedTable):
+        table = table.get_table(r)
+    if table is None:
+        return []
+    r_id = table.rel_vocab.get(r, -1)
+    return [c for (c, c_r_id) in table.segments.keys() if c_r_id == r_id]
+
+
+class RankedProgramTable(object):
+    """
+    For every (cluster, relation), the programs which have a score in the cluster or the fall-back maps, sorted the
+    way ProbCBR.rank_programs sorts them, i.e. by decreasing prior * precision (precision only if not use_prior)
+    and then by program id, with the fall-back score for the programs missing from the cluster.
+    Rows are sorted by (cluster, relation, rank). programs_by_id / rank_by_id is the same segment sorted by program
+    id, so that a set of programs is intersected with the segment with np.searchsorted.
+        clusters: int64 cluster ids (NO_CLUSTER for the programs scored from the fall-back maps only)
+        relations: int32 ids into relation_names
+        programs, scores, in_cluster: ranked programs, their scores and if they were scored with the cluster maps
+        programs_by_id, rank_by_id: programs of the segment sorted by id and their rank in the segment
+    """
+    COLUMNS = ["clusters", "relations", "programs", "scores", "in_cluster", "programs_by_id", "rank_by_id"]
+
+    def __init__(self, clusters: np.ndarray, relations: np.ndarray, programs: np.ndarray, scores: np.ndarray,
+                 in_cluster: np.ndarray, programs_by_id: np.ndarray, rank_by_id: np.ndarray,
+                 relation_names: List[str], use_prior: bool = True):
+        self.clusters = clusters
+        self.relations = relations
+        self.programs = programs
+        self.scores = scores
+        self.in_cluster = in_cluster
+        self.programs_by_id = programs_by_id
+        self.rank_by_id = rank_by_id
+        self.relation_names = list(relation_names)
+        self.rel_vocab = {r: r_ctr for r_ctr, r in enumerate(self.relation_names)}
+        self.use_prior = use_prior
+        self.segments = get_segments(clusters, relations)
+
+    def __len__(self) -> int:
+        return self.scores.shape[0]
+
+    @classmethod
+    def from_score_tables(cls, r: str, precision_map, precision_map_fallback=None, prior_map=None,
+                          prior_map_fallback=None, use_prior: bool = True, fallback_c: int = 0) \
+            -> "RankedProgramTable":
+        """
+        Ranks the programs of query relation r for every cluster which has statistics for r, and for NO_CLUSTER.
+        """
+        def seg_programs(table, c):
+            return np.zeros(0, dtype=np.int64) if table is None else np.asarray(table.get_segment(c, r)[0])
+
+        clusters = sorted(set(_get_clusters(precision_map, r) + _get_clusters(prior_map, r)))
+        fallback_programs = np.union1d(seg_programs(precision_map_fallback, fallback_c),
+                                       seg_programs(prior_map_fallback, fallback_c))
+        all_columns = {name: [] for name in cls.COLUMNS}
+        for c in [NO_CLUSTER] + clusters:
+            programs = fallback_programs if c == NO_CLUSTER else \
+                np.union1d(np.union1d(seg_programs(precision_map, c), seg_programs(prior_map, c)), fallback_programs)
+            scores, in_cluster = score_programs(c, r, programs, precision_map, precision_map_fallback, prior_map,
+                                                prior_map_fallback, use_prior=use_prior, fallback_c=fallback_c)
+            # programs is sorted by id, so a stable sort by decreasing score breaks ties by id
+            order = np.argsort(-scores, kind="stable")
+            all_columns["clusters"].append(np.full(programs.shape[0], c, dtype=np.int64))
+            all_columns["relations"].append(np.zeros(programs.shape[0], dtype=np.int32))
+            all_columns["programs"].append(programs[order])
+            all_columns["scores"].append(scores[order])
+            all_columns["in_cluster"].append(in_cluster[order])
+            all_columns["programs_by_id"].append(programs)
+            rank_by_id = np.zeros(programs.shape[0], dtype=np.int64)
+            rank_by_id[order] = np.arange(programs.shape[0])
+            all_columns["rank_by_id"].append(rank_by_id)
+        return cls(*[np.concatenate(all_columns[name]) for name in cls.COLUMNS], [r], use_prior)
+
+    def save(self, file_name: str):
+        np.savez(file_name, relation_names=np.array(self.relation_names, dtype=str),
+                 use_prior=np.array(self.use_prior), **{name: getattr(self, name) for name in self.COLUMNS})
+
+    @classmethod
+    def load(cls, file_name: str) -> "RankedProgramTable":
+        with np.load(file_name, allow_pickle=False) as arrays:
+            return cls(*[arrays[name] for name in cls.COLUMNS], arrays["relation_names"].tolist(),
+                       bool(arrays["use_prior"]))
+
+    def save_arrays(self, dir_name: str):
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        for name in self.COLUMNS:
+            np.save(os.path.join(dir_name, name + ".npy"), getattr(self, name), allow_pickle=False)
+        np.save(os.path.join(dir_name, "relation_names.npy"), np.array(self.relation_names, dtype=str),
+                allow_pickle=False)
+        np.save(os.path.join(dir_name, "use_prior.npy"), np.array(self.use_prior), allow_pickle=False)
+
+    @classmethod
+    def load_arrays(cls, dir_name: str, mmap_mode: Optional[str] = None) -> "RankedProgramTable":
+        columns = [np.load(os.path.join(dir_name, name + ".npy"), mmap_mode=mmap_mode, allow_pickle=False)
+                   for name in cls.COLUMNS]
+        return cls(*columns, np.load(os.path.join(dir_name, "relation_names.npy"), allow_pickle=False).tolist(),
+                   bool(np.load(os.path.join(dir_name, "use_prior.npy"), allow_pickle=False)))
+
+    def get_segment(self, c: int, r: str) -> Optional[Tuple[int, int]]:
+        """
+        :return: rows of (c, r), or of (NO_CLUSTER, r) if c has no statistics for r. None if r is not in the table
+        """
+        r_id = self.rel_vocab.get(r, -1)
+        return self.segments.get((int(c), r_id), self.segments.get((NO_CLUSTER, r_id)))
+
+    def _find(self, st: int, en: int, programs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: rank of the programs in the segment and a mask of the programs which are in it
+        """
+        by_id = self.programs_by_id[st:en]
+        if by_id.shape[0] == 0 or programs.shape[0] == 0:
+            return np.zeros(programs.shape[0], dtype=np.int64), np.zeros(programs.shape[0], dtype=bool)
+        pos = np.minimum(np.searchsorted(by_id, programs), by_id.shape[0] - 1)
+        found = by_id[pos] == programs
+        return np.where(found, self.rank_by_id[st:en][pos], 0), found
+
+    def rank(self, c: int, r: str, programs: np.ndarray, query_program: int = -1,
+             max_programs: Optional[int] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Same ranking as score_programs followed by a stable sort on decreasing score, for a set of programs.
+        :param programs: sorted unique program ids (e.g. the programs of the nearest neighbors)
+        :param query_program: id of the one-hop program of r, dropped unless it was scored with the cluster maps
+        :param max_programs: only return the first max_programs
+        :return: ranked programs and their scores, None if r is not in the table
+        """
+        segment = self.get_segment(c, r)
+        if segment is None:
+            return None
+        st, en = segment
+        programs = np.asarray(programs, dtype=np.int64)
+        ranks, found = self._find(st, en, programs)
+        scores = np.where(found, self.scores[st + ranks], 0.0)
+        in_cluster = found & self.in_cluster[st + ranks]
+        keep = in_cluster | (programs != query_program)
+        programs, ranks, scores = programs[keep], ranks[keep], scores[keep]
+        positive = np.nonzero(scores > 0)[0]
+        # positive scores in rank order, then the programs without a score, which are already sorted by id
+        order = np.concatenate([positive[np.argsort(ranks[positive])], np.nonzero(scores <= 0)[0]])
+        if max_programs is not None:
+            order = order[:max_programs]
+        return programs[order], scores[order]
+
+    def get_scores(self, c: int, r: str, programs: np.ndarray) -> Optional[np.ndarray]:
+        """
+        :return: scores of the programs (in any order), 0 for the ones without a score. None if r is not in the table
+        """
+        segment = self.get_segment(c, r)
+        if segment is None:
+            return None
+        programs = np.asarray(programs, dtype=np.int64)
+        ranks, found = self._find(segment[0], segment[1], programs)
+        return np.where(found, self.scores[segment[0] + ranks], 0.0)
+
+
+class PartitionedRankedProgramTable(PartitionedTable):
+    """
+    RankedProgramTables partitioned per relation (see score_table.save_partitioned), loaded when first used.
+    """
+    table_cls = RankedProgramTable
+
+    def rank(self, c: int, r: str, programs: np.ndarray, query_program: int = -1,
+             max_programs: Optional[int] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        table = self.get_table(r)
+        return None if table is None else table.rank(c, r, programs, query_program, max_programs)
+
+    def get_scores(self, c: int, r: str, programs: np.ndarray) -> Optional[np.ndarray]:
+        table = self.get_table(r)
+        return None if table is None else table.get_scores(c, r, programs)
+
+    def uses_prior(self, r: str) -> Optional[bool]:
+        table = self.get_table(r)
+        return None if table is None else table.use_prior
+
+
+def build_ranked_programs(relations: List[str], precision_map, precision_map_fallback, prior_map,
+                          prior_map_fallback, use_prior: bool = True) -> Dict[str, RankedProgramTable]:
+    """
+    :return: relation -> its RankedProgramTable, to be written with score_table.save_partitioned
+    """
+    return {r: RankedProgramTable.from_score_tables(r, precision_map, precision_map_fallback, prior_map,
+                                                    prior_map_fallback, use_prior)
+            for r in relations}
+
+
+def load_ranked_programs(dir_name: str, map_name: str = "ranked_programs",
+                         program_vocab: Optional[ProgramVocab] = None) -> Optional[PartitionedRankedProgramTable]:
+    """
+    :return: the ranked programs written by the preprocessing script, None if they are not found or were written for
+    another program_vocab or without a fingerprint of it (the programs are then ranked with the prior/precision maps
+    at query time)
+    """
+    if PartitionedTable.exists(os.path.join(dir_name, map_name)):
+        table = PartitionedRankedProgramTable(os.path.join(dir_name, map_name))
+        if table.vocab_fingerprint is None:
+            logger.warning("Ranked programs at {} were written without a program vocab fingerprint, ranking with the "
+                           "prior/precision maps".format(table.dir_name))
+            return None
+        if program_vocab is None or table.matches(program_vocab):
+            return table
+        logger.warning("Ranked programs at {} were written for another program vocab, ranking with the "
+                       "prior/precision maps".format(table.dir_name))
+        return None
+    logger.info("Ranked programs not found at {}, ranking with the prior/precision maps".format(
+        os.path.join(dir_name, map_name)))
+    return None
@@ -0,0 +1,352 @@
+import os
+import json
+import pickle
+import logging
+import threading
+import numpy as np
+from typing import *
+from src.prob_cbr.data.program_vocab import ProgramVocab, to_program_ids, write_vocab_fingerprint, \
+    read_vocab_fingerprint
+
+logger = logging.getLogger()
+
+
+def get_segments(clusters: np.ndarray, relations: np.ndarray) -> Dict[Tuple[int, int], Tuple[int, int]]:
+    """
+    :param clusters: cluster of every row, rows of a (cluster, relation) pair are contiguous
+    :return: (cluster, relation id) -> (start, end) of its rows
+    """
+    segments = {}
+    if clusters.shape[0] > 0:
+        clusters, relations = np.asarray(clusters), np.asarray(relations)
+        change = np.nonzero((clusters[1:] != clusters[:-1]) | (relations[1:] != relations[:-1]))[0] + 1
+        starts = np.concatenate([[0], change])
+        ends = np.concatenate([change, [clusters.shape[0]]])
+        for st, en, c, r in zip(starts.tolist(), ends.tolist(), clusters[starts].tolist(),
+                                relations[starts].tolist()):
+            segments[(c, r)] = (st, en)
+    return segments
+
+
+class ScoreTable(object):
+    """
+    Columnar version of the cluster -> relation -> program -> value maps (path prior and precision maps).
+    Rows are sorted by (cluster, relation, program), so the programs of a (cluster, relation) pair are a contiguous
+    sorted segment which is searched with np.searchsorted.
+        clusters: int64 cluster ids
+        relations: int32 ids into relation_names
+        programs: int64 program ids (see ProgramVocab)
+        values: float64 scores
+    vocab_fingerprint is the fingerprint of the ProgramVocab of the program ids, saved with the table by save.
+    """
+
+    def __init__(self, clusters: np.ndarray, relations: np.ndarray, programs: np.ndarray, values: np.ndarray,
+                 relation_names: List[str], vocab_fingerprint: Optional[Dict] = None):
+        self.clusters = clusters
+        self.relations = relations
+        self.programs = programs
+        self.values = values
+        self.relation_names = list(relation_names)
+        self.vocab_fingerprint = vocab_fingerprint
+        self.rel_vocab = {r: r_ctr for r_ctr, r in enumerate(self.relation_names)}
+        # (cluster, relation id) -> (start, end) of its segment
+        self.segments = get_segments(clusters, relations)
+
+    def __len__(self) -> int:
+        return self.values.shape[0]
+
+    @classmethod
+    def from_nested_map(cls, nested_map: Dict, program_vocab: Optional[ProgramVocab] = None) -> "ScoreTable":
+        """
+        :param nested_map: cluster -> relation -> program -> value
+        :param program_vocab: needed if the programs are tuples of relations instead of program ids. They are
+        interned in it.
+        :return:
+        """
+        relation_names = sorted(set([r for r_map in nested_map.values() for r in r_map]))
+        rel_vocab = {r: r_ctr for r_ctr, r in enumerate(relation_names)}
+        clusters, relations, programs, values = [], [], [], []
+        for c, r_map in nested_map.items():
+            for r, p_map in r_map.items():
+                for p, v in p_map.items():
+                    clusters.append(int(c))
+                    relations.append(rel_vocab[r])
+                    programs.append(program_vocab.intern(p) if isinstance(p, tuple) else p)
+                    values.append(v)
+        clusters = np.array(clusters, dtype=np.int64)
+        relations = np.array(relations, dtype=np.int32)
+        programs = np.array(programs, dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        order = np.lexsort((programs, relations, clusters))
+        return cls(clusters[order], relations[order], programs[order], values[order], relation_names)
+
+    def to_nested_map(self) -> Dict:
+        nested_map = {}
+        for (c, r_id), (st, en) in self.segments.items():
+            r = self.relation_names[r_id]
+            nested_map.setdefault(c, {})[r] = dict(zip(self.programs[st:en].tolist(), self.values[st:en].tolist()))
+        return nested_map
+
+    def save(self, file_name: str):
+        arrays = {}
+        if self.vocab_fingerprint is not None:
+            arrays["vocab_fingerprint"] = np.array(json.dumps(self.vocab_fingerprint))
+        np.savez(file_name, clusters=self.clusters, relations=self.relations, programs=self.programs,
+                 values=self.values, relation_names=np.array(self.relation_names, dtype=str), **arrays)
+
+    @classmethod
+    def load(cls, file_name: str) -> "ScoreTable":
+        with np.load(file_name, allow_pickle=False) as arrays:
+            vocab_fingerprint = json.loads(str(arrays["vocab_fingerprint"])) if "vocab_fingerprint" in arrays \
+                else None
+            return cls(arrays["clusters"], arrays["relations"], arrays["programs"], arrays["values"],
+                       arrays["relation_names"].tolist(), vocab_fingerprint)
+
+    def save_arrays(self, dir_name: str):
+        """
+        Same as save, but with a .npy file per column so that the table can be memory-mapped by load_arrays.
+        """
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        for name, arr in [("clusters", self.clusters), ("relations", self.relations), ("programs", self.programs),
+                          ("values", self.values), ("relation_names", np.array(self.relation_names, dtype=str))]:
+            np.save(os.path.join(dir_name, name + ".npy"), arr, allow_pickle=False)
+
+    @classmethod
+    def load_arrays(cls, dir_name: str, mmap_mode: Optional[str] = None) -> "ScoreTable":
+        arrays = {name: np.load(os.path.join(dir_name, name + ".npy"), mmap_mode=mmap_mode, allow_pickle=False)
+                  for name in ["clusters", "relations", "programs", "values", "relation_names"]}
+        return cls(arrays["clusters"], arrays["relations"], arrays["programs"], arrays["values"],
+                   arrays["relation_names"].tolist())
+
+    def split_by_relation(self) -> Dict[str, "ScoreTable"]:
+        """
+        :return: relation -> table with only the rows of that relation
+        """
+        tables = {}
+        relations = np.asarray(self.relations)
+        for r_id, r in enumerate(self.relation_names):
+            rows = np.nonzero(relations == r_id)[0]
+            if rows.shape[0] > 0:
+                tables[r] = ScoreTable(np.asarray(self.clusters)[rows], np.zeros(rows.shape[0], dtype=np.int32),
+                                       np.asarray(self.programs)[rows], np.asarray(self.values)[rows], [r])
+        return tables
+
+    def save_partitioned(self, dir_name: str, as_arrays: bool = False, vocab_fingerprint: Optional[Dict] = None):
+        save_partitioned(self.split_by_relation(), dir_name, as_arrays,
+                         self.vocab_fingerprint if vocab_fingerprint is None else vocab_fingerprint)
+
+    def matches(self, program_vocab: ProgramVocab) -> bool:
+        """
+        :return: False if the table was written for another program vocab, or without a fingerprint
+        """
+        return self.vocab_fingerprint is not None and program_vocab.matches(self.vocab_fingerprint)
+
+    def has(self, c: int, r: str) -> bool:
+        return (int(c), self.rel_vocab.get(r, -1)) in self.segments
+
+    def get_segment(self, c: int, r: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: sorted program ids of (c, r) and their values
+        """
+        st, en = self.segments.get((int(c), self.rel_vocab.get(r, -1)), (0, 0))
+        return self.programs[st:en], self.values[st:en]
+
+    def lookup(self, c: int, r: str, programs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Batched lookup of programs for (c, r).
+        :return: values (0 if missing) and a mask of the programs which were found
+        """
+        programs = np.asarray(programs, dtype=np.int64)
+        values = np.zeros(programs.shape[0], dtype=np.float64)
+        found = np.zeros(programs.shape[0], dtype=bool)
+        seg_programs, seg_values = self.get_segment(c, r)
+        if seg_programs.shape[0] == 0 or programs.shape[0] == 0:
+            return values, found
+        idx = np.minimum(np.searchsorted(seg_programs, programs), seg_programs.shape[0] - 1)
+        found = seg_programs[idx] == programs
+        values[found] = seg_values[idx[found]]
+        return values, found
+
+    def get(self, c: int, r: str, p: int, default: Optional[float] = None) -> Optional[float]:
+        values, found = self.lookup(c, r, np.array([p]))
+        return float(values[0]) if found[0] else default
+
+
+def save_partitioned(tables: Dict[str, Any], dir_name: str, as_arrays: bool = False,
+                     vocab_fingerprint: Optional[Dict] = None):
+    """
+    Writes a table per relation into dir_name (relation_<i>.npz, or relation_<i>/ with a .npy per column if
+    as_arrays), and an index of the relations, to be read by a PartitionedTable.
+    :param vocab_fingerprint: fingerprint of the ProgramVocab the program ids of the tables refer to
+    """
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    relation_names = sorted(tables.keys())
+    file_names = []
+    for r_ctr, r in enumerate(relation_names):
+        if as_arrays:
+            file_names.append("relation_{}".format(r_ctr))
+            tables[r].save_arrays(os.path.join(dir_name, file_names[-1]))
+        else:
+            file_names.append("relation_{}.npz".format(r_ctr))
+            tables[r].save(os.path.join(dir_name, file_names[-1]))
+    with open(os.path.join(dir_name, PartitionedTable.INDEX_FILE_NAME), "w") as fout:
+        json.dump({"relation_names": relation_names, "file_names": file_names}, fout)
+    write_vocab_fingerprint(dir_name, vocab_fingerprint)
+
+
+class PartitionedTable(object):
+    """
+    A table stored as one table of table_cls per relation (see save_partitioned). The table of a relation is only
+    read when that relation is first looked up, and is kept afterwards, so memory and load time depend on the
+    relations which are queried.
+    """
+    INDEX_FILE_NAME = "relations.json"
+    table_cls = None
+
+    def __init__(self, dir_name: str, mmap_mode: Optional[str] = None):
+        """
+        :param mmap_mode: used for the tables written with as_arrays
+        """
+        self.dir_name = dir_name
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(dir_name, self.INDEX_FILE_NAME)) as fin:
+            index = json.load(fin)
+        self.relation_names = index["relation_names"]
+        self.file_names = dict(zip(index["relation_names"], index["file_names"]))
+        self._tables = {}  # relation -> table, the relations loaded so far
+        self.lock = threading.Lock()
+        self.vocab_fingerprint = read_vocab_fingerprint(dir_name)
+
+    @staticmethod
+    def exists(dir_name: str) -> bool:
+        return os.path.exists(os.path.join(dir_name, PartitionedTable.INDEX_FILE_NAME))
+
+    def get_table(self, r: str):
+        """
+        :return: the table of relation r, None if r has no rows
+        """
+        if r in self._tables:
+            return self._tables[r]
+        if r not in self.file_names:
+            return None
+        with self.lock:
+            if r not in self._tables:
+                file_name = os.path.join(self.dir_name, self.file_names[r])
+                self._tables[r] = self.table_cls.load(file_name) if file_name.endswith(".npz") else \
+                    self.table_cls.load_arrays(file_name, mmap_mode=self.mmap_mode)
+        return self._tables[r]
+
+    def split_by_relation(self) -> Dict[str, Any]:
+        return {r: self.get_table(r) for r in self.relation_names}
+
+    def save_partitioned(self, dir_name: str, as_arrays: bool = False, vocab_fingerprint: Optional[Dict] = None):
+        save_partitioned(self.split_by_relation(), dir_name, as_arrays,
+                         self.vocab_fingerprint if vocab_fingerprint is None else vocab_fingerprint)
+
+    def matches(self, program_vocab: ProgramVocab) -> bool:
+        """
+        :return: False if the table was written for another program vocab, or without a fingerprint
+        """
+        return self.vocab_fingerprint is not None and program_vocab.matches(self.vocab_fingerprint)
+
+
+class PartitionedScoreTable(PartitionedTable):
+    """
+    ScoreTable partitioned per relation, with the same lookups.
+    """
+    table_cls = ScoreTable
+
+    def has(self, c: int, r: str) -> bool:
+        table = self.get_table(r)
+        return table is not None and table.has(c, r)
+
+    def get_segment(self, c: int, r: str) -> Tuple[np.ndarray, np.ndarray]:
+        table = self.get_table(r)
+        if table is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        return table.get_segment(c, r)
+
+    def lookup(self, c: int, r: str, programs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        table = self.get_table(r)
+        if table is None:
+            programs = np.asarray(programs)
+            return np.zeros(programs.shape[0], dtype=np.float64), np.zeros(programs.shape[0], dtype=bool)
+        return table.lookup(c, r, programs)
+
+    def get(self, c: int, r: str, p: int, default: Optional[float] = None) -> Optional[float]:
+        table = self.get_table(r)
+        return default if table is None else table.get(c, r, p, default)
+
+
+def check_vocab_fingerprint(table: Union[ScoreTable, PartitionedTable], name: str,
+                            program_vocab: Optional[ProgramVocab]):
+    """
+    Raises a ValueError if the program ids of table do not refer to program_vocab. Without a program_vocab, only
+    checks that the table has a fingerprint.
+    """
+    if table.vocab_fingerprint is None:
+        raise ValueError("{} was written without a program vocab fingerprint, so its program ids can not be checked, "
+                         "please run the preprocessing script again".format(name))
+    if program_vocab is not None and not table.matches(program_vocab):
+        raise ValueError("{} was written for another program vocab (the paths were sampled again?), please "
+                         "run the preprocessing script again".format(name))
+
+
+def load_score_table(dir_name: str, map_name: str, program_vocab: Optional[ProgramVocab] = None,
+                     legacy_file_name: Optional[str] = None) -> Union[ScoreTable, PartitionedScoreTable, None]:
+    """
+    Load a prior/precision map written by the preprocessing script (<map_name>/, partitioned per relation). The
+    table of a relation is only read when it is first queried. Single tables (<map_name>.npz) and maps pickled as
+    nested dicts by older versions (<map_name>.pkl, or legacy_file_name) are read as a whole.
+    :param program_vocab: needed to convert the pickled maps, which are keyed by relation tuples. A table keyed by
+    program ids which was written for another program vocab, or without a fingerprint of it, raises a ValueError.
+    :return: the table, None if the map is not found
+    """
+    if PartitionedTable.exists(os.path.join(dir_name, map_name)):
+        table = PartitionedScoreTable(os.path.join(dir_name, map_name))
+        check_vocab_fingerprint(table, table.dir_name, program_vocab)
+        return table
+    file_name = os.path.join(dir_name, map_name + ".npz")
+    if os.path.exists(file_name):
+        table = ScoreTable.load(file_name)
+        check_vocab_fingerprint(table, file_name, program_vocab)
+        return table
+    pkl_file_name = os.path.join(dir_name, legacy_file_name if legacy_file_name is not None else map_name + ".pkl")
+    if os.path.exists(pkl_file_name) and program_vocab is not None:
+        with open(pkl_file_name, "rb") as fin:
+            return ScoreTable.from_nested_map(to_program_ids(pickle.load(fin), program_vocab))
+    logger.info("{} not found at {}. Please run the preprocessing script".format(map_name, file_name))
+    return None
+
+
+def _lookup_product(c: int, r: str, programs: np.ndarray, precision_map: Optional[ScoreTable],
+                    prior_map: Optional[ScoreTable], use_prior: bool) -> Tuple[np.ndarray, np.ndarray]:
+    if precision_map is None or (use_prior and prior_map is None):
+        return np.zeros(programs.shape[0], dtype=np.float64), np.zeros(programs.shape[0], dtype=bool)
+    scores, found = precision_map.lookup(c, r, programs)
+    if use_prior:
+        prior_scores, prior_found = prior_map.lookup(c, r, programs)
+        scores, found = scores * prior_scores, found & prior_found
+    return scores, found
+
+
+def score_programs(c: int, r: str, programs: np.ndarray, precision_map: ScoreTable,
+                   precision_map_fallback: Optional[ScoreTable] = None, prior_map: Optional[ScoreTable] = None,
+                   prior_map_fallback: Optional[ScoreTable] = None, use_prior: bool = True,
+                   fallback_c: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Score programs for query relation r in cluster c with prior * precision (only precision if not use_prior).
+    Programs which are missing from the cluster maps are scored with the fallback maps (cluster fallback_c), and get
+    a score of 0 if they are missing from them as well. The maps can also be PartitionedScoreTables.
+    :return: scores and a mask of the programs which were found in cluster c
+    """
+    programs = np.asarray(programs, dtype=np.int64)
+    scores, in_cluster = _lookup_product(c, r, programs, precision_map, prior_map, use_prior)
+    missing = ~in_cluster
+    if np.any(missing):
+        fallback_scores, fallback_found = _lookup_product(fallback_c, r, programs[missing], precision_map_fallback,
+                                                          prior_map_fallback, use_prior)
+        scores[missing] = np.where(fallback_found, fallback_scores, 0.0)
+    return scores, in_cluster
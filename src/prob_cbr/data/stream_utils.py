@@ -3,7 +3,7 @@ import logging
 import numpy as np
 import os
 
-from prob_cbr.data.data_utils import get_inv_relation, is_inv_relation
+from src.prob_cbr.data.data_utils import get_inv_relation, is_inv_relation
 logger = logging.getLogger('stream_utils')
 logger.setLevel(logging.INFO)
 ch = logging.StreamHandler()
@@ -0,0 +1,59 @@
+import numpy as np
+from typing import *
+
+HITS_AT = [1, 3, 5, 10]
+
+
+def get_known_answer_ids(all_kg_map: Dict[Tuple[str, str], List[str]], e1: str, r: str,
+                         entity_vocab: Dict[str, int]) -> np.ndarray:
+    """
+    :return: sorted ids of the answers of (e1, r) in train/dev/test, which are filtered out when ranking a gold answer
+    """
+    return np.unique(np.array([entity_vocab[e2] for e2 in all_kg_map.get((e1, r), []) if e2 in entity_vocab],
+                              dtype=np.int64))
+
+
+def get_filtered_ranks(ent_ids: np.ndarray, scores: np.ndarray, gold_ids: np.ndarray, known_ids: np.ndarray,
+                       second_scores: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Filtered rank of each gold answer among the predicted entities: the other known answers are removed before
+    ranking. Entities are ranked as in aggregation.get_top_k (decreasing score, then decreasing second score, then
+    position), without sorting them by score.
+    :param ent_ids: predicted entity ids
+    :param scores: their scores, ties are ranked in this order
+    :param gold_ids: ids of the gold answers, negative for the ones which are not entities
+    :param known_ids: sorted ids of all the known answers of the query (see get_known_answer_ids)
+    :return: rank (starting at 1) of every gold answer, -1 if it was not predicted
+    """
+    gold_ids = np.asarray(gold_ids, dtype=np.int64)
+    ranks = np.full(gold_ids.shape[0], -1, dtype=np.int64)
+    if ent_ids.shape[0] == 0 or gold_ids.shape[0] == 0:
+        return ranks
+    order = np.argsort(ent_ids, kind="stable")
+    pos = np.minimum(np.searchsorted(ent_ids[order], gold_ids), ent_ids.shape[0] - 1)
+    found = (ent_ids[order][pos] == gold_ids) & (gold_ids >= 0)
+    gold_pos = order[pos[found]]
+    # entities which compete with the gold answers
+    candidates = np.nonzero(~np.isin(ent_ids, known_ids, assume_unique=False))[0]
+    c_scores, g_scores = scores[candidates][None, :], scores[gold_pos][:, None]
+    ahead = c_scores > g_scores
+    tied = c_scores == g_scores
+    if second_scores is not None:
+        c_second, g_second = second_scores[candidates][None, :], second_scores[gold_pos][:, None]
+        ahead |= tied & (c_second > g_second)
+        tied &= c_second == g_second
+    ahead |= tied & (candidates[None, :] < gold_pos[:, None])
+    ranks[found] = ahead.sum(axis=1) + 1
+    return ranks
+
+
+def get_ranking_metrics(ranks: np.ndarray, hits_at: Sequence[int] = HITS_AT) -> Dict[str, float]:
+    """
+    :param ranks: filtered ranks of gold answers, -1 if an answer was not predicted
+    :return: hits_<k> for every k in hits_at and mrr, summed over the ranks (divide by the number of answers)
+    """
+    ranks = np.asarray(ranks)
+    predicted = ranks > 0
+    metrics = {"hits_{}".format(k): float(np.sum(predicted & (ranks <= k))) for k in hits_at}
+    metrics["mrr"] = float(np.sum(1.0 / ranks[predicted]))
+    return metrics
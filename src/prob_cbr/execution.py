@@ -0,0 +1,122 @@
+import scipy.sparse
+import numpy as np
+from typing import *
+
+
+def build_out_adj_mats(sparse_adj_mats: Dict[str, scipy.sparse.csr_matrix]) -> Dict[str, scipy.sparse.csr_matrix]:
+    """
+    sparse_adj_mats[r] has a row per tail entity. Transpose them so that the row of an entity lists its outgoing edges,
+    i.e. indices[indptr[e1]:indptr[e1 + 1]] are the e2 of (e1, r, e2) and data the number of such edges.
+    """
+    out_adj_mats = {}
+    for r, adj_mat in sparse_adj_mats.items():
+        out_adj_mat = adj_mat.transpose().tocsr()
+        out_adj_mat.sum_duplicates()
+        out_adj_mats[r] = out_adj_mat
+    return out_adj_mats
+
+
+def expand_frontier(out_adj_mat: scipy.sparse.csr_matrix, ent_ids: np.ndarray, counts: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Follows one relation from a sparse frontier by slicing the outgoing edges of the frontier entities.
+    :param out_adj_mat: out-edges of the relation (see build_out_adj_mats)
+    :param ent_ids: sorted entity ids of the frontier
+    :param counts: number of paths reaching each of them
+    :return: the next frontier (sorted entity ids, number of paths)
+    """
+    st = out_adj_mat.indptr[ent_ids]
+    deg = out_adj_mat.indptr[ent_ids + 1] - st
+    num_edges = int(deg.sum())
+    if num_edges == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    first_edge = np.cumsum(deg) - deg
+    edge_idx = np.repeat(st - first_edge, deg) + np.arange(num_edges)
+    targets = out_adj_mat.indices[edge_idx]
+    weights = np.repeat(counts, deg) * out_adj_mat.data[edge_idx].astype(np.int64)
+    order = np.argsort(targets, kind="stable")
+    targets, weights = targets[order], weights[order]
+    seg_st = np.concatenate([[0], np.nonzero(targets[1:] != targets[:-1])[0] + 1])
+    return targets[seg_st].astype(np.int64), np.add.reduceat(weights, seg_st)
+
+
+def execute_one_program_sparse(out_adj_mats: Dict[str, scipy.sparse.csr_matrix], entity_vocab: Dict[str, int],
+                               e: str, path: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Same as utils.execute_one_program, but the frontier is kept as sparse (entity ids, counts) arrays.
+    :return: entity ids reached by the program and the number of paths reaching each (the non-zeros of the vector
+    returned by utils.execute_one_program)
+    """
+    ent_ids, counts = np.array([entity_vocab[e]], dtype=np.int64), np.ones(1, dtype=np.int64)
+    for r in path:
+        ent_ids, counts = expand_frontier(out_adj_mats[r], ent_ids, counts)
+    return ent_ids, counts
+
+
+class _TrieNode(object):
+    __slots__ = ["children", "num_programs", "frontier"]
+
+    def __init__(self):
+        self.children = {}
+        self.num_programs = 0  # number of programs not executed yet which go through this node
+        self.frontier = None  # frontier after the relations on the way to this node, kept while num_programs > 1
+
+
+class ProgramTrieExecutor(object):
+    """
+    Executes a ranked list of programs from one entity, sharing the work of common prefixes.
+    The programs are arranged into a trie of relations. The frontier (sparse entity ids reached with the number of
+    paths to each) at a node is computed once and kept until the last program through that node has been
+    executed, so that every program only expands from its longest already executed prefix.
+    The answers are the non-zeros of utils.execute_one_program for every program.
+    """
+
+    def __init__(self, sparse_adj_mats: Dict[str, scipy.sparse.csr_matrix], entity_vocab: Dict[str, int],
+                 out_adj_mats: Optional[Dict[str, scipy.sparse.csr_matrix]] = None):
+        """
+        :param out_adj_mats: build_out_adj_mats(sparse_adj_mats), if it was already computed (e.g. in a snapshot)
+        """
+        self.out_adj_mats = out_adj_mats if out_adj_mats is not None else build_out_adj_mats(sparse_adj_mats)
+        self.entity_vocab = entity_vocab
+
+    @staticmethod
+    def build_trie(programs: List[Sequence[str]]) -> _TrieNode:
+        root = _TrieNode()
+        for path in programs:
+            node = root
+            node.num_programs += 1
+            for r in path:
+                if r not in node.children:
+                    node.children[r] = _TrieNode()
+                node = node.children[r]
+                node.num_programs += 1
+        return root
+
+    def iter_execute(self, e: str, programs: List[Sequence[str]]) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Lazily executes the programs in order, so that the caller can stop early (e.g. after max_num_programs).
+        :return: iterator over the answers (entity ids, counts) of the programs
+        """
+        root = self.build_trie(programs)
+        root.frontier = np.array([self.entity_vocab[e]], dtype=np.int64), np.ones(1, dtype=np.int64)
+        for path in programs:
+            node, frontier = root, root.frontier
+            for r in path:
+                parent, node = node, node.children[r]
+                if node.frontier is not None:
+                    frontier = node.frontier
+                else:
+                    frontier = expand_frontier(self.out_adj_mats[r], *frontier)
+                    if node.num_programs > 1:
+                        node.frontier = frontier
+                # this program is done with the parent. Free its frontier if no later program needs it.
+                parent.num_programs -= 1
+                if parent.num_programs == 0:
+                    parent.frontier = None
+            node.num_programs -= 1
+            if node.num_programs == 0:
+                node.frontier = None
+            yield frontier
+
+    def execute(self, e: str, programs: List[Sequence[str]]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return list(self.iter_execute(e, programs))
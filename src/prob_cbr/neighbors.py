@@ -0,0 +1,396 @@
+import os
+import time
+import logging
+import numpy as np
+import scipy.sparse
+from typing import *
+
+logger = logging.getLogger()
+
+
+def _top_k(sims: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: the k highest similarities and their ids, by decreasing similarity and then increasing id
+    """
+    if sims.shape[0] > k:
+        kth_sim = np.partition(sims, sims.shape[0] - k)[sims.shape[0] - k]
+        keep = np.nonzero(sims >= kth_sim)[0]
+        sims, ids = sims[keep], ids[keep]
+    order = np.lexsort((ids, -sims))[:k]
+    return sims[order], ids[order]
+
+
+def _isin_sorted(ids: np.ndarray, sorted_ids: np.ndarray) -> np.ndarray:
+    """
+    :return: mask of the ids which are in sorted_ids
+    """
+    if sorted_ids.shape[0] == 0:
+        return np.zeros(ids.shape[0], dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), sorted_ids.shape[0] - 1)
+    return sorted_ids[pos] == ids
+
+
+def _pad(num_queries: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    return np.full((num_queries, k), -np.inf), np.full((num_queries, k), -1, dtype=np.int64)
+
+
+def exact_top_k(vectors: scipy.sparse.csr_matrix, query_ids: np.ndarray, k: int, batch_size: int = 1024) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top k inner products of the query entities against all the entities, batch_size queries at a time.
+    :return: similarities and entity ids (n X k, by decreasing similarity, -inf / -1 if there are less than k entities)
+    """
+    query_ids = np.asarray(query_ids, dtype=np.int64)
+    all_ids = np.arange(vectors.shape[0])
+    sims, ids = _pad(query_ids.shape[0], k)
+    for st in range(0, query_ids.shape[0], batch_size):
+        batch_sim = (vectors[query_ids[st:st + batch_size]] @ vectors.T).toarray()
+        for i, row in enumerate(batch_sim):
+            row_sims, row_ids = _top_k(row, all_ids, k)
+            sims[st + i, :row_sims.shape[0]], ids[st + i, :row_ids.shape[0]] = row_sims, row_ids
+    return sims, ids
+
+
+def top_k_among(vectors: scipy.sparse.csr_matrix, query_vectors: scipy.sparse.csr_matrix, candidate_ids: np.ndarray,
+                k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact top k inner products of the queries against the candidate entities only.
+    :return: similarities and entity ids (n X k, by decreasing similarity, -inf / -1 if there are less than k
+    candidates)
+    """
+    candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+    sims, ids = _pad(query_vectors.shape[0], k)
+    if candidate_ids.shape[0] == 0:
+        return sims, ids
+    candidate_sims = (vectors[candidate_ids] @ query_vectors.T).toarray()
+    for q in range(query_vectors.shape[0]):
+        row_sims, row_ids = _top_k(candidate_sims[:, q], candidate_ids, k)
+        sims[q, :row_sims.shape[0]], ids[q, :row_ids.shape[0]] = row_sims, row_ids
+    return sims, ids
+
+
+def _assign(vectors: scipy.sparse.csr_matrix, centroids: np.ndarray, batch_size: int = 4096) -> np.ndarray:
+    """
+    :return: most similar centroid of every vector
+    """
+    assignments = np.zeros(vectors.shape[0], dtype=np.int64)
+    for st in range(0, vectors.shape[0], batch_size):
+        assignments[st:st + batch_size] = np.argmax(vectors[st:st + batch_size] @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex(object):
+    """
+    Approximate inner product search over the L2 normalized sparse entity vectors. The entities are partitioned into
+    lists with spherical k-means, and a query only scores the entities of the nprobe lists whose centroids are the
+    most similar to it. Entities added after the index was built are put in the list of their closest centroid, the
+    centroids are not trained again.
+        centroids: L X R dense centroids of unit norm
+        assignments: list of every entity, -1 for the ids which were never added
+        vectors: N X R sparse entity vectors
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, vectors: scipy.sparse.csr_matrix,
+                 nprobe: int = 1):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.vectors = vectors
+        self.nprobe = nprobe
+        self._lists = None
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def num_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, vectors: scipy.sparse.csr_matrix, num_lists: int, nprobe: int = 1, num_iters: int = 10,
+              seed: int = 0) -> "IVFIndex":
+        """
+        :param vectors: N X R L2 normalized entity vectors
+        :param num_lists: number of k-means clusters (at most the number of entities with an edge)
+        """
+        vectors = scipy.sparse.csr_matrix(vectors, dtype=np.float64)
+        rng = np.random.default_rng(seed)
+        non_empty = np.nonzero(np.diff(vectors.indptr) > 0)[0]
+        num_lists = max(1, min(num_lists, non_empty.shape[0]))
+        if non_empty.shape[0] == 0:
+            centroids = np.zeros((1, vectors.shape[1]))
+        else:
+            centroids = vectors[np.sort(rng.choice(non_empty, num_lists, replace=False))].toarray()
+        for _ in range(num_iters):
+            assignments = _assign(vectors, centroids)
+            members = scipy.sparse.csr_matrix((np.ones(vectors.shape[0]), (assignments, np.arange(vectors.shape[0]))),
+                                              shape=(num_lists, vectors.shape[0]))
+            sums = (members @ vectors).toarray()
+            norms = np.linalg.norm(sums, axis=-1)
+            # lists which lost all their entities keep their centroid
+            updated = norms > 0
+            centroids[updated] = sums[updated] / norms[updated].reshape(-1, 1)
+        assignments = _assign(vectors, centroids)
+        logger.info("Built IVF index of {} entities in {} lists (largest list: {})".format(
+            vectors.shape[0], num_lists, np.bincount(assignments, minlength=num_lists).max()))
+        return cls(centroids, assignments, vectors, nprobe)
+
+    def add(self, vectors: scipy.sparse.csr_matrix, ids: Optional[np.ndarray] = None):
+        """
+        Adds entities to the index, or replaces the vectors of entities already in it.
+        :param ids: entity ids of the rows of vectors, by default the ones after the last entity of the index
+        """
+        vectors = scipy.sparse.csr_matrix(vectors, dtype=np.float64)
+        ids = np.arange(len(self), len(self) + vectors.shape[0]) if ids is None else np.asarray(ids, dtype=np.int64)
+        if ids.shape[0] == 0:
+            return
+        num_entities = max(len(self), int(ids.max()) + 1)
+        old_vectors = scipy.sparse.csr_matrix(self.vectors, copy=True)
+        old_vectors.resize((num_entities, max(self.vectors.shape[1], vectors.shape[1])))
+        vectors.resize((vectors.shape[0], old_vectors.shape[1]))
+        keep = np.ones(num_entities)
+        keep[ids] = 0
+        select = scipy.sparse.csr_matrix((np.ones(ids.shape[0]), (ids, np.arange(ids.shape[0]))),
+                                         shape=(num_entities, ids.shape[0]))
+        self.vectors = (scipy.sparse.diags(keep) @ old_vectors + select @ vectors).tocsr()
+        if self.centroids.shape[1] < self.vectors.shape[1]:
+            # new relations: the centroids have no weight on them
+            self.centroids = np.pad(self.centroids, ((0, 0), (0, self.vectors.shape[1] - self.centroids.shape[1])))
+        assignments = np.full(num_entities, -1, dtype=np.int64)
+        assignments[:self.assignments.shape[0]] = self.assignments
+        assignments[ids] = _assign(vectors, self.centroids)
+        self.assignments = assignments
+        self._lists = None
+
+    def get_lists(self) -> Tuple[np.ndarray, np.ndarray, scipy.sparse.csr_matrix]:
+        """
+        :return: entity ids sorted by list, the offset of every list in them and their vectors in that order
+        """
+        if self._lists is None:
+            added = np.nonzero(self.assignments >= 0)[0]
+            order = added[np.argsort(self.assignments[added], kind="stable")]
+            counts = np.bincount(self.assignments[added], minlength=self.num_lists)
+            self._lists = order, np.concatenate([[0], np.cumsum(counts)]), self.vectors[order]
+        return self._lists
+
+    def search(self, query_vectors: scipy.sparse.csr_matrix, k: int, nprobe: Optional[int] = None,
+               allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param query_vectors: n X R L2 normalized vectors
+        :param allowed: sorted ids of the only entities which can be returned (e.g. the entities with the query
+        relation). If there are fewer of them than entities in the probed lists, they are all scored exactly.
+        :return: similarities and entity ids of the approximate top k of every query (n X k, by decreasing
+        similarity, -inf / -1 if the probed lists have less than k entities)
+        """
+        query_vectors = scipy.sparse.csr_matrix(query_vectors, dtype=np.float64)
+        if query_vectors.shape[1] < self.vectors.shape[1]:
+            query_vectors.resize((query_vectors.shape[0], self.vectors.shape[1]))
+        num_queries = query_vectors.shape[0]
+        nprobe = min(nprobe if nprobe is not None else self.nprobe, self.num_lists)
+        order, offsets, list_vectors = self.get_lists()
+        if allowed is not None:
+            allowed = np.asarray(allowed, dtype=np.int64)
+            if allowed.shape[0] <= nprobe * order.shape[0] / self.num_lists:
+                allowed = allowed[allowed < len(self)]
+                return top_k_among(self.vectors, query_vectors, allowed[self.assignments[allowed] >= 0], k)
+        centroid_sims = np.asarray(query_vectors @ self.centroids.T)
+        probes = np.argsort(-centroid_sims, axis=1, kind="stable")[:, :nprobe]
+        # one sparse product per probed list, with all the queries which probe it
+        candidate_sims, candidate_ids = [[] for _ in range(num_queries)], [[] for _ in range(num_queries)]
+        for l in np.unique(probes):
+            st, en = offsets[l], offsets[l + 1]
+            if st == en:
+                continue
+            list_queries = np.nonzero(np.any(probes == l, axis=1))[0]
+            list_sims = (list_vectors[st:en] @ query_vectors[list_queries].T).toarray()
+            for j, q in enumerate(list_queries):
+                candidate_sims[q].append(list_sims[:, j])
+                candidate_ids[q].append(order[st:en])
+        sims, ids = _pad(num_queries, k)
+        for q in range(num_queries):
+            if len(candidate_ids[q]) == 0:
+                continue
+            row_sims, row_ids = np.concatenate(candidate_sims[q]), np.concatenate(candidate_ids[q])
+            if allowed is not None:
+                keep = _isin_sorted(row_ids, allowed)
+                row_sims, row_ids = row_sims[keep], row_ids[keep]
+            row_sims, row_ids = _top_k(row_sims, row_ids, k)
+            sims[q, :row_sims.shape[0]], ids[q, :row_ids.shape[0]] = row_sims, row_ids
+        return sims, ids
+
+    def search_ids(self, query_ids: np.ndarray, k: int, nprobe: Optional[int] = None,
+                   allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as search, for entities of the index.
+        """
+        return self.search(self.vectors[np.asarray(query_ids, dtype=np.int64)], k, nprobe, allowed)
+
+    def save(self, dir_name: str):
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        np.save(os.path.join(dir_name, "centroids.npy"), self.centroids, allow_pickle=False)
+        np.save(os.path.join(dir_name, "assignments.npy"), self.assignments, allow_pickle=False)
+        np.save(os.path.join(dir_name, "nprobe.npy"), np.array(self.nprobe), allow_pickle=False)
+        scipy.sparse.save_npz(os.path.join(dir_name, "vectors.npz"), self.vectors)
+
+    @classmethod
+    def load(cls, dir_name: str) -> "IVFIndex":
+        return cls(np.load(os.path.join(dir_name, "centroids.npy"), allow_pickle=False),
+                   np.load(os.path.join(dir_name, "assignments.npy"), allow_pickle=False),
+                   scipy.sparse.load_npz(os.path.join(dir_name, "vectors.npz")).tocsr(),
+                   int(np.load(os.path.join(dir_name, "nprobe.npy"), allow_pickle=False)))
+
+    @staticmethod
+    def exists(dir_name: str) -> bool:
+        return os.path.exists(os.path.join(dir_name, "centroids.npy"))
+
+
+class RelationEntityIndex(object):
+    """
+    For every relation r, the sorted ids of the entities e which have it (train_map[e, r] is not empty), so that the
+    neighbors of a query are restricted to the entities with the query relation without looking them up one by one.
+    The entities of a relation are read from the columns of its sparse adjacency matrix the first time it is used.
+    """
+
+    def __init__(self, rel_entities: Optional[Dict[str, np.ndarray]] = None,
+                 sparse_adj_mats: Optional[Dict[str, scipy.sparse.csr_matrix]] = None):
+        self.rel_entities = rel_entities if rel_entities is not None else {}
+        self.sparse_adj_mats = sparse_adj_mats
+
+    @classmethod
+    def from_train_map(cls, train_map: Dict[Tuple[str, str], List[str]], entity_vocab: Dict[str, int]) \
+            -> "RelationEntityIndex":
+        rel_entities = {}
+        for (e1, r), e2_list in train_map.items():
+            if len(e2_list) > 0:
+                rel_entities.setdefault(r, []).append(entity_vocab[e1])
+        return cls({r: np.unique(np.array(ent_ids, dtype=np.int64)) for r, ent_ids in rel_entities.items()})
+
+    def get_entities(self, r: str) -> np.ndarray:
+        """
+        :return: sorted ids of the entities which have relation r
+        """
+        if r not in self.rel_entities:
+            if self.sparse_adj_mats is None or r not in self.sparse_adj_mats:
+                return np.zeros(0, dtype=np.int64)
+            # column e1 of the adjacency matrix of r holds the answers of (e1, r)
+            self.rel_entities[r] = np.unique(self.sparse_adj_mats[r].indices).astype(np.int64)
+        return self.rel_entities[r]
+
+    def filter(self, neighbor_ids: np.ndarray, r: str, k: int, exclude: int = -1) -> np.ndarray:
+        """
+        :param neighbor_ids: entity ids sorted by decreasing similarity, -1 for padding
+        :return: the first k neighbors which have relation r, except exclude (the query entity)
+        """
+        neighbor_ids = np.asarray(neighbor_ids, dtype=np.int64)
+        neighbor_ids = neighbor_ids[(neighbor_ids >= 0) & (neighbor_ids != exclude)]
+        return neighbor_ids[_isin_sorted(neighbor_ids, self.get_entities(r))][:k]
+
+    def top_k(self, vectors: scipy.sparse.csr_matrix, e1: int, r: str, k: int) -> np.ndarray:
+        """
+        :return: the k entities which have relation r with the highest inner product with entity e1 (itself
+        excluded), by decreasing similarity
+        """
+        _, ids = top_k_among(vectors, vectors[[e1]], self.get_entities(r), k + 1)
+        return self.filter(ids[0], r, k, exclude=e1)
+
+
+class NeighborCache(object):
+    """
+    The k nearest neighbors with the query relation of a set of (entity id, relation) queries, computed once, so that
+    the evaluations which share queries do not search their neighbors again. Only the k neighbors of a query are kept.
+        neighbor_ids: m X k entity ids by decreasing similarity, -1 for padding
+        rows: (entity id, relation) -> row of neighbor_ids
+    """
+
+    def __init__(self, neighbor_ids: np.ndarray, rows: Dict[Tuple[int, str], int]):
+        self.neighbor_ids = neighbor_ids
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def k(self) -> int:
+        return self.neighbor_ids.shape[1]
+
+    @classmethod
+    def build(cls, queries: Iterable[Tuple[int, str]], k: int, relation_entities: RelationEntityIndex,
+              entity_vectors: Optional[scipy.sparse.csr_matrix] = None, nn_index: Optional[IVFIndex] = None,
+              memory_mb: float = 1024) -> "NeighborCache":
+        """
+        Searches the neighbors of the queries of a relation together, in the approximate index if given, else
+        exactly among the entities with the relation.
+        :param memory_mb: bounds the similarities of a batch of queries (entities with the relation X batch)
+        """
+        queries = sorted(set(queries), key=lambda q: (q[1], q[0]))
+        rows = {q: row for row, q in enumerate(queries)}
+        neighbor_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        queries_by_relation = {}
+        for e1, r in queries:
+            queries_by_relation.setdefault(r, []).append(e1)
+        for r, query_ids in queries_by_relation.items():
+            allowed = relation_entities.get_entities(r)
+            query_ids = np.array(query_ids, dtype=np.int64)
+            batch_size = max(1, int(memory_mb * 1024 * 1024 // (8 * max(allowed.shape[0], 1))))
+            for st in range(0, query_ids.shape[0], batch_size):
+                batch_ids = query_ids[st:st + batch_size]
+                # one more, as the query entity is usually its own nearest neighbor
+                if nn_index is not None:
+                    _, batch_neighbors = nn_index.search_ids(batch_ids, k + 1, allowed=allowed)
+                else:
+                    _, batch_neighbors = top_k_among(entity_vectors, entity_vectors[batch_ids], allowed, k + 1)
+                for e1, neighbors in zip(batch_ids.tolist(), batch_neighbors):
+                    neighbors = relation_entities.filter(neighbors, r, k, exclude=e1)
+                    neighbor_ids[rows[(e1, r)], :neighbors.shape[0]] = neighbors
+        logger.info("Cached {} nearest neighbors of {} queries ({} relations)".format(
+            k, len(queries), len(queries_by_relation)))
+        return cls(neighbor_ids, rows)
+
+    def get(self, e1: int, r: str, k: int) -> Optional[np.ndarray]:
+        """
+        :return: the k nearest neighbors of e1 with relation r, None if they are not cached
+        """
+        row = self.rows.get((e1, r))
+        if row is None or k > self.k:
+            return None
+        neighbors = self.neighbor_ids[row, :k]
+        return neighbors[neighbors >= 0]
+
+
+def get_recall_at_k(approx_sims: np.ndarray, exact_sims: np.ndarray) -> float:
+    """
+    Average fraction of the exact top k found by the approximate search. An approximate neighbor counts if its
+    similarity is at least the k-th exact similarity, so that ties at the k-th similarity are not counted as misses.
+    :param approx_sims: n X k similarities returned by IVFIndex.search
+    :param exact_sims: n X k similarities returned by exact_top_k
+    """
+    if exact_sims.shape[0] == 0:
+        return 1.0
+    num_exact = np.isfinite(exact_sims).sum(axis=1)
+    found = np.isfinite(approx_sims) & (approx_sims >= exact_sims[:, -1:] - 1e-9)
+    return float(np.mean(np.minimum(found.sum(axis=1), num_exact) / np.maximum(num_exact, 1)))
+
+
+def report_recall(index: IVFIndex, query_ids: np.ndarray, k: int, nprobes: Optional[List[int]] = None) \
+        -> Dict[int, Tuple[float, float]]:
+    """
+    Logs recall@k and the search time of the index against the exact search, for every nprobe in nprobes (by
+    default index.nprobe and powers of 2 up to the number of lists), to pick the recall / latency trade-off.
+    :return: nprobe -> (recall@k, ms per query)
+    """
+    if nprobes is None:
+        # the configured nprobe and powers of 2 up to all the lists
+        nprobes = sorted({index.nprobe, index.num_lists} | {2 ** i for i in range(int(np.log2(index.num_lists)) + 1)})
+    query_ids = np.asarray(query_ids, dtype=np.int64)
+    num_queries = max(query_ids.shape[0], 1)
+    st = time.time()
+    exact_sims, _ = exact_top_k(index.vectors, query_ids, k)
+    exact_ms = 1000 * (time.time() - st) / num_queries
+    report = {}
+    for nprobe in nprobes:
+        st = time.time()
+        approx_sims, _ = index.search_ids(query_ids, k, nprobe)
+        report[nprobe] = get_recall_at_k(approx_sims, exact_sims), 1000 * (time.time() - st) / num_queries
+        logger.info("[IVF index] nprobe {}/{}: recall@{} {:.4f}, {:.3f} ms per query (exact: {:.3f} ms per query)"
+                    .format(nprobe, index.num_lists, k, report[nprobe][0], report[nprobe][1], exact_ms))
+    return report
@@ -1,6 +1,5 @@
 import argparse
 import numpy as np
-from scipy.special import logsumexp
 import os
 from tqdm import tqdm
 import scipy.sparse
@@ -13,9 +12,19 @@ import logging
 import json
 import pandas as pd
 import sys
+import time
 import wandb
-from src.prob_cbr.preprocessing.preprocessing import combine_path_splits
-from src.prob_cbr.utils import get_programs, create_sparse_adj_mats, execute_one_program
+from src.prob_cbr.preprocessing.preprocessing import load_path_store, get_path_store_dir
+from src.prob_cbr.utils import get_programs, create_sparse_adj_mats, execute_one_program, execute_program_batch, \
+    normalize_adj_mat
+from src.prob_cbr.data.score_table import score_programs, load_score_table
+from src.prob_cbr.data.ranked_programs import load_ranked_programs
+from src.prob_cbr.execution import ProgramTrieExecutor
+from src.prob_cbr.aggregation import aggregate_answers, get_top_k, AnytimeTopK
+from src.prob_cbr.evaluation import get_known_answer_ids, get_filtered_ranks, get_ranking_metrics, HITS_AT
+from src.prob_cbr.screen import run_screen
+from src.prob_cbr.neighbors import RelationEntityIndex, NeighborCache
+from src.prob_cbr.snapshot import export_snapshot, load_snapshot, SCORE_TABLES
 from src.prob_cbr.data.data_utils import create_vocab, load_vocab, load_data, get_unique_entities, \
     read_graph, get_entities_group_by_relation, get_inv_relation, load_data_all_triples, create_adj_list
 
@@ -26,10 +35,22 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-MRN_nodes = pd.read_csv('/home/msinha/CBR-AKBC/cbr-akbc-data/data/MRN/node_biolink.csv', dtype=str)
+NODE_NAMES_FILE = '/home/msinha/CBR-AKBC/cbr-akbc-data/data/MRN/node_biolink.csv'
+
+
+def load_node_names(file_name: str, id_column: str = "id", name_column: str = "name") -> Dict[str, str]:
+    """
+    :return: map from entity id to its name, read from the MRN node csv
+    """
+    mrn_nodes = pd.read_csv(file_name, dtype=str)
+    return dict(zip(mrn_nodes[id_column], mrn_nodes[name_column].fillna("")))
+
+
 class ProbCBR(object):
     def __init__(self, args, train_map, eval_map, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab, eval_vocab,
-                 eval_rev_vocab, all_paths, rel_ent_map, per_relation_config: Union[None, dict]):
+                 eval_rev_vocab, all_paths, rel_ent_map, per_relation_config: Union[None, dict],
+                 sparse_adj_mats: Optional[Dict[str, scipy.sparse.csr_matrix]] = None,
+                 out_adj_mats: Optional[Dict[str, scipy.sparse.csr_matrix]] = None):
         self.args = args
         self.eval_map = eval_map
         self.train_map = train_map
@@ -38,36 +59,60 @@ class ProbCBR(object):
         self.entity_vocab, self.rev_entity_vocab, self.rel_vocab, self.rev_rel_vocab = entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab
         self.eval_vocab, self.eval_rev_vocab = eval_vocab, eval_rev_vocab
         self.all_paths = all_paths
+        self.program_vocab = all_paths.program_vocab  # programs are referred to by their ids in this vocab
         self.rel_ent_map = rel_ent_map
         self.per_relation_config = per_relation_config
         self.num_non_executable_programs = []
+        self.num_skipped_programs = []  # programs not executed because a query stopped early
         self.nearest_neighbor_1_hop = None
+        self.neighbor_cache = None  # neighbors of the entities which are not in eval_vocab
         #logger.info("Building sparse adjacency matrices")
-        self.sparse_adj_mats = create_sparse_adj_mats(self.train_map, self.entity_vocab, self.rel_vocab)
+        # the adjacency matrices can be given when they were loaded from a snapshot
+        self.sparse_adj_mats = sparse_adj_mats if sparse_adj_mats is not None else \
+            create_sparse_adj_mats(self.train_map, self.entity_vocab, self.rel_vocab)
+        self.executor = ProgramTrieExecutor(self.sparse_adj_mats, self.entity_vocab, out_adj_mats)
+        # entities which have each relation, to filter the nearest neighbors
+        self.relation_entities = RelationEntityIndex(sparse_adj_mats=self.sparse_adj_mats)
         self.top_query_preds = {}
 
     def set_nearest_neighbor_1_hop(self, nearest_neighbor_1_hop):
         self.nearest_neighbor_1_hop = nearest_neighbor_1_hop
 
+    def get_entity_vectors(self) -> scipy.sparse.csr_matrix:
+        """
+        :return: N X R L2 normalized number of edges of every relation of every entity (the features of
+        utils.get_adj_mat), counted from the adjacency matrices
+        """
+        rows, cols, counts = [], [], []
+        for r, r_ctr in self.rel_vocab.items():
+            # column e1 of the adjacency matrix of r holds the answers of (e1, r)
+            r_counts = np.asarray(self.sparse_adj_mats[r].sum(axis=0)).reshape(-1)
+            ent_ids = np.nonzero(r_counts)[0]
+            rows.append(ent_ids)
+            cols.append(np.full(ent_ids.shape[0], r_ctr, dtype=np.int64))
+            counts.append(r_counts[ent_ids])
+        adj_mat = scipy.sparse.csr_matrix((np.concatenate(counts).astype(np.float64),
+                                           (np.concatenate(rows), np.concatenate(cols))),
+                                          shape=(len(self.entity_vocab), len(self.rel_vocab)))
+        return normalize_adj_mat(adj_mat)
+
+    def set_neighbor_cache(self, neighbor_cache: NeighborCache):
+        """
+        :param neighbor_cache: nearest neighbors (with the query relation) of entities which have no row in
+        nearest_neighbor_1_hop
+        """
+        self.neighbor_cache = neighbor_cache
+
     def get_nearest_neighbor_inner_product(self, e1: str, r: str, k: Optional[int] = 5) -> Union[List[str], None]:
-        try:
-            nearest_entities = [self.rev_entity_vocab[e] for e in
-                                self.nearest_neighbor_1_hop[self.eval_vocab[e1]].tolist()]
-            # remove e1 from the set of k-nearest neighbors if it is there.
-            nearest_entities = [nn for nn in nearest_entities if nn != e1]
-            # making sure, that the similar entities also have the query relation
-            ctr = 0
-            temp = []
-            for nn in nearest_entities:
-                if ctr == k:
-                    break
-                if len(self.train_map[nn, r]) > 0:
-                    temp.append(nn)
-                    ctr += 1
-            nearest_entities = temp
-        except KeyError:
-            return None
-        return nearest_entities
+        if e1 not in self.eval_vocab:
+            neighbor_ids = self.neighbor_cache.get(self.entity_vocab.get(e1, -1), r, k) \
+                if self.neighbor_cache is not None else None
+            return None if neighbor_ids is None else [self.rev_entity_vocab[e] for e in neighbor_ids.tolist()]
+        neighbor_ids = self.nearest_neighbor_1_hop[self.eval_vocab[e1]]
+        # remove e1 and keep the first k neighbors which have the query relation (ids are -1 past the neighbors found
+        # by an approximate search, see neighbors.IVFIndex)
+        neighbor_ids = self.relation_entities.filter(neighbor_ids, r, k, exclude=self.entity_vocab.get(e1, -1))
+        return [self.rev_entity_vocab[e] for e in neighbor_ids.tolist()]
 
     def get_programs_from_nearest_neighbors(self, e1: str, r: str, nn_func: Callable, num_nn: Optional[int] = 5):
         all_programs = []
@@ -89,284 +134,468 @@ class ProbCBR(object):
         zero_ctr = 0
         for e in nearest_entities:
             if len(self.train_map[(e, r)]) > 0:
-                paths_e = self.all_paths[e]  # get the collected 3 hop paths around e
                 nn_answers = self.train_map[(e, r)]
                 for nn_ans in nn_answers:
-                    all_programs += get_programs(e, nn_ans, paths_e)
+                    # get the programs in the collected paths around e
+                    all_programs += self.all_paths.get_program_ids(e, nn_ans).tolist()
             elif len(self.train_map[(e, r)]) == 0:
                 zero_ctr += 1
         self.all_zero_ctr.append(zero_ctr)
         return all_programs
 
-    def rank_programs(self, list_programs: List[List[str]], r: str) -> List[List[str]]:
+    def rank_programs(self, list_programs: List[int], r: str, c: int) -> List[int]:
         """
-        Rank programs.
+        Rank programs (program ids) for query relation r, using the statistics of cluster c.
         """
-        # sort it by the path score
-        unique_programs = set()
-        for p in list_programs:
-            unique_programs.add(tuple(p))
-        # now get the score of each path
-        path_and_scores = []
+        unique_programs = np.array(sorted(set(list_programs)), dtype=np.int64)
         use_only_precision_scores_for_r = self.args.use_only_precision_scores if self.per_relation_config is None \
             else self.per_relation_config[r]["use_only_precision_scores"]
-        for p in unique_programs:
-            try:
-                if use_only_precision_scores_for_r:
-                    path_and_scores.append((p, self.args.precision_map[self.c][r][p]))
-                else:
-                    path_and_scores.append((p, self.args.path_prior_map_per_relation[self.c][r][p] *
-                                            self.args.precision_map[self.c][r][p]))
-            except KeyError:
-                # TODO: Fix key error
-                if len(p) == 1 and p[0] == r:
-                    continue  # ignore query relation
-                else:
-                    # use the fall back score
-                    try:
-                        c = 0
-                        if use_only_precision_scores_for_r:
-                            score = self.args.precision_map_fallback[c][r][p]
-                        else:
-                            score = self.args.path_prior_map_per_relation_fallback[c][r][p] * \
-                                    self.args.precision_map_fallback[c][r][p]
-                        path_and_scores.append((p, score))
-                    except KeyError:
-                        # still a path or rel is missing.
-                        path_and_scores.append((p, 0))
-
+        ranked_programs = getattr(self.args, "ranked_programs", None)
+        if ranked_programs is not None and ranked_programs.uses_prior(r) == (not use_only_precision_scores_for_r):
+            # pre-sorted by the preprocessing script, only the intersection with the programs of the neighbors
+            ranked = ranked_programs.rank(c, r, unique_programs, query_program=self.program_vocab.get_id((r,)),
+                                          max_programs=self.args.max_ranked_programs or None)
+            if ranked is not None:
+                return ranked[0].tolist()
+        # programs missing from the cluster are scored with the fall back (single cluster) maps
+        scores, in_cluster = score_programs(c, r, unique_programs, self.args.precision_map,
+                                            self.args.precision_map_fallback, self.args.path_prior_map_per_relation,
+                                            self.args.path_prior_map_per_relation_fallback,
+                                            use_prior=not use_only_precision_scores_for_r)
+        # ignore query relation
+        keep = in_cluster | ~np.array([self.program_vocab.is_query_relation(p, r) for p in unique_programs.tolist()],
+                                      dtype=bool)
+        unique_programs, scores = unique_programs[keep], scores[keep]
         # sort wrt counts
-        sorted_programs = [k for k, v in sorted(path_and_scores, key=lambda item: -item[1])]
+        sorted_programs = unique_programs[np.argsort(-scores, kind="stable")].tolist()
+        if self.args.max_ranked_programs:
+            sorted_programs = sorted_programs[:self.args.max_ranked_programs]
 
         return sorted_programs
 
-    def execute_programs(self, e: str, r: str, path_list: List[List[str]], max_branch: Optional[int] = 1000) \
-            -> Tuple[List[Tuple[np.ndarray, float, List[str]]], List[List[str]]]:
-
-        def _fall_back(r, p):
-            """
-            When a cluster does not have a query relation (because it was not seen during counting)
-            or if a path is not found, then fall back to no cluster statistics
-            :param r:
-            :param p:
-            :return:
-            """
-            c = 0  # one cluster for all entity
-            try:
-                score = self.args.path_prior_map_per_relation_fallback[c][r][p] * \
-                        self.args.precision_map_fallback[c][r][p]
-            except KeyError:
-                # either the path or relation is missing from the fall back map as well
-                score = 0
-            return score
+    def get_path_scores(self, r: str, c: int, path_list: List[int]) -> np.ndarray:
+        if not self.args.use_path_counts:
+            return np.ones(len(path_list))
+        # When a cluster does not have a query relation (because it was not seen during counting)
+        # or if a path is not found, then fall back to no cluster statistics
+        ranked_programs = getattr(self.args, "ranked_programs", None)
+        if ranked_programs is not None and ranked_programs.uses_prior(r):
+            path_scores = ranked_programs.get_scores(c, r, np.array(path_list, dtype=np.int64))
+            if path_scores is not None:
+                return path_scores
+        path_scores, _ = score_programs(c, r, np.array(path_list, dtype=np.int64), self.args.precision_map,
+                                        self.args.precision_map_fallback, self.args.path_prior_map_per_relation,
+                                        self.args.path_prior_map_per_relation_fallback)
+        return path_scores
+
+    def execute_programs(self, e: str, r: str, c: int, path_list: List[int], max_branch: Optional[int] = 1000,
+                         top_k: Optional[int] = None) \
+            -> Tuple[List[Tuple[Tuple[np.ndarray, np.ndarray], float, int]], List[int]]:
+        """
+        Executes the ranked programs until max_num_programs of them returned answers (see execute_programs_anytime
+        for stopping earlier).
+        :return: list of (answers as (entity ids, counts), program score, program) and the programs without answers
+        """
+        all_answers, not_executed_paths, num_skipped = self.execute_programs_anytime(e, r, c, path_list, max_branch,
+                                                                                     top_k)
+        self.num_skipped_programs.append(num_skipped)
+        return all_answers, not_executed_paths
 
+    def execute_programs_anytime(self, e: str, r: str, c: int, path_list: List[int],
+                                 max_branch: Optional[int] = 1000, top_k: Optional[int] = None,
+                                 deadline: Optional[float] = None) \
+            -> Tuple[List[Tuple[Tuple[np.ndarray, np.ndarray], float, int]], List[int], int]:
+        """
+        Executes the ranked programs until max_num_programs of them returned answers, or earlier:
+        - once the remaining programs cannot change the top_k entities (only with aggr_type1 none and aggr_type2 sum
+        or max, see AnytimeTopK). The top_k entities are then the same as with all the programs, their scores can be
+        lower.
+        - at the deadline (time.monotonic()), with the answers of the programs executed so far.
+        :param top_k: defaults to --anytime_top_k, 0 does not stop early
+        :param deadline: defaults to --query_deadline_ms from now, if set
+        :return: list of (answers as (entity ids, counts), program score, program), the programs without answers and
+        the number of programs skipped by stopping early
+        """
+        top_k = top_k if top_k is not None else self.args.anytime_top_k
+        if deadline is None and self.args.query_deadline_ms > 0:
+            deadline = time.monotonic() + self.args.query_deadline_ms / 1000
+        path_scores = self.get_path_scores(r, c, path_list)
         all_answers = []
         not_executed_paths = []
         execution_fail_counter = 0
         executed_path_counter = 0
+        num_skipped = 0
         max_num_programs_for_r = self.args.max_num_programs if self.per_relation_config is None else \
             self.per_relation_config[r]["max_num_programs"]
-        for path in path_list:
+        aggr_type1_for_r, aggr_type2_for_r = self.get_aggr_types(r)
+        anytime_top_k = None
+        if top_k and aggr_type1_for_r == "none" and aggr_type2_for_r in ["sum", "max"]:
+            anytime_top_k = AnytimeTopK(path_scores, len(self.entity_vocab), top_k, aggr_type2_for_r,
+                                        max_num_programs_for_r)
+        # programs sharing a prefix re-use its frontier
+        answer_iter = self.executor.iter_execute(e, [self.program_vocab.get_program(path) for path in path_list])
+        for p_ctr, (path, path_score) in enumerate(zip(path_list, path_scores.tolist())):
             if executed_path_counter == max_num_programs_for_r:
                 break
-            ans = execute_one_program(self.sparse_adj_mats, self.entity_vocab, e, path)
-            if self.args.use_path_counts:
-                try:
-                    if path in self.args.path_prior_map_per_relation[self.c][r] and path in \
-                            self.args.precision_map[self.c][r]:
-                        path_score = self.args.path_prior_map_per_relation[self.c][r][path] * \
-                                     self.args.precision_map[self.c][r][path]
-                    else:
-                        # logger.info("This path was not there in the cluster for the relation.")
-                        path_score = _fall_back(r, path)
-                except KeyError:
-                    # logger.info("Looks like the relation was not found in the cluster, have to fall back")
-                    # fallback to the global scores
-                    path_score = _fall_back(r, path)
-            else:
-                path_score = 1
-            path = tuple(path)
-            if len(np.nonzero(ans)[0]) == 0:
+            if (deadline is not None and time.monotonic() >= deadline) or \
+                    (anytime_top_k is not None and anytime_top_k.is_settled(p_ctr, executed_path_counter)):
+                num_skipped = len(path_list) - p_ctr
+                break
+            ans = next(answer_iter)
+            if ans[0].shape[0] == 0:
                 not_executed_paths.append(path)
                 execution_fail_counter += 1
             else:
                 executed_path_counter += 1
+                if anytime_top_k is not None:
+                    anytime_top_k.add(ans[0], path_score)
             all_answers += [(ans, path_score, path)]
         #np.savetxt("all_answers.csv", all_answers, delimiter=",", fmt='%s')
         self.num_non_executable_programs.append(execution_fail_counter)
-        return all_answers, not_executed_paths
+        return all_answers, not_executed_paths, num_skipped
 
-    def rank_answers(self, list_answers: List[Tuple[np.ndarray, float, List[str]]], aggr_type1="none",
-                     aggr_type2="sum") -> List[
-        str]:
-        """
-        Different ways to re-rank answers
-        """
-
-        def rank_entities_by_max_score(score_map):
-            """
-            sorts wrt top value. If there are same values, then it sorts wrt the second value
-            :param score_map:
-            :return:
-            """
-            # sort wrt the max value
-            if len(score_map) == 0:
-                return []
-            sorted_score_map = sorted(score_map.items(), key=lambda kv: -kv[1][0])
-            sorted_score_map_second_round = []
-            temp = []
-            curr_val = sorted_score_map[0][1][0]  # value of the first
-            for (k, v) in sorted_score_map:
-                if v[0] == curr_val:
-                    temp.append((k, v))
-                else:
-                    sorted_temp = sorted(temp, key=lambda kv: -kv[1][1] if len(
-                        kv[1]) > 1 else 1)  # sort wrt second highest score
-                    sorted_score_map_second_round += sorted_temp
-                    temp = [(k, v)]  # clear temp and add new val
-                    curr_val = v[0]  # calculate new curr_val
-            # do the same for remaining elements in temp
-            if len(temp) > 0:
-                sorted_temp = sorted(temp,
-                                     key=lambda kv: -kv[1][1] if len(kv[1]) > 1 else 1)  # sort wrt second highest score
-                sorted_score_map_second_round += sorted_temp
-            return sorted_score_map_second_round
-
-        count_map = {}
-        uniq_entities = set()
-        for e_vec, e_score, path in list_answers:
-            path_answers = [(self.rev_entity_vocab[d_e], e_vec[d_e]) for d_e in np.nonzero(e_vec)[0]]
-            for e, e_c in path_answers:
-                if e not in count_map:
-                    count_map[e] = {}
-                if aggr_type1 == "none":
-                    count_map[e][path] = e_score  # just count once for a path type.
-                elif aggr_type1 == "sum":
-                    count_map[e][path] = e_score * e_c  # aggregate for each path
-                else:
-                    raise NotImplementedError("{} aggr_type1 is invalid".format(aggr_type1))
-                uniq_entities.add(e)
-        score_map = defaultdict(int)
-        for e, path_scores_map in count_map.items():
-            p_scores = [v for k, v in path_scores_map.items()]
-            if aggr_type2 == "sum":
-                score_map[e] = np.sum(p_scores)
-            elif aggr_type2 == "max":
-                score_map[e] = sorted(p_scores, reverse=True)
-            elif aggr_type2 == "noisy_or":
-                score_map[e] = 1 - np.prod(1 - np.asarray(p_scores))
-            elif aggr_type2 == "logsumexp":
-                score_map[e] = logsumexp(p_scores)
-            else:
-                raise NotImplementedError("{} aggr_type2 is invalid".format(aggr_type2))
-        if aggr_type2 == "max":
-            sorted_entities_by_val = rank_entities_by_max_score(score_map)
-        else:
-            sorted_entities_by_val = sorted(score_map.items(), key=lambda kv: -kv[1])
-        return sorted_entities_by_val
+    def get_anytime_top_k(self, top_k: Optional[int]) -> int:
+        """
+        :param top_k: number of predicted answers a query returns, None for all of them
+        :return: top_k of execute_programs_anytime, so that all the answers returned are settled: at least
+        --anytime_top_k, and 0 (do not stop early) if all the answers are returned
+        """
+        if self.args.anytime_top_k <= 0 or top_k is None:
+            return 0
+        return max(self.args.anytime_top_k, top_k)
 
-    @staticmethod
-    def get_rank_in_list(e, predicted_answers):
-        for i, e_to_check in enumerate(predicted_answers):
-            if e == e_to_check:
-                return i + 1
-        return -1
+    def uses_anytime_execution(self) -> bool:
+        """
+        :return: True if queries can stop early (--anytime_top_k or --query_deadline_ms), which is only done by
+        execute_programs_anytime, so queries are then not executed in batches
+        """
+        return self.args.anytime_top_k > 0 or self.args.query_deadline_ms > 0
 
+    def execute_programs_batch(self, r: str, heads: List[str], clusters: List[int], ranked_programs: List[List[int]]) \
+            -> List[Tuple[List[Tuple[Tuple[np.ndarray, np.ndarray], float, int]], List[int]]]:
+        """
+        Same as calling execute_programs for a batch of queries with the same relation r, but each program is executed
+        once for all the queries which need it, with one SpMM per relation from a source matrix with a column per
+        head entity.
+        Execution goes in rounds: every query which has not reached max_num_programs asks for as many of its next
+        programs as it still needs, so no query executes more programs than it would on its own.
+        :return: (answers, programs which did not execute) of every query
+        """
+        max_num_programs_for_r = self.args.max_num_programs if self.per_relation_config is None else \
+            self.per_relation_config[r]["max_num_programs"]
+        head_ids = np.array([self.entity_vocab[e] for e in heads], dtype=np.int64)
+        path_scores = [self.get_path_scores(r, c, path_list).tolist()
+                       for c, path_list in zip(clusters, ranked_programs)]
+        all_answers = [[] for _ in heads]
+        not_executed_paths = [[] for _ in heads]
+        next_program = [0] * len(heads)
+        executed_path_counter = [0] * len(heads)
+        pending = [q_ctr for q_ctr in range(len(heads)) if len(ranked_programs[q_ctr]) > 0]
+        while len(pending) > 0:
+            program_queries = defaultdict(list)  # program -> queries of this round which need it
+            for q_ctr in pending:
+                num_needed = max_num_programs_for_r - executed_path_counter[q_ctr]
+                for path in ranked_programs[q_ctr][next_program[q_ctr]:next_program[q_ctr] + num_needed]:
+                    program_queries[path].append(q_ctr)
+            program_answers = {}  # (program, query) -> (entity ids, counts)
+            for path, path_queries in program_queries.items():
+                ans_mat = execute_program_batch(self.sparse_adj_mats, head_ids[path_queries],
+                                                self.program_vocab.get_program(path)).tocsc()
+                ans_mat.eliminate_zeros()
+                ans_mat.sort_indices()
+                for col, q_ctr in enumerate(path_queries):
+                    st, en = ans_mat.indptr[col], ans_mat.indptr[col + 1]
+                    program_answers[(path, q_ctr)] = ans_mat.indices[st:en].astype(np.int64), \
+                        ans_mat.data[st:en].astype(np.int64)
+            still_pending = []
+            for q_ctr in pending:
+                num_needed = max_num_programs_for_r - executed_path_counter[q_ctr]
+                for p_ctr in range(next_program[q_ctr], min(next_program[q_ctr] + num_needed,
+                                                            len(ranked_programs[q_ctr]))):
+                    path = ranked_programs[q_ctr][p_ctr]
+                    ans = program_answers[(path, q_ctr)]
+                    if ans[0].shape[0] == 0:
+                        not_executed_paths[q_ctr].append(path)
+                    else:
+                        executed_path_counter[q_ctr] += 1
+                    all_answers[q_ctr] += [(ans, path_scores[q_ctr][p_ctr], path)]
+                next_program[q_ctr] = min(next_program[q_ctr] + num_needed, len(ranked_programs[q_ctr]))
+                if executed_path_counter[q_ctr] < max_num_programs_for_r and \
+                        next_program[q_ctr] < len(ranked_programs[q_ctr]):
+                    still_pending.append(q_ctr)
+            pending = still_pending
+        self.num_non_executable_programs += [len(paths) for paths in not_executed_paths]
+        return list(zip(all_answers, not_executed_paths))
+
+    def rank_answers(self, list_answers: List[Tuple[Tuple[np.ndarray, np.ndarray], float, int]], aggr_type1="none",
+                     aggr_type2="sum", top_k: Optional[int] = None) -> List[Tuple[str, float]]:
+        """
+        Different ways to re-rank answers. Scores are aggregated per entity id (see aggregate_answers) and only the
+        top_k entities (all if None) are converted to names.
+        With aggr_type2 = max, entities with the same max score are sorted wrt their second highest score.
+        :return: (entity, score) sorted by decreasing score, ties in the order the entities were first reached
+        """
+        ent_ids, scores, second_scores = aggregate_answers(list_answers, aggr_type1, aggr_type2)
+        return self.name_answers(ent_ids, scores, second_scores, top_k)
 
+    def name_answers(self, ent_ids: np.ndarray, scores: np.ndarray, second_scores: Optional[np.ndarray] = None,
+                     top_k: Optional[int] = None) -> List[Tuple[str, float]]:
+        """
+        :return: the top_k (all if None) of the aggregated answers (see aggregate_answers) as (entity, score)
+        """
+        top = get_top_k(scores, second_scores, top_k)
+        return [(self.rev_entity_vocab[e], score) for e, score in zip(ent_ids[top].tolist(), scores[top].tolist())]
 
-    def do_symbolic_case_based_reasoning(self):
-        num_programs = []
-        num_answers = []
-        all_acc = []
-        non_zero_ctr = 0
-        hits_10, hits_5, hits_3, hits_1, mrr = 0.0, 0.0, 0.0, 0.0, 0.0
-        per_relation_scores = {}  # map of performance per relation
-        per_relation_query_count = {}
-        total_examples = 0
-        learnt_programs = defaultdict(lambda: defaultdict(int))  # for each query relation, a map of programs to count
-        all_data =[]
-        for ex_ctr, ((e1, r), e2_list) in enumerate(tqdm(self.eval_map.items())):
-            #logger.info("Executing query {}".format(ex_ctr))
-            orig_train_e2_list = self.train_map[(e1, r)]
-            temp_train_e2_list = []
-            for e2 in orig_train_e2_list:
-                if e2 in e2_list:
-                    continue
-                temp_train_e2_list.append(e2)
-            self.train_map[(e1, r)] = temp_train_e2_list
-             #also remove (e2, r^-1, e1)
-            r_inv = get_inv_relation(r, args.dataset_name)
-            temp_map = {}  # map from (e2, r_inv) -> outgoing nodes
-            for e2 in e2_list:
-                temp_map[(e2, r_inv)] = self.train_map[e2, r_inv]
-                temp_list = []
-                for e1_dash in self.train_map[e2, r_inv]:
-                    if e1_dash == e1:
-                        continue
-                    else:
-                        temp_list.append(e1_dash)
-                self.train_map[e2, r_inv] = temp_list
-
-            total_examples += len(e2_list)
-            if e1 not in self.entity_vocab:
-                all_acc += [0.0] * len(e2_list)
-                 #put it back
-                self.train_map[(e1, r)] = orig_train_e2_list
-                for e2 in e2_list:
-                    self.train_map[(e2, r_inv)] = temp_map[(e2, r_inv)]
-                continue  # this entity was not seen during train; skip?
-            self.c = self.args.cluster_assignments[self.entity_vocab[e1]]
-            num_nn_for_r = self.args.k_adj if self.per_relation_config is None else self.per_relation_config[r]["k_adj"]
-            all_programs = self.get_programs_from_nearest_neighbors(e1, r, self.get_nearest_neighbor_inner_product,
-                                                                    num_nn=num_nn_for_r)
-            for p in all_programs:
-                if p[0] == r:
-                    continue
-                if r not in learnt_programs:
-                    learnt_programs[r] = {}
-                p = tuple(p)
-                if p not in learnt_programs[r]:
-                    learnt_programs[r][p] = 0
-                learnt_programs[r][p] += 1
-                
-            temp = []
-            for p in all_programs:
-                if len(p) == 1 and p[0] == r:
-                    continue
-                temp.append(p)
-            all_programs = temp
 
 
+    def prepare_query(self, e1: str, r: str, e2_list: List[str], learnt_programs: Dict) -> Tuple[int, List[int]]:
+        """
+        Gathers the programs of the nearest neighbors of e1 and ranks them. The query edges (and their inverses) are
+        hidden from train_map while doing so.
+        :return: cluster of e1 and the ranked programs
+        """
+        orig_train_e2_list = self.train_map[(e1, r)]
+        temp_train_e2_list = []
+        for e2 in orig_train_e2_list:
+            if e2 in e2_list:
+                continue
+            temp_train_e2_list.append(e2)
+        self.train_map[(e1, r)] = temp_train_e2_list
+        # also remove (e2, r^-1, e1)
+        r_inv = get_inv_relation(r, self.args.dataset_name)
+        temp_map = {}  # map from (e2, r_inv) -> outgoing nodes
+        for e2 in e2_list:
+            temp_map[(e2, r_inv)] = self.train_map[e2, r_inv]
+            temp_list = []
+            for e1_dash in self.train_map[e2, r_inv]:
+                if e1_dash == e1:
+                    continue
+                else:
+                    temp_list.append(e1_dash)
+            self.train_map[e2, r_inv] = temp_list
+
+        c = self.args.cluster_assignments[self.entity_vocab[e1]]
+        num_nn_for_r = self.args.k_adj if self.per_relation_config is None else self.per_relation_config[r]["k_adj"]
+        all_programs = self.get_programs_from_nearest_neighbors(e1, r, self.get_nearest_neighbor_inner_product,
+                                                                num_nn=num_nn_for_r)
+        # put it back
+        self.train_map[(e1, r)] = orig_train_e2_list
+        for e2 in e2_list:
+            self.train_map[(e2, r_inv)] = temp_map[(e2, r_inv)]
+
+        for p in all_programs:
+            if self.program_vocab.get_program(p)[0] == r:
+                continue
+            if r not in learnt_programs:
+                learnt_programs[r] = {}
+            if p not in learnt_programs[r]:
+                learnt_programs[r][p] = 0
+            learnt_programs[r][p] += 1
+
+        # filter the program if it is equal to the query relation
+        all_programs = [p for p in all_programs if not self.program_vocab.is_query_relation(p, r)]
+        return c, self.rank_programs(all_programs, r, c)
+
+    def get_aggr_types(self, r: str) -> Tuple[str, str]:
+        aggr_type1_for_r = self.args.aggr_type1 if self.per_relation_config is None \
+            else self.per_relation_config[r]["aggr_type1"]
+        aggr_type2_for_r = self.args.aggr_type2 if self.per_relation_config is None \
+            else self.per_relation_config[r]["aggr_type2"]
+        return aggr_type1_for_r, aggr_type2_for_r
+
+    def finish_query(self, r: str, answers: List[Tuple[Tuple[np.ndarray, np.ndarray], float, int]],
+                     top_k: Optional[int] = None) -> Dict[str, float]:
+        """
+        Aggregates the answers of the executed programs into scores of the predicted entities.
+        :param top_k: only keep the top_k predicted entities
+        :return: predicted entity -> score, by decreasing score
+        """
+        aggr_type1_for_r, aggr_type2_for_r = self.get_aggr_types(r)
+        answers = self.rank_answers(answers,
+                                    aggr_type1_for_r,
+                                    aggr_type2_for_r,
+                                    top_k=top_k)
 
-            all_uniq_programs = self.rank_programs(all_programs, r)
-            
+        predicted_answers = dict([(e, float(score)) for e, score in answers])
+        return predicted_answers
 
-            
-            num_programs.append(len(all_uniq_programs))
-            # Now execute the program
-            answers, not_executed_programs = self.execute_programs(e1, r, all_uniq_programs, max_branch=args.max_branch)
-            aggr_type1_for_r = self.args.aggr_type1 if self.per_relation_config is None \
-                else self.per_relation_config[r]["aggr_type1"]
-            aggr_type2_for_r = self.args.aggr_type2 if self.per_relation_config is None \
-                else self.per_relation_config[r]["aggr_type2"]
-            answers = self.rank_answers(answers,
-                                        aggr_type1_for_r,
-                                        aggr_type2_for_r)
-            
-            predicted_answers = [(e, float(score)) for e, score in answers]
-            predicted_answers_highscore = list()
-            predicted_answers = dict(predicted_answers)
-            print(predicted_answers)
-            itemMaxValue = max(predicted_answers.items(), key=lambda x: x[1],default=0)
-            for key, value in predicted_answers.items():
-                if value == itemMaxValue[1]:
-                     predicted_answers_highscore.append((key,value))
-            predicted_answers_highscore = dict(predicted_answers_highscore)
-
-            
+    def get_filtered_ranks(self, e1: str, r: str, e2_list: List[str], ent_ids: np.ndarray, scores: np.ndarray,
+                           second_scores: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        :return: filtered rank of every answer in e2_list among the aggregated answers, -1 if it was not predicted
+        """
+        gold_ids = np.array([self.entity_vocab.get(e2, -1) for e2 in e2_list], dtype=np.int64)
+        known_ids = get_known_answer_ids(self.args.all_kg_map, e1, r, self.entity_vocab)
+        return get_filtered_ranks(ent_ids, scores, gold_ids, known_ids, second_scores)
 
+    def get_known_answers(self, e1: str, r: str) -> List[str]:
+        """
+        :return: answers of (e1, r) in train/dev/test
+        """
+        return list(dict.fromkeys(self.args.all_kg_map[(e1, r)])) if (e1, r) in self.args.all_kg_map else []
 
-def main(args):
+    @staticmethod
+    def format_query_result(e1: str, r: str, e2_list: List[str], predicted_answers: Dict[str, float],
+                            top_k: Optional[int] = None, node_names: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        :return: the query in the format of data.json, i.e. {"e1": [id, name], "r": r, "answers": [[id, name], ...],
+        "predicted_answers": [[id, score], ...]} with predicted answers sorted by decreasing score
+        """
+        node_names = node_names if node_names is not None else {}
+        predicted_answers = sorted(predicted_answers.items(), key=lambda item: -item[1])
+        if top_k is not None:
+            predicted_answers = predicted_answers[:top_k]
+        return {"e1": [e1, node_names.get(e1, "")], "r": r, "answers": [[e2, node_names.get(e2, "")] for e2 in e2_list],
+                "predicted_answers": [[e2, score] for e2, score in predicted_answers]}
+
+    def answer_query(self, e1: str, r: str, e2_list: Optional[List[str]] = None, top_k: Optional[int] = None,
+                     node_names: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        Answers a single (e1, r) query in-process.
+        :param e2_list: known answers, hidden from the graph when gathering programs (as for eval queries). Defaults to
+        the answers of (e1, r) in train/dev/test.
+        :param top_k: only return the top_k predicted answers
+        :param node_names: entity id -> name, for the e1 and answers fields
+        :return: see format_query_result
+        """
+        if e2_list is None:
+            e2_list = self.get_known_answers(e1, r)
+        predicted_answers = {}
+        if e1 in self.entity_vocab:
+            c, all_uniq_programs = self.prepare_query(e1, r, e2_list, {})
+            answers, _ = self.execute_programs(e1, r, c, all_uniq_programs, max_branch=self.args.max_branch,
+                                               top_k=self.get_anytime_top_k(top_k))
+            predicted_answers = self.finish_query(r, answers, top_k)
+        return self.format_query_result(e1, r, e2_list, predicted_answers, top_k, node_names)
+
+    def get_query_batches(self) -> List[List[Tuple[Tuple[str, str], List[str]]]]:
+        """
+        With --batch_queries, eval queries are grouped by query relation (in chunks of query_batch_size), so that
+        their programs can be executed together. Otherwise every query is a batch of its own.
+        """
+        if not self.args.batch_queries:
+            return [[query] for query in self.eval_map.items()]
+        queries_by_relation = defaultdict(list)
+        for (e1, r), e2_list in self.eval_map.items():
+            queries_by_relation[r].append(((e1, r), e2_list))
+        batches = []
+        for r, queries in queries_by_relation.items():
+            batches += [queries[b_st:b_st + self.args.query_batch_size]
+                        for b_st in range(0, len(queries), self.args.query_batch_size)]
+        return batches
+
+    def do_symbolic_case_based_reasoning(self):
+        all_ranks = []  # filtered ranks of the gold answers of every query
+        total_examples = 0
+        learnt_programs = defaultdict(lambda: defaultdict(int))  # for each query relation, a map of programs to count
+        for query_batch in tqdm(self.get_query_batches()):
+            prepared_queries = []  # (e1, r, e2_list, cluster, ranked programs)
+            for (e1, r), e2_list in query_batch:
+                total_examples += len(e2_list)
+                if e1 not in self.entity_vocab:
+                    continue  # this entity was not seen during train; skip?
+                c, all_uniq_programs = self.prepare_query(e1, r, e2_list, learnt_programs)
+                prepared_queries.append((e1, r, e2_list, c, all_uniq_programs))
+            if len(prepared_queries) == 0:
+                continue
+            # Now execute the program
+            if len(prepared_queries) == 1 or self.uses_anytime_execution():
+                results = [self.execute_programs(e1, r, c, all_uniq_programs, max_branch=self.args.max_branch)
+                           for e1, r, _, c, all_uniq_programs in prepared_queries]
+            else:
+                # all the queries of a batch have the same relation
+                r = prepared_queries[0][1]
+                results = self.execute_programs_batch(r, [q[0] for q in prepared_queries],
+                                                      [q[3] for q in prepared_queries],
+                                                      [q[4] for q in prepared_queries])
+            for (e1, r, e2_list, _, _), (answers, not_executed_programs) in zip(prepared_queries, results):
+                ent_ids, scores, second_scores = aggregate_answers(answers, *self.get_aggr_types(r))
+                all_ranks.append(self.get_filtered_ranks(e1, r, e2_list, ent_ids, scores, second_scores))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Predicted answers of ({}, {}): {}".format(e1, r, dict(
+                        [(e, float(score)) for e, score in self.name_answers(ent_ids, scores, second_scores)])))
+        metrics = get_ranking_metrics(np.concatenate(all_ranks) if len(all_ranks) > 0 else np.zeros(0))
+        if total_examples > 0:
+            for k in HITS_AT:
+                logger.info("Hits@{} {}".format(k, metrics["hits_{}".format(k)] / total_examples))
+            logger.info("MRR {}".format(metrics["mrr"] / total_examples))
+        if self.uses_anytime_execution() and len(self.num_skipped_programs) > 0:
+            logger.info("Avg number of programs skipped per query by stopping early: {}".format(
+                np.mean(self.num_skipped_programs)))
+
+
+def get_score_table_dirs(args, data_dir: str) -> Dict[str, str]:
+    """
+    :return: directories of the prior and precision maps, for the linkage of args and the fall-back (single cluster)
+    """
+    path_dir_name = "path_{}".format(args.num_paths_around_entities)
+    return {"path_prior_map_per_relation": os.path.join(data_dir, "linkage={}".format(args.linkage), "prior_maps",
+                                                        path_dir_name),
+            "path_prior_map_per_relation_fallback": os.path.join(data_dir, "linkage=0.0", "prior_maps",
+                                                                 path_dir_name),
+            "precision_map": os.path.join(data_dir, "linkage={}".format(args.linkage), "precision_maps",
+                                          path_dir_name),
+            "precision_map_fallback": os.path.join(data_dir, "linkage=0.0", "precision_maps", path_dir_name),
+            "ranked_programs": os.path.join(data_dir, "linkage={}".format(args.linkage), "ranked_programs",
+                                            path_dir_name)}
+
+
+def get_input_files(args, data_dir: str, subgraph_dir: str, kg_file: str) -> List[str]:
+    """
+    Files and directories read by load_prob_cbr. A snapshot is stale when one of them changed.
+    """
+    input_files = [kg_file, args.train_file, args.dev_file, args.test_file, os.path.join(data_dir, "dev.txt"),
+                   os.path.join(data_dir, "test.txt"), os.path.join(data_dir, "entity_vocab.json"),
+                   os.path.join(data_dir, "relation_vocab.json"), os.path.join(data_dir, "eval_vocab.json"),
+                   subgraph_dir, get_path_store_dir(subgraph_dir, args.max_path_len),
+                   os.path.join(args.data_dir, "data", args.dataset_name, "ent_sim.pkl"),
+                   os.path.join(args.data_dir, "data", args.dataset_name, "linkage={}".format(args.linkage),
+                                "cluster_assignments.pkl")]
+    for score_table_dir in get_score_table_dirs(args, data_dir).values():
+        input_files += [score_table_dir] + [os.path.join(score_table_dir, map_name)
+                                            for map_name in ["path_prior_map", "precision_map", "ranked_programs"]]
+    if args.per_relation_config_file is not None:
+        input_files.append(args.per_relation_config_file)
+    return input_files
+
+
+def get_snapshot_config(args) -> Dict:
+    """
+    Arguments which change what load_prob_cbr loads. A snapshot is only used with the same ones.
+    """
+    return {"dataset_name": args.dataset_name, "data_dir": args.data_dir, "linkage": args.linkage,
+            "num_paths_around_entities": args.num_paths_around_entities, "max_path_len": args.max_path_len,
+            "test": bool(args.test)}
+
+
+def prob_cbr_from_snapshot(args, snapshot: Dict) -> ProbCBR:
+    args.entity_vocab = snapshot["entity_vocab"]
+    args.rel_vocab = snapshot["rel_vocab"]
+    args.rev_entity_vocab = snapshot["rev_entity_vocab"]
+    args.rev_rel_vocab = snapshot["rev_rel_vocab"]
+    args.train_map = snapshot["train_map"]
+    if args.test:
+        args.test_map = snapshot["eval_map"]
+    else:
+        args.dev_map = snapshot["eval_map"]
+    args.all_kg_map = snapshot["all_kg_map"]
+    args.cluster_assignments = snapshot["cluster_assignments"]
+    for table_name in SCORE_TABLES:
+        setattr(args, table_name, snapshot[table_name])
+    prob_cbr_agent = ProbCBR(args, snapshot["train_map"], snapshot["eval_map"], snapshot["entity_vocab"],
+                             snapshot["rev_entity_vocab"], snapshot["rel_vocab"], snapshot["rev_rel_vocab"],
+                             snapshot["eval_vocab"], snapshot["eval_rev_vocab"], snapshot["all_paths"],
+                             snapshot["rel_ent_map"], snapshot["per_relation_config"],
+                             sparse_adj_mats=snapshot["sparse_adj_mats"], out_adj_mats=snapshot["out_adj_mats"])
+    prob_cbr_agent.set_nearest_neighbor_1_hop(snapshot["nearest_neighbors"])
+    return prob_cbr_agent
+
+
+def load_prob_cbr(args) -> ProbCBR:
+    """
+    Loads the vocabs, paths, similarities, clusters and prior/precision maps, i.e. everything needed before inference.
+    With --snapshot_dir, they are memory-mapped from the snapshot instead, unless it is stale.
+    """
     dataset_name = 'MRN_ind_with_CtD_len4'
     #logger.info("==========={}============".format(dataset_name))
     data_dir = 'prob-cbr-data/data/MRN_ind_with_CtD_len4'
@@ -407,6 +636,13 @@ def main(args):
           #      else os.path.join(data_dir, args.test_file_name)
 
     args.train_file = 'prob-cbr-data/data/MRN_ind_with_CtD_len4/train.txt'
+    args.input_files = get_input_files(args, data_dir, subgraph_dir, kg_file)
+    if args.snapshot_dir is not None and not args.export_snapshot:
+        snapshot = load_snapshot(args.snapshot_dir, args.input_files, get_snapshot_config(args),
+                                 verify_content=args.verify_snapshot, path_cache_size=args.path_cache_size)
+        if snapshot is not None:
+            return prob_cbr_from_snapshot(args, snapshot)
+        logger.info("Loading from the input files instead of the snapshot")
     #logger.info("Loading train map")
     train_map = load_data(kg_file)
     #logger.info("Loading dev map")
@@ -446,7 +682,8 @@ def main(args):
 
     ########### Load all paths ###########
     file_prefix = "paths_{}_path_len_{}_".format(args.num_paths_around_entities, args.max_path_len)
-    all_paths = combine_path_splits(subgraph_dir, file_prefix=file_prefix)
+    all_paths = load_path_store(subgraph_dir, file_prefix, entity_vocab, rel_vocab, args.max_path_len,
+                                mmap_mode="r" if args.mmap_paths else None, cache_size=args.path_cache_size)
 
     prob_cbr_agent = ProbCBR(args, train_map, eval_map, entity_vocab, rev_entity_vocab, rel_vocab,
                              rev_rel_vocab, eval_vocab, eval_rev_vocab, all_paths, rel_ent_map, per_relation_config)
@@ -475,62 +712,45 @@ def main(args):
       #      "Clustering file not found at {}. Please run the preprocessing script first".format(cluster_file_name))
         sys.exit(1)
 
+    score_table_dirs = get_score_table_dirs(args, data_dir)
     ########### load prior maps ###########
-    path_prior_map_filenm = os.path.join(data_dir, "linkage={}".format(args.linkage), "prior_maps",
-                                         "path_{}".format(args.num_paths_around_entities), "path_prior_map1.pkl")
-   # logger.info("Loading path prior weights")
-    if os.path.exists(path_prior_map_filenm):
-        with open(path_prior_map_filenm, "rb") as fin:
-            args.path_prior_map_per_relation = pickle.load(fin)
-    else:
-        logger.info(
-            "Path prior files not found at {}. Please run the preprocessing script".format(path_prior_map_filenm))
+    args.path_prior_map_per_relation = load_score_table(score_table_dirs["path_prior_map_per_relation"],
+                                                        "path_prior_map", all_paths.program_vocab,
+                                                        legacy_file_name="path_prior_map1.pkl")
 
     ########### load prior maps (fall-back) ###########
-    linkage_bck = args.linkage
-    args.linkage = 0.0
-    bck_dir_name = os.path.join(data_dir, "linkage={}".format(args.linkage), "prior_maps",
-                                "path_{}".format(args.num_paths_around_entities))
-    path_prior_map_filenm_fallback = os.path.join(bck_dir_name, "path_prior_map1.pkl")
-    if os.path.exists(bck_dir_name):
-     #   logger.info("Loading fall-back path prior weights")
-        with open(path_prior_map_filenm_fallback, "rb") as fin:
-            args.path_prior_map_per_relation_fallback = pickle.load(fin)
-    else:
-        logger.info("Fall-back path prior weights not found at {}. Please run the preprocessing script".format(
-            path_prior_map_filenm_fallback))
-    args.linkage = linkage_bck
+    args.path_prior_map_per_relation_fallback = load_score_table(
+        score_table_dirs["path_prior_map_per_relation_fallback"], "path_prior_map", all_paths.program_vocab,
+        legacy_file_name="path_prior_map1.pkl")
 
     ########### load precision maps ###########
-    precision_map_filenm = os.path.join(data_dir, "linkage={}".format(args.linkage), "precision_maps",
-                                        "path_{}".format(args.num_paths_around_entities), "precision_map.pkl")
-   # logger.info("Loading precision map")
-    if os.path.exists(precision_map_filenm):
-        with open(precision_map_filenm, "rb") as fin:
-            args.precision_map = pickle.load(fin)
-    else:
-        logger.info(
-            "Path precision files not found at {}. Please run the preprocessing script".format(precision_map_filenm))
+    args.precision_map = load_score_table(score_table_dirs["precision_map"], "precision_map",
+                                          all_paths.program_vocab)
 
     ########### load precision maps (fall-back) ###########
-    linkage_bck = args.linkage
-    args.linkage = 0.0
-    precision_map_filenm_fallback = os.path.join(data_dir, "linkage={}".format(args.linkage), "precision_maps",
-                                                 "path_{}".format(args.num_paths_around_entities), "precision_map.pkl")
-   #logger.info("Loading fall-back precision map")
-    if os.path.exists(precision_map_filenm_fallback):
-        with open(precision_map_filenm_fallback, "rb") as fin:
-            args.precision_map_fallback = pickle.load(fin)
-    else:
-        logger.info("Path precision fall-back files not found at {}. Please run the preprocessing script".format(
-            precision_map_filenm_fallback))
-    args.linkage = linkage_bck
+    args.precision_map_fallback = load_score_table(score_table_dirs["precision_map_fallback"], "precision_map",
+                                                   all_paths.program_vocab)
+
+    ########### load ranked programs ###########
+    args.ranked_programs = load_ranked_programs(score_table_dirs["ranked_programs"],
+                                                program_vocab=all_paths.program_vocab)
+
+    return prob_cbr_agent
+
 
+def main(args):
+    prob_cbr_agent = load_prob_cbr(args)
+    if args.export_snapshot:
+        export_snapshot(prob_cbr_agent, args.snapshot_dir, args.input_files, get_snapshot_config(args))
+        return
     # Finally all files are loaded, do inference!
-    prob_cbr_agent.do_symbolic_case_based_reasoning()
+    if args.screen_relation is not None:
+        run_screen(prob_cbr_agent, args)
+    else:
+        prob_cbr_agent.do_symbolic_case_based_reasoning()
 
 
-if __name__ == '__main__':
+def get_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Collect subgraphs around entities")
     parser.add_argument("--dataset_name", type=str, default="nell")
     parser.add_argument("--data_dir", type=str, default="../prob_cbr_data/")
@@ -556,6 +776,19 @@ if __name__ == '__main__':
     parser.add_argument("--cheat_neighbors", type=int, default=0,
                         help="When adjacency fails to return neighbors, use any entities which have query relation")
     parser.add_argument("--max_num_programs", type=int, default=5000)
+    parser.add_argument("--max_ranked_programs", type=int, default=0,
+                        help="Only execute the first N ranked programs (0: all of them). Programs without answers do "
+                             "not count towards --max_num_programs, so a cutoff can drop answers")
+    parser.add_argument("--anytime_top_k", type=int, default=0,
+                        help="Stop executing the programs of a query once the remaining ones cannot change its top k "
+                             "answers (aggr_type1 none, aggr_type2 sum/max). 0: execute up to max_num_programs")
+    parser.add_argument("--query_deadline_ms", type=float, default=0,
+                        help="Stop executing the programs of a query after this long and answer with the programs "
+                             "executed so far. 0: no deadline")
+    parser.add_argument("--batch_queries", type=int, choices=[0, 1], default=0,
+                        help="Set to 1 to group eval queries by relation and execute their programs together")
+    parser.add_argument("--query_batch_size", type=int, default=512,
+                        help="Max number of queries executed together with --batch_queries")
     # Output modifier args
     parser.add_argument("--name_of_run", type=str, default="unset")
     parser.add_argument("--output_per_relation_scores", action="store_true")
@@ -565,13 +798,41 @@ if __name__ == '__main__':
     parser.add_argument("--num_paths_around_entities", type=int, default=1000)
     parser.add_argument("--max_path_len", type=int, default=3)
     parser.add_argument("--prevent_loops", type=int, choices=[0, 1], default=1)
+    parser.add_argument("--mmap_paths", type=int, choices=[0, 1], default=1,
+                        help="Set to 1 to memory-map the path store and only read paths of the entities needed")
+    parser.add_argument("--path_cache_size", type=int, default=1024,
+                        help="Number of recently used entities whose paths and programs are kept in memory")
     parser.add_argument("--max_branch", type=int, default=100)
     parser.add_argument("--aggr_type1", type=str, default="none", help="none/sum")
     parser.add_argument("--aggr_type2", type=str, default="sum", help="sum/max/noisy_or/logsumexp")
     parser.add_argument("--use_only_precision_scores", type=int, default=0)
     parser.add_argument("--specific_rel", type=int, default=None)
     parser.add_argument("--dump_paths", action="store_true", default='true')
+    # Screen args
+    parser.add_argument("--screen_relation", type=str, default=None,
+                        help="If set, score every head entity against every candidate for this relation")
+    parser.add_argument("--screen_heads_file", type=str, default=None,
+                        help="File with the head entities to screen, one per line")
+    parser.add_argument("--screen_head_prefix", type=str, default="CHEBI:",
+                        help="If no heads file is given, screen all entities with this prefix")
+    parser.add_argument("--screen_candidate_prefix", type=str, default=None,
+                        help="Only rank candidates with this prefix (e.g. MONDO:)")
+    parser.add_argument("--screen_top_k", type=int, default=100)
+    parser.add_argument("--screen_memory_mb", type=float, default=1024,
+                        help="Memory budget of a block of scores, controls how many heads are screened together")
+    parser.add_argument("--screen_output_dir", type=str, default=None, help="Defaults to expt_dir")
+    parser.add_argument("--snapshot_dir", type=str, default=None,
+                        help="Memory-map everything from this snapshot instead of loading the input files, unless it "
+                             "is stale")
+    parser.add_argument("--export_snapshot", type=int, choices=[0, 1], default=0,
+                        help="Load the input files and write them to --snapshot_dir, then exit")
+    parser.add_argument("--verify_snapshot", type=int, choices=[0, 1], default=0,
+                        help="Check the content hash of the snapshot files before using it (reads all of them)")
+    return parser
 
+
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
 
 
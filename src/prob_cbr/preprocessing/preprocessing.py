@@ -12,13 +12,24 @@ import json
 import sys
 import wandb
 import time
+import multiprocessing
+import scipy.sparse
 
 from src.prob_cbr.data.data_utils import create_vocab, load_vocab, load_data, get_unique_entities, \
     read_graph, get_entities_group_by_relation, get_inv_relation, load_data_all_triples, create_adj_list
-from src.prob_cbr.utils import execute_one_program, get_programs, get_adj_mat, create_sparse_adj_mats
+from src.prob_cbr.data.path_sampler import CSRAdjList, get_paths_vectorized
+from src.prob_cbr.data.path_store import PathStore
+from src.prob_cbr.data.score_table import ScoreTable, save_partitioned, load_score_table
+from src.prob_cbr.data.ranked_programs import build_ranked_programs
+from src.prob_cbr.data.program_vocab import write_vocab_fingerprint, read_vocab_fingerprint
+from src.prob_cbr.neighbors import IVFIndex, report_recall
+from src.prob_cbr.utils import execute_one_program, execute_program_batch, get_programs, get_adj_mat, \
+    create_sparse_adj_mats, calc_sparse_sim
 from numpy.random import default_rng
 
 rng = default_rng()
+# adjacency shared (read-only) with the forked path sampling workers
+_worker_csr_adj = None
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 ch = logging.StreamHandler()
@@ -65,19 +76,24 @@ def get_paths(args, train_adj_list, start_node, max_len=3):
     return all_paths
 
 
-def combine_path_splits(data_dir, file_prefix=None):
-    combined_paths = defaultdict(list)
-    # combined_paths = []
+def get_path_split_file_names(data_dir, file_prefix=None):
     file_names = []
     for f in tqdm(os.listdir(data_dir)):
         if os.path.isfile(os.path.join(data_dir, f)):
             if file_prefix is not None:
                 if not f.startswith(file_prefix):
                     continue
-            file_names.append(f)
+            file_names.append(os.path.join(data_dir, f))
+    return file_names
+
+
+def combine_path_splits(data_dir, file_prefix=None):
+    combined_paths = defaultdict(list)
+    # combined_paths = []
+    file_names = get_path_split_file_names(data_dir, file_prefix)
     for f in file_names:
-        logger.info("Reading file name: {}".format(os.path.join(data_dir, f)))
-        with open(os.path.join(data_dir, f), "rb") as fin:
+        logger.info("Reading file name: {}".format(f))
+        with open(f, "rb") as fin:
             paths = pickle.load(fin)
             # combined_paths.append(paths)
             for k, v in paths.items():
@@ -87,12 +103,45 @@ def combine_path_splits(data_dir, file_prefix=None):
     return combined_paths
 
 
+def get_path_store_dir(subgraph_dir, max_len):
+    return os.path.join(subgraph_dir, "path_store_path_len_{}".format(max_len))
+
+
+def load_path_store(subgraph_dir, file_prefix, entity_vocab, rel_vocab, max_len, mmap_mode=None, cache_size=0):
+    """
+    Load the paths around entities as a PathStore. If the store has not been written yet (--combine_paths),
+    it is built in memory from the pickled path splits.
+    Use mmap_mode="r" to only read the paths of entities when they are requested.
+    """
+    store_dir = get_path_store_dir(subgraph_dir, max_len)
+    if PathStore.exists(store_dir):
+        logger.info("Loading path store from {}".format(store_dir))
+        return PathStore.load(store_dir, entity_vocab, mmap_mode=mmap_mode, cache_size=cache_size)
+    logger.info("Path store not found at {}, building it from the path splits".format(store_dir))
+    return PathStore.from_path_splits(get_path_split_file_names(subgraph_dir, file_prefix), entity_vocab, rel_vocab,
+                                      max_len)
+
+
+def _get_paths_for_batch(batch_args):
+    """
+    Collect paths around a batch of entities. Runs in the worker processes of get_paths_parallel.
+    :param batch_args: (args, list of entities, SeedSequence of the batch)
+    """
+    args, batch_entities, seed_seq = batch_args
+    return get_paths_vectorized(args, _worker_csr_adj, batch_entities, args.max_len, default_rng(seed_seq))
+
+
 def get_paths_parallel(args, kg_file, out_dir, job_id=0, total_jobs=1):
     """
+    Collect paths around the entities of this job's partition. If args.num_workers > 1, the adjacency is loaded once
+    and shared with a pool of forked worker processes which are handed batches of entities dynamically.
+    Every batch gets its own random stream spawned from args.seed, so the output does not depend on num_workers.
     :param kg_file:
     :return:
     """
-    unique_entities = get_unique_entities(kg_file)
+    global _worker_csr_adj
+    # sort so that every job sees the entities in the same order
+    unique_entities = sorted(get_unique_entities(kg_file))
     num_entities = len(unique_entities)
     logger.info("Total num unique entities are {}".format(num_entities))
     num_entities_in_partition = num_entities / total_jobs
@@ -101,17 +150,31 @@ def get_paths_parallel(args, kg_file, out_dir, job_id=0, total_jobs=1):
     logger.info("Starting a job with st ind {} and end ind {}".format(st, en))
     logger.info("Creating adj list")
     train_adj_list = create_adj_list(kg_file, args.add_inv_edges)
+    _worker_csr_adj = CSRAdjList.from_adj_list(train_adj_list)
+    del train_adj_list
     logger.info("Done creating...")
     st_time = time.time()
     paths_map = defaultdict(list)
-    for ctr, e1 in enumerate(tqdm(unique_entities)):
-        if st <= ctr < en:
-            paths = get_paths(args, train_adj_list, e1, args.max_len)
-            if paths is None:
-                continue
-            paths_map[e1] = paths
-            if args.use_wandb and (ctr - st) % 100 == 0:
-                wandb.log({"progress": (ctr - st) / num_entities_in_partition})
+    entities_in_partition = [e1 for ctr, e1 in enumerate(unique_entities) if st <= ctr < en]
+    batches = [entities_in_partition[b_st:b_st + args.path_sampling_batch_size]
+               for b_st in range(0, len(entities_in_partition), args.path_sampling_batch_size)]
+    # one independent stream per (job, batch)
+    batch_seeds = np.random.SeedSequence(args.seed, spawn_key=(job_id,)).spawn(len(batches))
+    batch_args = [(args, batch_entities, seed_seq) for batch_entities, seed_seq in zip(batches, batch_seeds)]
+    pool = None
+    if args.num_workers > 1:
+        logger.info("Collecting paths with {} worker processes".format(args.num_workers))
+        pool = multiprocessing.get_context("fork").Pool(args.num_workers)
+        batch_iter = pool.imap_unordered(_get_paths_for_batch, batch_args)
+    else:
+        batch_iter = map(_get_paths_for_batch, batch_args)
+    for batch_paths in tqdm(batch_iter, total=len(batches)):
+        paths_map.update(batch_paths)
+        if args.use_wandb:
+            wandb.log({"progress": len(paths_map) / num_entities_in_partition})
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     logger.info("Took {} seconds to collect paths for {} entities".format(time.time() - st_time, len(paths_map)))
     out_file_name = "paths_" + str(args.num_paths_to_collect) + "_path_len_" + str(args.max_len) + "_" + str(job_id)
@@ -124,9 +187,20 @@ def get_paths_parallel(args, kg_file, out_dir, job_id=0, total_jobs=1):
     fout.close()
 
 
-def combine_precision_maps(args, dir_name, output_dir_name, output_file_name="precision_map.pkl"):
+def get_per_entity_vocab_fingerprint(dir_name: str) -> Dict:
+    """
+    :return: fingerprint of the program vocab the per entity maps in dir_name are keyed by
     """
-    Combines all the individual maps
+    vocab_fingerprint = read_vocab_fingerprint(dir_name)
+    if vocab_fingerprint is None:
+        raise ValueError("The maps in {} were written without a program vocab fingerprint, please compute them "
+                         "again".format(dir_name))
+    return vocab_fingerprint
+
+
+def combine_precision_maps(args, dir_name, output_dir_name, output_file_name="precision_map"):
+    """
+    Combines all the individual maps and writes the precision map as a ScoreTable partitioned per relation
     :param dir_name:
     :return:
     """
@@ -182,8 +256,8 @@ def combine_precision_maps(args, dir_name, output_dir_name, output_file_name="pr
 
     output_filenm = os.path.join(output_dir_name, output_file_name)
     logger.info("Dumping ratio map at {}".format(output_filenm))
-    with open(output_filenm, "wb") as fout:
-        pickle.dump(ratio_map, fout)
+    ScoreTable.from_nested_map(ratio_map).save_partitioned(
+        output_filenm, vocab_fingerprint=get_per_entity_vocab_fingerprint(dir_name))
     logger.info("Done...")
 
 
@@ -192,6 +266,10 @@ def calc_precision_map_parallel(args, dir_name, job_id=0, total_jobs=1):
     Calculates precision of each path wrt a query relation, i.e. ratio of how many times, a path was successful when executed
     to how many times the path was executed.
     Note: In the current implementation, we compute precisions for the paths stored in the path_prior_map
+    Programs are keyed by their id in args.program_vocab
+    The (e1, r) queries are grouped by program and every program is executed once for a batch of
+    args.precision_batch_size queries (see execute_program_batch). Success counts are the non-zeros of the answers
+    multiplied elementwise with the gold answers.
     :return:
     """
     logger.info("Calculating precision map")
@@ -204,12 +282,13 @@ def calc_precision_map_parallel(args, dir_name, job_id=0, total_jobs=1):
     st = job_id * job_size
     en = min((job_id + 1) * job_size, len(train_map))
     logger.info("Start of partition: {}, End of partition: {}".format(st, en))
-    for e_ctr, ((e1, r), e2_list) in tqdm(enumerate(train_map)):
+    queries = []  # (c, r) of the queries of this partition
+    head_ids, gold_rows, gold_cols = [], [], []
+    program_queries = defaultdict(list)  # program -> queries for which the program has to be executed
+    for e_ctr, ((e1, r), e2_list) in enumerate(train_map):
         if e_ctr < st or e_ctr >= en:
             # not this partition
             continue
-        if e_ctr % 100 == 0:
-            logger.info("Processing entity# {}".format(e_ctr))
         c = args.entity_vocab[e1]  # calculate stats for each entity
         if c not in success_map:
             success_map[c] = {}
@@ -219,32 +298,47 @@ def calc_precision_map_parallel(args, dir_name, job_id=0, total_jobs=1):
             success_map[c][r] = {}
         if r not in total_map[c]:
             total_map[c][r] = {}
-        if r in args.path_prior_map_per_entity[c]:
-            paths_for_this_relation = args.path_prior_map_per_entity[c][r]
-        else:
+        if r not in args.path_prior_map_per_entity[c]:
             continue  # if a relation is missing from prior map, then no need to calculate precision for that relation.
-        for p_ctr, (path, _) in enumerate(paths_for_this_relation.items()):
-            ans_vec = execute_one_program(args.sparse_adj_mats, args.entity_vocab, e1, path)
-            ans = [args.rev_entity_vocab[d_e] for d_e in np.nonzero(ans_vec)[0]]
-            if len(ans) == 0:
-                continue
+        q_ctr = len(queries)
+        queries.append((c, r))
+        head_ids.append(args.entity_vocab[e1])
+        for e2 in set(e2_list):
+            gold_rows.append(args.entity_vocab[e2])
+            gold_cols.append(q_ctr)
+        for path in args.path_prior_map_per_entity[c][r]:
+            program_queries[path].append(q_ctr)
+    head_ids = np.array(head_ids, dtype=np.int64)
+    gold_mat = scipy.sparse.csc_matrix((np.ones(len(gold_rows), dtype=np.uint32), (gold_rows, gold_cols)),
+                                       shape=(len(args.entity_vocab), len(queries)))
+    logger.info("Executing {} programs for {} queries".format(len(program_queries), len(queries)))
+    for path, path_queries in tqdm(program_queries.items()):
+        relations = args.program_vocab.get_program(path)
+        path_queries = np.array(path_queries, dtype=np.int64)
+        for b_st in range(0, path_queries.shape[0], args.precision_batch_size):
+            batch_queries = path_queries[b_st:b_st + args.precision_batch_size]
             # execute the path get answer
-            if path not in success_map[c][r]:
-                success_map[c][r][path] = 0
-            if path not in total_map[c][r]:
-                total_map[c][r][path] = 0
-            for a in ans:
-                if a in e2_list:
-                    success_map[c][r][path] += 1
-                total_map[c][r][path] += 1
+            ans_mat = execute_program_batch(args.sparse_adj_mats, head_ids[batch_queries], relations)
+            ans_mat.eliminate_zeros()
+            ans_mat.data[:] = 1
+            total_counts = np.asarray(ans_mat.sum(axis=0)).reshape(-1)
+            success_counts = np.asarray(ans_mat.multiply(gold_mat[:, batch_queries]).sum(axis=0)).reshape(-1)
+            for q_ctr, success_count, total_count in zip(batch_queries.tolist(), success_counts.tolist(),
+                                                         total_counts.tolist()):
+                if total_count == 0:
+                    continue
+                c, r = queries[q_ctr]
+                success_map[c][r][path] = success_map[c][r].get(path, 0) + int(success_count)
+                total_map[c][r][path] = total_map[c][r].get(path, 0) + int(total_count)
     output_filenm = os.path.join(dir_name, "{}_precision_map.pkl".format(job_id))
     logger.info("Dumping precision map at {}".format(output_filenm))
     with open(output_filenm, "wb") as fout:
         pickle.dump({"numerator_map": success_map, "denominator_map": total_map}, fout)
+    write_vocab_fingerprint(dir_name, args.program_vocab.get_fingerprint())
     logger.info("Done...")
 
 
-def combine_prior_maps(args, dir_name, output_dir, output_file_name="path_prior_map.pkl"):
+def combine_prior_maps(args, dir_name, output_dir, output_file_name="path_prior_map"):
     all_program_maps = []
     combined_program_maps = {}
     logger.info("Combining prior maps located in {}".format(dir_name))
@@ -278,8 +372,38 @@ def combine_prior_maps(args, dir_name, output_dir, output_file_name="path_prior_
 
     output_filenm = os.path.join(output_dir, output_file_name)
     logger.info("Dumping ratio map at {}".format(output_filenm))
-    with open(output_filenm, "wb") as fout:
-        pickle.dump(combined_program_maps, fout)
+    ScoreTable.from_nested_map(combined_program_maps).save_partitioned(
+        output_filenm, vocab_fingerprint=get_per_entity_vocab_fingerprint(dir_name))
+    logger.info("Done...")
+
+
+def combine_ranked_programs(args, dir_name, fallback_dir_name, output_dir, output_file_name="ranked_programs"):
+    """
+    Merges the combined prior and precision maps of the clusters (dir_name) with the ones of the single cluster
+    (fallback_dir_name) into the programs of every (cluster, relation) sorted by score, see RankedProgramTable.
+    """
+    path_dir_name = "path_{}".format(args.num_paths_to_collect)
+    score_tables = {}
+    for map_dir, key in [(dir_name, ""), (fallback_dir_name, "_fallback")]:
+        score_tables["prior_map" + key] = load_score_table(os.path.join(map_dir, "prior_maps", path_dir_name),
+                                                           "path_prior_map")
+        score_tables["precision_map" + key] = load_score_table(os.path.join(map_dir, "precision_maps", path_dir_name),
+                                                               "precision_map")
+    assert score_tables["precision_map"] is not None and score_tables["precision_map_fallback"] is not None
+    # all the maps have to be keyed by the same program ids (load_score_table checked that they have a fingerprint)
+    vocab_fingerprints = [table.vocab_fingerprint for table in score_tables.values() if table is not None]
+    if any([fingerprint != vocab_fingerprints[0] for fingerprint in vocab_fingerprints]):
+        raise ValueError("The prior/precision maps in {} and {} were written for different program vocabs".format(
+            dir_name, fallback_dir_name))
+    relations = sorted(set(r for table in score_tables.values() if table is not None for r in table.relation_names))
+    logger.info("Ranking the programs of {} relations".format(len(relations)))
+    ranked_programs = build_ranked_programs(relations, score_tables["precision_map"],
+                                            score_tables["precision_map_fallback"], score_tables["prior_map"],
+                                            score_tables["prior_map_fallback"],
+                                            use_prior=not args.use_only_precision_scores)
+    output_filenm = os.path.join(output_dir, output_file_name)
+    logger.info("Dumping ranked programs at {}".format(output_filenm))
+    save_partitioned(ranked_programs, output_filenm, vocab_fingerprint=vocab_fingerprints[0])
     logger.info("Done...")
 
 
@@ -288,10 +412,12 @@ def calc_prior_path_prob_parallel(args, output_dir_name, job_id=0, total_jobs=1)
     Calculate how probable a path is given a query relation, i.e P(path|query rel)
     For each entity in the graph, count paths that exists for each relation in the
     random subgraph.
+    Programs are keyed by their id in args.all_paths.program_vocab
     :return:
     """
     logger.info("Calculating prior map")
     programs_map = {}
+    program_vocab = args.all_paths.program_vocab
     job_size = len(args.train_map) / total_jobs
     st = job_id * job_size
     en = min((job_id + 1) * job_size, len(args.train_map))
@@ -310,15 +436,12 @@ def calc_prior_path_prob_parallel(args, output_dir_name, job_id=0, total_jobs=1)
             programs_map[c] = {}
         if r not in programs_map[c]:
             programs_map[c][r] = {}
-        all_paths_around_e1 = args.all_paths[e1]
         nn_answers = e2_list
         for nn_ans in nn_answers:
-            programs = get_programs(e1, nn_ans, all_paths_around_e1)
+            programs = args.all_paths.get_program_ids(e1, nn_ans).tolist()
             for p in programs:
-                p = tuple(p)
-                if len(p) == 1:
-                    if p[0] == r:  # don't store query relation
-                        continue
+                if program_vocab.is_query_relation(p, r):  # don't store query relation
+                    continue
                 if p not in programs_map[c][r]:
                     programs_map[c][r][p] = 0
                 programs_map[c][r][p] += 1
@@ -328,19 +451,38 @@ def calc_prior_path_prob_parallel(args, output_dir_name, job_id=0, total_jobs=1)
 
     with open(output_filenm, "wb") as fout:
         pickle.dump(programs_map, fout)
+    write_vocab_fingerprint(output_dir_name, program_vocab.get_fingerprint())
 
     logger.info("Done...")
 
 
-def calc_sim(adj_mat: torch.Tensor, query_entities: torch.LongTensor) -> torch.Tensor:
+def get_sim_batch_size(num_entities: int, memory_mb: float, itemsize: int = 8) -> int:
     """
-    :param adj_mat: N X R
-    :param query_entities: b is a batch of indices of query entities
-    :return:
+    Number of query entities whose similarities (batch X num_entities) and top-k selection fit in memory_mb.
     """
-    query_entities_vec = torch.index_select(adj_mat, dim=0, index=query_entities)
-    sim = torch.matmul(query_entities_vec, torch.t(adj_mat))
-    return sim
+    bytes_per_query = num_entities * itemsize * 2  # similarities + top-k workspace
+    return max(1, int(memory_mb * 1024 * 1024 // bytes_per_query))
+
+
+def calc_top_k_sim(adj_mat: scipy.sparse.csr_matrix, query_entities: np.ndarray, k: int, batch_size: int) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top k most similar entities of every query entity, computed batch_size queries at a time. The similarities of a
+    batch come from a sparse X sparse product, only their top k (torch.topk) are written into the preallocated outputs.
+    :param adj_mat: N X R normalized sparse matrix
+    :return: similarities (n X k, sorted by decreasing similarity) and the entity ids they belong to
+    """
+    num_queries, num_entities = query_entities.shape[0], adj_mat.shape[0]
+    k = min(k, num_entities)
+    sim = torch.zeros((num_queries, k), dtype=torch.float64)
+    arg_sim = torch.zeros((num_queries, k), dtype=torch.long)
+    for st in range(0, num_queries, batch_size):
+        en = min(st + batch_size, num_queries)
+        logger.info("st: {}, en: {}, query_ind.shape[0]: {}".format(st, en, num_queries))
+        # n X N (n: batch of query entities, N: all entities)
+        batch_sim = torch.from_numpy(calc_sparse_sim(adj_mat, query_entities[st:en]))
+        sim[st:en], arg_sim[st:en] = torch.topk(batch_sim, k, dim=-1, sorted=True)
+    return sim.numpy(), arg_sim.numpy()
 
 
 if __name__ == '__main__':
@@ -356,18 +498,34 @@ if __name__ == '__main__':
                         help="Useful to switch between test files for FB122")
     parser.add_argument("--sim_batch_size", type=int, default=128,
                         help="Batch size to use when doing ent-ent similarity")
+    parser.add_argument("--sim_memory_mb", type=float, default=0,
+                        help="If set, the number of query entities per similarity batch is chosen to fit this budget "
+                             "(instead of --sim_batch_size)")
     parser.add_argument("--k_adj", type=int, default=100,
                         help="Number of nearest neighbors to consider based on adjacency matrix")
+    parser.add_argument("--ann_num_lists", type=int, default=0,
+                        help="If set, neighbors are searched in an approximate (IVF) index with this many k-means "
+                             "lists instead of computing the similarities to all the entities")
+    parser.add_argument("--ann_nprobe", type=int, default=8,
+                        help="Number of lists of the approximate index searched per query")
+    parser.add_argument("--ann_recall_queries", type=int, default=0,
+                        help="If set, recall@k_adj of the approximate index against the exact search is logged on "
+                             "this many query entities")
     # properties of paths
     parser.add_argument("--num_paths_to_collect", type=int, default=1000)
     parser.add_argument("--max_len", type=int, default=4)
     parser.add_argument("--prevent_loops", type=int, choices=[0, 1], default=1, help="prevent sampling of looped paths")
     parser.add_argument("--add_inv_edges", action="store_true")
+    parser.add_argument("--path_sampling_batch_size", type=int, default=64,
+                        help="Number of entities whose random walks are advanced together when collecting paths")
     # preprocessing args
     parser.add_argument("--create_vocab", action="store_true")
     parser.add_argument("--combine_paths", action="store_true")
     parser.add_argument("--calculate_precision_map_parallel", action="store_true",
                         help="If on, calculate precision maps")
+    parser.add_argument("--precision_batch_size", type=int, default=4096,
+                        help="Max number of queries a program is executed for in one sparse matrix product when "
+                             "calculating precision maps")
     parser.add_argument("--calculate_prior_map_parallel", action="store_true",
                         help="If on, calculate precision maps")
     parser.add_argument("--calculate_ent_similarity", action="store_true",
@@ -378,12 +536,20 @@ if __name__ == '__main__':
                         help="If on, combine precision maps")
     parser.add_argument("--combine_prior_map", action="store_true",
                         help="If on, combine prior maps")
+    parser.add_argument("--build_ranked_programs", action="store_true",
+                        help="If on, sort the programs of every (cluster, relation) by their combined score")
+    parser.add_argument("--use_only_precision_scores", type=int, choices=[0, 1], default=0,
+                        help="Rank the programs by precision only (same as the inference flag)")
     parser.add_argument("--do_clustering", action="store_true")
     # parallel jobs
     parser.add_argument("--total_jobs", type=int, default=50,
                         help="Total number of jobs")
     parser.add_argument("--current_job", type=int, default=0,
                         help="Current job id")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Number of worker processes used to collect paths within a job")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for path sampling. Paths are reproducible for a fixed seed and batch size")
     parser.add_argument("--name_of_run", type=str, default="unset")
     # Clustering args
     parser.add_argument("--linkage", type=float, default=0.8,
@@ -467,49 +633,37 @@ if __name__ == '__main__':
     args.train_map = train_map
     args.dev_map = dev_map
     args.test_map = test_map
+    if args.combine_paths:
+        logger.info("Combining path splits into a path store")
+        file_prefix = "paths_{}_path_len_{}_".format(args.num_paths_to_collect, args.max_len)
+        path_store = PathStore.from_path_splits(get_path_split_file_names(subgraph_dir, file_prefix), entity_vocab,
+                                                rel_vocab, args.max_len)
+        store_dir = get_path_store_dir(subgraph_dir, args.max_len)
+        logger.info("Saving path store at {}".format(store_dir))
+        path_store.save(store_dir)
+        sys.exit(0)
     adj_mat = get_adj_mat(kg_file, entity_vocab, rel_vocab)
     logger.info("Building sparse adjacency matrices")
     args.sparse_adj_mats = create_sparse_adj_mats(args.train_map, args.entity_vocab, args.rel_vocab)
     if args.calculate_ent_similarity:
         logger.info("Calculating entity similarity matrix...")
-        adj_mat = torch.from_numpy(adj_mat)
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        print(device)
-        logger.info('Using device: {}'.format(device.__str__()))
-        adj_mat = adj_mat.to(device)
-        # Changed
-        adj_mat= adj_mat.cpu()
         query_ind = []
         for i in range(len(eval_vocab)):
             query_ind.append(entity_vocab[eval_rev_vocab[i]])
-        query_ind = torch.LongTensor(query_ind).to(device)
-        # Changed
-        query_ind = query_ind.cpu()
-        # Calculate similarity
-        st = 0
-        sim = None
-        arg_sim = None
-        batch_sim, batch_sim_ind = None, None
-        while st < query_ind.shape[0]:
-            en = min(st + args.sim_batch_size, query_ind.shape[0])
-            logger.info("st: {}, en: {}, query_ind.shape[0]: {}".format(st, en, query_ind.shape[0]))
-            batch_sim = calc_sim(adj_mat, query_ind[st:en])  # n X N (n== size of dev_entities, N: size of all entities)
-            #batch_sim_sorted = np.sort(-batch_sim, axis=-1)
-            #batch_sim = batch_sim.detach().cpu().numpy()
-            batch_sim_ind = np.argsort(-batch_sim, axis=-1)
-            batch_sim_ind = batch_sim_ind[:, :args.k_adj]
-            batch_sim_sorted = None
-            for i in range(batch_sim.shape[0]):
-                batch_sim_sorted = batch_sim[i, batch_sim_ind[i, :]] if batch_sim_sorted is None else np.vstack(
-                    [batch_sim_sorted, batch_sim[i, batch_sim_ind[i, :]]])
-            if sim is None:
-                sim = batch_sim_sorted
-                arg_sim = batch_sim_ind
-            else:
-                sim = np.vstack([sim, batch_sim_sorted])
-                arg_sim = np.vstack([arg_sim, batch_sim_ind])
-            st = en
+        query_ind = np.array(query_ind, dtype=np.int64)
         dir_name = os.path.join(args.data_dir, "data", args.dataset_name)
+        # Calculate similarity
+        if args.ann_num_lists > 0:
+            logger.info("Searching neighbors in an IVF index with {} lists".format(args.ann_num_lists))
+            nn_index = IVFIndex.build(adj_mat, args.ann_num_lists, nprobe=args.ann_nprobe)
+            nn_index.save(os.path.join(dir_name, "nn_index"))
+            if args.ann_recall_queries > 0:
+                report_recall(nn_index, query_ind[:args.ann_recall_queries], args.k_adj)
+            sim, arg_sim = nn_index.search_ids(query_ind, args.k_adj)
+        else:
+            batch_size = args.sim_batch_size if args.sim_memory_mb <= 0 else \
+                get_sim_batch_size(adj_mat.shape[0], args.sim_memory_mb, adj_mat.dtype.itemsize)
+            sim, arg_sim = calc_top_k_sim(adj_mat, query_ind, args.k_adj, batch_size)
         ent_sim_dict_file = os.path.join(dir_name, "ent_sim.pkl")
         logger.info("Writing {}".format(ent_sim_dict_file))
         with open(ent_sim_dict_file, "wb") as fout:
@@ -555,7 +709,7 @@ if __name__ == '__main__':
             "Calculating prior map. Current job id: {}, Total jobs: {}".format(args.current_job, args.total_jobs))
         logger.info("Loading subgraph around entities:")
         file_prefix = "paths_{}_path_len_{}_".format(args.num_paths_to_collect, args.max_len)
-        all_paths = combine_path_splits(subgraph_dir, file_prefix=file_prefix)
+        all_paths = load_path_store(subgraph_dir, file_prefix, entity_vocab, rel_vocab, args.max_len)
         logger.info("Done...")
         args.all_paths = all_paths
         assert args.all_paths is not None
@@ -588,6 +742,10 @@ if __name__ == '__main__':
         per_entity_prior_map_dir = os.path.join(dir_name, "prior_maps", "path_{}".format(args.num_paths_to_collect))
         args.path_prior_map_per_entity = combine_path_splits(per_entity_prior_map_dir)
         assert args.path_prior_map_per_entity is not None
+        # the prior maps are keyed by program ids of the path store
+        file_prefix = "paths_{}_path_len_{}_".format(args.num_paths_to_collect, args.max_len)
+        args.program_vocab = load_path_store(subgraph_dir, file_prefix, entity_vocab, rel_vocab, args.max_len,
+                                             mmap_mode="r").program_vocab
         dir_name = os.path.join(dir_name, "precision_maps", "path_{}".format(args.num_paths_to_collect))
         if not os.path.exists(dir_name):
             os.makedirs(dir_name)
@@ -601,4 +759,13 @@ if __name__ == '__main__':
                                        "path_{}".format(args.num_paths_to_collect))
         if not os.path.exists(output_dir_name):
             os.makedirs(output_dir_name)
-        combine_precision_maps(args, dir_name, output_dir_name)
\ No newline at end of file
+        combine_precision_maps(args, dir_name, output_dir_name)
+
+    if args.build_ranked_programs:
+        # needs the combined prior and precision maps of this linkage and of linkage=0.0 (the fall-back)
+        dir_name = os.path.join(args.data_dir, "data", args.dataset_name, "linkage={}".format(args.linkage))
+        output_dir_name = os.path.join(dir_name, "ranked_programs", "path_{}".format(args.num_paths_to_collect))
+        if not os.path.exists(output_dir_name):
+            os.makedirs(output_dir_name)
+        combine_ranked_programs(args, dir_name, os.path.join(args.data_dir, "data", args.dataset_name, "linkage=0.0"),
+                                output_dir_name)
@@ -5,13 +5,19 @@ import os
 from tqdm import tqdm, trange
 from collections import defaultdict
 import pickle
-import torch
+import scipy.sparse
 import uuid
-from prob_cbr.data.data_utils import load_data_from_triples, get_unique_entities_from_triples, \
+from src.prob_cbr.data.data_utils import load_data_from_triples, get_unique_entities_from_triples, \
     read_graph_from_triples, get_entities_group_by_relation_from_triples, get_inv_relation, create_adj_list_from_triples
-from prob_cbr.data.stream_utils import KBStream
-from prob_cbr.data.get_paths import get_paths
-from prob_cbr.clustering.grinch_with_deletes import GrinchWithDeletes
+from src.prob_cbr.data.stream_utils import KBStream
+from src.prob_cbr.utils import build_answer_index, get_programs_from_index, normalize_adj_mat, calc_sparse_sim
+from src.prob_cbr.data.program_vocab import ProgramVocab, write_vocab_fingerprint
+from src.prob_cbr.data.score_table import ScoreTable, score_programs
+from src.prob_cbr.evaluation import get_known_answer_ids, get_filtered_ranks, get_ranking_metrics
+from src.prob_cbr.aggregation import aggregate_answers
+from src.prob_cbr.neighbors import IVFIndex, RelationEntityIndex, NeighborCache, report_recall
+from src.prob_cbr.data.get_paths import get_paths
+from src.prob_cbr.clustering.grinch_with_deletes import GrinchWithDeletes
 from typing import *
 import logging
 import json
@@ -31,7 +37,8 @@ logger.addHandler(ch)
 
 class ProbCBR(object):
     def __init__(self, args, train_map, eval_map, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab, eval_vocab,
-                 eval_rev_vocab, all_paths, rel_ent_map):
+                 eval_rev_vocab, all_paths, rel_ent_map, answer_index=None,
+                 relation_entities: Optional[RelationEntityIndex] = None):
         self.args = args
         self.eval_map = eval_map
         self.train_map = train_map
@@ -40,44 +47,67 @@ class ProbCBR(object):
         self.entity_vocab, self.rev_entity_vocab, self.rel_vocab, self.rev_rel_vocab = entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab
         self.eval_vocab, self.eval_rev_vocab = eval_vocab, eval_rev_vocab
         self.all_paths = all_paths
+        # map from entity to the answer index of the paths around it (see utils.build_answer_index)
+        self.answer_index = answer_index if answer_index is not None else {}
         self.rel_ent_map = rel_ent_map
         self.num_non_executable_programs = []
         self.query_c = None
         self.nearest_neighbor_1_hop = None
+        self.nn_index = None
+        self.entity_vectors = None
+        self.neighbor_cache = None
+        # entities which have each relation, to search the nearest neighbors among them
+        self.relation_entities = relation_entities if relation_entities is not None else \
+            RelationEntityIndex.from_train_map(train_map, entity_vocab)
 
     def set_nearest_neighbor_1_hop(self, nearest_neighbor_1_hop):
         self.nearest_neighbor_1_hop = nearest_neighbor_1_hop
 
+    def set_nn_index(self, nn_index: IVFIndex):
+        """
+        Neighbors are then searched in the approximate index, per query entity, instead of nearest_neighbor_1_hop
+        """
+        self.nn_index = nn_index
+
+    def set_neighbor_cache(self, neighbor_cache: NeighborCache):
+        """
+        Neighbors of the queries in the cache are read from it, the others are searched as usual
+        """
+        self.neighbor_cache = neighbor_cache
+
+    def set_entity_vectors(self, entity_vectors: scipy.sparse.csr_matrix):
+        """
+        Neighbors are then the exact top k among the entities with the query relation, per query entity
+        """
+        self.entity_vectors = entity_vectors
+
     @staticmethod
-    def calc_sim(adj_mat: Type[torch.Tensor], query_entities: Type[torch.LongTensor]) -> Type[torch.LongTensor]:
+    def calc_sim(adj_mat: scipy.sparse.csr_matrix, query_entities: np.ndarray) -> np.ndarray:
         """
-        :param adj_mat: N X R
+        :param adj_mat: N X R normalized sparse matrix
         :param query_entities: b is a batch of indices of query entities
-        :return:
+        :return: b X N similarities
         """
-        query_entities_vec = torch.index_select(adj_mat, dim=0, index=query_entities)
-        sim = torch.matmul(query_entities_vec, torch.t(adj_mat))
-        return sim
+        return calc_sparse_sim(adj_mat, query_entities)
 
     def get_nearest_neighbor_inner_product(self, e1: str, r: str, k: Optional[int] = 5) -> Union[List[str], None]:
         try:
-            nearest_entities = [self.rev_entity_vocab[e] for e in
-                                self.nearest_neighbor_1_hop[self.eval_vocab[e1]].tolist()]
-            # remove e1 from the set of k-nearest neighbors if it is there.
-            nearest_entities = [nn for nn in nearest_entities if nn != e1]
-            # making sure, that the similar entities also have the query relation
-            ctr = 0
-            temp = []
-            for nn in nearest_entities:
-                if ctr == k:
-                    break
-                if len(self.train_map[nn, r]) > 0:
-                    temp.append(nn)
-                    ctr += 1
-            nearest_entities = temp
+            e1_id = self.entity_vocab[e1]
+            neighbor_ids = self.neighbor_cache.get(e1_id, r, k) if self.neighbor_cache is not None else None
+            if neighbor_ids is None:
+                if self.nn_index is not None:
+                    _, neighbor_ids = self.nn_index.search_ids(np.array([e1_id]), k + 1,
+                                                               allowed=self.relation_entities.get_entities(r))
+                    neighbor_ids = neighbor_ids[0]
+                elif self.entity_vectors is not None:
+                    neighbor_ids = self.relation_entities.top_k(self.entity_vectors, e1_id, r, k)
+                else:
+                    neighbor_ids = self.nearest_neighbor_1_hop[self.eval_vocab[e1]]
         except KeyError:
             return None
-        return nearest_entities
+        # remove e1 and keep the first k neighbors which have the query relation
+        neighbor_ids = self.relation_entities.filter(neighbor_ids, r, k, exclude=e1_id)
+        return [self.rev_entity_vocab[e] for e in neighbor_ids.tolist()]
 
     def get_nearest_neighbor_naive(self, e1: str, r: str, k: Optional[int] = 5) -> List[str]:
         """
@@ -110,6 +140,14 @@ class ProbCBR(object):
                     all_programs.append([x for (x, _) in path[:l + 1]])  # we only need to keep the relations
         return all_programs
 
+    def get_programs_from_answer_index(self, e: str, ans: str):
+        """
+        Same as get_programs(e, ans, self.all_paths[e]), but only visits the paths which reach ans
+        """
+        if e not in self.answer_index:
+            self.answer_index[e] = build_answer_index(self.all_paths[e])
+        return get_programs_from_index(ans, self.answer_index[e])
+
     def get_programs_from_nearest_neighbors(self, e1: str, r: str, nn_func: Callable, num_nn: Optional[int] = 5):
         all_programs = []
         nearest_entities = nn_func(e1, r, k=num_nn)
@@ -120,43 +158,38 @@ class ProbCBR(object):
         zero_ctr = 0
         for e in nearest_entities:
             if len(self.train_map[(e, r)]) > 0:
-                paths_e = self.all_paths[e]  # get the collected 3 hop paths around e
                 nn_answers = self.train_map[(e, r)]
                 for nn_ans in nn_answers:
-                    all_programs += self.get_programs(e, nn_ans, paths_e)
+                    # programs from the collected 3 hop paths around e
+                    all_programs += self.get_programs_from_answer_index(e, nn_ans)
             elif len(self.train_map[(e, r)]) == 0:
                 zero_ctr += 1
         self.all_zero_ctr.append(zero_ctr)
         return all_programs
 
+    def score_programs(self, programs: List[Tuple[str, ...]], r: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Batched lookup of prior * precision of programs in the score tables of the query cluster.
+        :return: scores and a mask of the programs found in the query cluster
+        """
+        program_ids = np.array([self.args.program_vocab.get_id(p) for p in programs], dtype=np.int64)
+        return score_programs(self.query_c, r, program_ids, self.args.precision_table,
+                              self.args.precision_table_fallback, self.args.path_prior_table,
+                              self.args.path_prior_table_fallback)
+
     def rank_programs(self, list_programs: List[str], r: str) -> List[str]:
         """
         Rank programs.
         """
         # sort it by the path score
-        unique_programs = set()
-        for p in list_programs:
-            unique_programs.add(tuple(p))
-        # now get the score of each path
+        unique_programs = sorted(set([tuple(p) for p in list_programs]))
+        # now get the score of each path, falling back to the single cluster maps
+        scores, in_cluster = self.score_programs(unique_programs, r)
         path_and_scores = []
-        for p in unique_programs:
-            try:
-                path_and_scores.append((p, self.args.path_prior_map_per_relation[self.query_c][r][p] *
-                                        self.args.precision_map[self.query_c][r][p]))
-            except KeyError:
-                # TODO: Fix key error
-                if len(p) == 1 and p[0] == r:
-                    continue  # ignore query relation
-                else:
-                    # use the fall back score
-                    try:
-                        c = 0
-                        score = self.args.path_prior_map_per_relation_fallback[c][r][p] * \
-                                self.args.precision_map_fallback[c][r][p]
-                        path_and_scores.append((p, score))
-                    except KeyError:
-                        # still a path or rel is missing.
-                        path_and_scores.append((p, 0))
+        for p, score, found in zip(unique_programs, scores.tolist(), in_cluster.tolist()):
+            if not found and len(p) == 1 and p[0] == r:
+                continue  # ignore query relation
+            path_and_scores.append((p, score))
 
         # sort wrt counts
         sorted_programs = [k for k, v in sorted(path_and_scores, key=lambda item: -item[1])]
@@ -184,64 +217,38 @@ class ProbCBR(object):
             answers += self.execute_one_program(e_next, path, depth + 1, max_branch)
         return answers
 
-    def execute_programs(self, e: str, r: str, path_list: List[List[str]], max_branch: Optional[int] = 1000) -> List[
-        str]:
-
-        def _fall_back(r, p):
-            """
-            When a cluster does not have a query relation (because it was not seen during counting)
-            or if a path is not found, then fall back to no cluster statistics
-            :param r:
-            :param p:
-            :return:
-            """
-            score = 0
-            c = 0  # one cluster for all entity
-            try:
-                score = self.args.path_prior_map_per_relation_fallback[c][r][p] * \
-                        self.args.precision_map_fallback[c][r][p]
-            except KeyError:
-                # either the path or relation is missing from the fall back map as well
-                score = 0
-            return score
+    def execute_programs(self, e: str, r: str, path_list: List[List[str]], max_branch: Optional[int] = 1000) \
+            -> Tuple[List[Tuple[Tuple[np.ndarray, np.ndarray], float, Tuple[str, ...]]], List[Tuple[str, ...]]]:
+        """
+        :return: list of (answers as (entity ids, counts), program score, program), as in pr_cbr10, and the programs
+        without answers
+        """
 
+        if self.args.use_path_counts:
+            # When a cluster does not have a query relation (because it was not seen during counting)
+            # or if a path is not found, then fall back to no cluster statistics
+            path_scores, _ = self.score_programs([tuple(path) for path in path_list], r)
+        else:
+            path_scores = np.ones(len(path_list))
         all_answers = []
         not_executed_paths = []
         execution_fail_counter = 0
         executed_path_counter = 0
-        for path in path_list:
+        for path, path_score in zip(path_list, path_scores.tolist()):
             if executed_path_counter == self.args.max_num_programs:
                 break
             ans = self.execute_one_program(e, path, depth=0, max_branch=max_branch)
-            temp = []
-            for a in ans:
-                path = tuple(path)
-                if self.args.use_path_counts:
-                    try:
-                        if path in self.args.path_prior_map_per_relation[self.query_c][r] and path in \
-                                self.args.precision_map[self.query_c][r]:
-                            temp.append((a,
-                                         self.args.path_prior_map_per_relation[self.query_c][r][path] *
-                                         self.args.precision_map[self.query_c][r][path],
-                                         path))
-                        else:
-                            # logger.info("This path was not there in the cluster for the relation.")
-                            score = _fall_back(r, path)
-                            temp.append((a, score, path))
-                    except KeyError:
-                        # logger.info("Looks like the relation was not found in the cluster, have to fall back")
-                        # fallback to the global scores
-                        score = _fall_back(r, path)
-                        temp.append((a, score, path))
-                else:
-                    temp.append((a, 1, path))
-            ans = temp
-            if ans == []:
+            path = tuple(path)
+            if len(ans) == 0:
                 not_executed_paths.append(path)
                 execution_fail_counter += 1
-            else:
-                executed_path_counter += 1
-            all_answers += ans
+                continue
+            executed_path_counter += 1
+            # entities in the order the search reached them, which is the order ties are ranked in
+            ans_ids, first_idx, ans_counts = np.unique(np.array([self.entity_vocab[a] for a in ans], dtype=np.int64),
+                                                       return_index=True, return_counts=True)
+            order = np.argsort(first_idx)
+            all_answers.append(((ans_ids[order], ans_counts[order]), path_score, path))
             # if len(all_answers) == 0:
             #     all_answers = set(ans)
             # else:
@@ -249,76 +256,23 @@ class ProbCBR(object):
         self.num_non_executable_programs.append(execution_fail_counter)
         return all_answers, not_executed_paths
 
-    def rank_answers(self, list_answers: List[str]) -> List[str]:
+    def get_hits(self, ent_ids: np.ndarray, scores: np.ndarray, gold_answers: List[str], query: Tuple[str, str]) \
+            -> Tuple[float, float, float, float, float]:
         """
-        Different ways to re-rank answers
+        :param ent_ids: predicted entity ids and their scores (see aggregation.aggregate_answers)
+        :return: hits@10, 5, 3, 1 and reciprocal rank, summed over the gold answers, with the other known answers of
+        the query filtered out
         """
-        count_map = {}
-        uniq_entities = set()
-        for e, e_score, path in list_answers:
-            if e not in count_map:
-                count_map[e] = {}
-            if path not in count_map:
-                count_map[e][path] = e_score  # just count once for a path type.
-            uniq_entities.add(e)
-        score_map = defaultdict(int)
-        for e, path_scores_map in count_map.items():
-            sum_path_score = 0
-            for p, p_score in path_scores_map.items():
-                sum_path_score += p_score
-            score_map[e] = sum_path_score
-
-        sorted_entities_by_val = sorted(score_map.items(), key=lambda kv: -kv[1])
-        return sorted_entities_by_val
-
-    @staticmethod
-    def get_rank_in_list(e, predicted_answers):
-        rank = 0
-        for i, e_to_check in enumerate(predicted_answers):
-            if e == e_to_check:
-                return i + 1
-        return -1
-
-    def get_hits(self, list_answers: List[str], gold_answers: List[str], query: Tuple[str, str]) -> Tuple[
-        float, float, float, float]:
-        hits_1 = 0.0
-        hits_3 = 0.0
-        hits_5 = 0.0
-        hits_10 = 0.0
-        rr = 0.0
         (e1, r) = query
-        all_gold_answers = self.args.all_kg_map[(e1, r)]
-        for gold_answer in gold_answers:
-            # remove all other gold answers from prediction
-            filtered_answers = []
-            for pred in list_answers:
-                if pred in all_gold_answers and pred != gold_answer:
-                    continue
-                else:
-                    filtered_answers.append(pred)
-
-            rank = ProbCBR.get_rank_in_list(gold_answer, filtered_answers)
-            if rank > 0:
-                if rank <= 10:
-                    hits_10 += 1
-                    if rank <= 5:
-                        hits_5 += 1
-                        if rank <= 3:
-                            hits_3 += 1
-                            if rank <= 1:
-                                hits_1 += 1
-                rr += 1.0 / rank
-        return hits_10, hits_5, hits_3, hits_1, rr
+        gold_ids = np.array([self.entity_vocab.get(e, -1) for e in gold_answers], dtype=np.int64)
+        known_ids = get_known_answer_ids(self.args.all_kg_map, e1, r, self.entity_vocab)
+        ranks = get_filtered_ranks(ent_ids, scores, gold_ids, known_ids)
+        metrics = get_ranking_metrics(ranks)
+        return metrics["hits_10"], metrics["hits_5"], metrics["hits_3"], metrics["hits_1"], metrics["mrr"]
 
-    @staticmethod
-    def get_accuracy(gold_answers: List[str], list_answers: List[str]) -> List[float]:
-        all_acc = []
-        for gold_ans in gold_answers:
-            if gold_ans in list_answers:
-                all_acc.append(1.0)
-            else:
-                all_acc.append(0.0)
-        return all_acc
+    def get_accuracy(self, gold_answers: List[str], ent_ids: np.ndarray) -> List[float]:
+        gold_ids = np.array([self.entity_vocab.get(e, -1) for e in gold_answers], dtype=np.int64)
+        return np.isin(gold_ids, ent_ids).astype(np.float64).tolist()
 
     def do_symbolic_case_based_reasoning(self):
         num_programs = []
@@ -403,10 +357,11 @@ class ProbCBR(object):
             #     import pdb
             #     pdb.set_trace()
 
-            answers = self.rank_answers(answers)
-            if len(answers) > 0:
-                acc = self.get_accuracy(e2_list, [k[0] for k in answers])
-                _10, _5, _3, _1, rr = self.get_hits([k[0] for k in answers], e2_list, query=(e1, r))
+            # a program counts once for each of its answers, and the scores of the programs are summed
+            ent_ids, scores, _ = aggregate_answers(answers, "none", "sum")
+            if ent_ids.shape[0] > 0:
+                acc = self.get_accuracy(e2_list, ent_ids)
+                _10, _5, _3, _1, rr = self.get_hits(ent_ids, scores, e2_list, query=(e1, r))
                 hits_10 += _10
                 hits_5 += _5
                 hits_3 += _3
@@ -425,7 +380,7 @@ class ProbCBR(object):
             else:
                 acc = [0.0] * len(e2_list)
             all_acc += acc
-            num_answers.append(len(answers))
+            num_answers.append(ent_ids.shape[0])
             # put it back
             self.train_map[(e1, r)] = orig_train_e2_list
             for e2 in e2_list:
@@ -853,10 +808,9 @@ class ProbCBR(object):
                     programs_map[c][r] = {}
                 if r not in programs_map_fallback[0]:
                     programs_map_fallback[0][r] = {}
-                all_paths_around_e1 = self.all_paths[e1]
                 nn_answers = e2_list
                 for nn_ans in nn_answers:
-                    programs = self.get_programs(e1, nn_ans, all_paths_around_e1)
+                    programs = self.get_programs_from_answer_index(e1, nn_ans)
                     for p in programs:
                         p = tuple(p)
                         if len(p) == 1:
@@ -904,10 +858,9 @@ class ProbCBR(object):
                 per_entity_prior_map[e1] = {}
             if r not in per_entity_prior_map[e1]:
                 per_entity_prior_map[e1][r] = {}
-            all_paths_around_e1 = self.all_paths[e1]
             nn_answers = e2_list
             for nn_ans in nn_answers:
-                programs = self.get_programs(e1, nn_ans, all_paths_around_e1)
+                programs = self.get_programs_from_answer_index(e1, nn_ans)
                 for p in programs:
                     p = tuple(p)
                     if len(p) == 1:
@@ -1055,134 +1008,35 @@ class ProbCBR(object):
 
 def main_step(args, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab, adj_mat, train_map, dev_map, dev_entities,
               new_dev_map, new_dev_entities, test_map, test_entities, new_test_map, new_test_entities, all_paths,
-              rel_ent_map):
-    # Lets put adj_mat to GPU
-    adj_mat = torch.from_numpy(adj_mat)
-
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    logger.info(f'Using device: {device.__str__()}')
-    adj_mat = adj_mat.to(device)
-
-    ######################################
-    # Perform evaluation on full dev set #
-    ######################################
+              rel_ent_map, answer_index=None, nn_index=None):
+    eval_sets = []  # (name, eval map, entities of the eval map)
     if not args.only_test:
-        logger.info("Begin evaluation on full dev set ...")
-        eval_map = dev_map
-        # get the unique entities in eval set, so that we can calculate similarity in advance.
-        eval_entities = dev_entities
-        eval_vocab, eval_rev_vocab = {}, {}
-        query_ind = []
-
-        e_ctr = 0
-        for e in eval_entities:
-            try:
-                query_ind.append(entity_vocab[e])
-            except KeyError:
-                continue
-            eval_vocab[e] = e_ctr
-            eval_rev_vocab[e_ctr] = e
-            e_ctr += 1
-
-        prob_cbr_agent = ProbCBR(args, train_map, eval_map, entity_vocab, rev_entity_vocab,
-                                 rel_vocab, rev_rel_vocab, eval_vocab, eval_rev_vocab, all_paths,
-                                 rel_ent_map)
-
-        query_ind = torch.LongTensor(query_ind).to(device)
-        # Calculate similarity
-        sim = prob_cbr_agent.calc_sim(adj_mat,
-                                      query_ind)  # n X N (n== size of dev_entities, N: size of all entities)
-
-        nearest_neighbor_1_hop = np.argsort(-sim.cpu(), axis=-1)
-        prob_cbr_agent.set_nearest_neighbor_1_hop(nearest_neighbor_1_hop)
-
-        prob_cbr_agent.do_symbolic_case_based_reasoning()
-
-    ######################################
-    # Perform evaluation on new dev set #
-    ######################################
-    if not args.only_test and new_dev_map is not None:
-        logger.info("Begin evaluation on new dev set ...")
-        eval_map = new_dev_map
-        # get the unique entities in eval set, so that we can calculate similarity in advance.
-        eval_entities = new_dev_entities
-        eval_vocab, eval_rev_vocab = {}, {}
-        query_ind = []
-
-        e_ctr = 0
-        for e in eval_entities:
-            try:
-                query_ind.append(entity_vocab[e])
-            except KeyError:
-                continue
-            eval_vocab[e] = e_ctr
-            eval_rev_vocab[e_ctr] = e
-            e_ctr += 1
-
-        prob_cbr_agent = ProbCBR(args, train_map, eval_map, entity_vocab, rev_entity_vocab,
-                                 rel_vocab, rev_rel_vocab, eval_vocab, eval_rev_vocab,
-                                 all_paths, rel_ent_map)
-
-        query_ind = torch.LongTensor(query_ind).to(device)
-        # Calculate similarity
-        sim = prob_cbr_agent.calc_sim(adj_mat,
-                                      query_ind)  # n X N (n== size of dev_entities, N: size of all entities)
-
-        nearest_neighbor_1_hop = np.argsort(-sim.cpu(), axis=-1)
-        prob_cbr_agent.set_nearest_neighbor_1_hop(nearest_neighbor_1_hop)
-
-        prob_cbr_agent.do_symbolic_case_based_reasoning()
-
-    #######################################
-    # Perform evaluation on full test set #
-    #######################################
+        eval_sets.append(("full dev", dev_map, dev_entities))
+        if new_dev_map is not None:
+            eval_sets.append(("new dev", new_dev_map, new_dev_entities))
     if args.test:
-        logger.info("Begin evaluation on full test set ...")
-        eval_map = test_map
-        # get the unique entities in eval set, so that we can calculate similarity in advance.
-        eval_entities = test_entities
+        eval_sets.append(("full test", test_map, test_entities))
+        if new_test_map is not None:
+            eval_sets.append(("new test", new_test_map, new_test_entities))
+
+    #########################################################
+    # Nearest neighbors of the queries of all the eval sets #
+    #########################################################
+    relation_entities = RelationEntityIndex.from_train_map(train_map, entity_vocab)
+    queries = {(entity_vocab[e1], r) for _, eval_map, _ in eval_sets for (e1, r) in eval_map.keys()
+               if e1 in entity_vocab}
+    if nn_index is not None and args.ann_recall_queries > 0:
+        query_ind = np.unique(np.array([e1 for e1, _ in queries], dtype=np.int64))
+        report_recall(nn_index, query_ind[:args.ann_recall_queries], args.k_adj)
+    neighbor_cache = NeighborCache.build(queries, args.k_adj, relation_entities, entity_vectors=adj_mat,
+                                         nn_index=nn_index, memory_mb=args.nn_cache_memory_mb)
+
+    for eval_name, eval_map, eval_entities in eval_sets:
+        logger.info(f"Begin evaluation on {eval_name} set ...")
         eval_vocab, eval_rev_vocab = {}, {}
-        query_ind = []
-
         e_ctr = 0
         for e in eval_entities:
-            try:
-                query_ind.append(entity_vocab[e])
-            except KeyError:
-                continue
-            eval_vocab[e] = e_ctr
-            eval_rev_vocab[e_ctr] = e
-            e_ctr += 1
-
-        prob_cbr_agent = ProbCBR(args, train_map, eval_map, entity_vocab, rev_entity_vocab, rel_vocab,
-                                 rev_rel_vocab, eval_vocab, eval_rev_vocab, all_paths, rel_ent_map)
-
-        query_ind = torch.LongTensor(query_ind).to(device)
-        # Calculate similarity
-        sim = prob_cbr_agent.calc_sim(adj_mat,
-                                      query_ind)  # n X N (n== size of dev_entities, N: size of all entities)
-
-        nearest_neighbor_1_hop = np.argsort(-sim.cpu(), axis=-1)
-        prob_cbr_agent.set_nearest_neighbor_1_hop(nearest_neighbor_1_hop)
-
-        prob_cbr_agent.do_symbolic_case_based_reasoning()
-
-    ######################################
-    # Perform evaluation on new test set #
-    ######################################
-    if args.test and new_test_map is not None:
-        logger.info("Begin evaluation on new test set ...")
-        eval_map = new_test_map
-        # get the unique entities in eval set, so that we can calculate similarity in advance.
-        eval_entities = new_test_entities
-        eval_vocab, eval_rev_vocab = {}, {}
-        query_ind = []
-
-        e_ctr = 0
-        for e in eval_entities:
-            try:
-                query_ind.append(entity_vocab[e])
-            except KeyError:
+            if e not in entity_vocab:
                 continue
             eval_vocab[e] = e_ctr
             eval_rev_vocab[e_ctr] = e
@@ -1190,15 +1044,13 @@ def main_step(args, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab, ad
 
         prob_cbr_agent = ProbCBR(args, train_map, eval_map, entity_vocab, rev_entity_vocab,
                                  rel_vocab, rev_rel_vocab, eval_vocab, eval_rev_vocab, all_paths,
-                                 rel_ent_map)
-
-        query_ind = torch.LongTensor(query_ind).to(device)
-        # Calculate similarity
-        sim = prob_cbr_agent.calc_sim(adj_mat,
-                                      query_ind)  # n X N (n== size of dev_entities, N: size of all entities)
-
-        nearest_neighbor_1_hop = np.argsort(-sim.cpu(), axis=-1)
-        prob_cbr_agent.set_nearest_neighbor_1_hop(nearest_neighbor_1_hop)
+                                 rel_ent_map, answer_index, relation_entities=relation_entities)
+        prob_cbr_agent.set_neighbor_cache(neighbor_cache)
+        # for the neighbors which are not cached
+        if nn_index is not None:
+            prob_cbr_agent.set_nn_index(nn_index)
+        else:
+            prob_cbr_agent.set_entity_vectors(adj_mat)
 
         prob_cbr_agent.do_symbolic_case_based_reasoning()
 
@@ -1209,11 +1061,14 @@ class CBRWrapper:
         self.args = args
 
         # Create GRINCH clustering object
-        self.clustering_model = GrinchWithDeletes(np.zeros((total_n_entity, total_n_relation)))
+        self.clustering_model = GrinchWithDeletes(scipy.sparse.csr_matrix((total_n_entity, total_n_relation)))
 
         self.seen_entities = set()
-        self.entity_representation = np.zeros((total_n_entity, total_n_relation))
+        # sparse normalized entity X relation features, GRINCH keeps the sparse row of an entity when it is inserted
+        self.entity_representation = scipy.sparse.csr_matrix((total_n_entity, total_n_relation))
+        self.nn_index = None  # approximate nearest neighbor index, if args.ann_num_lists > 0
         self.all_paths = {}
+        self.answer_index = {}  # map from entity to the answer index of self.all_paths[entity]
         self.per_entity_prior_path_count = {}
         self.per_cluster_path_prior_count, self.per_cluster_path_prior_count_fallback = {}, {}
 
@@ -1223,6 +1078,44 @@ class CBRWrapper:
         self.per_cluster_prec_success_counts_fallback, self.per_cluster_prec_total_counts_fallback = {}, {}
         self.per_cluster_precision_map, self.fallback_precision_map = {}, {}
         self.cluster_assignments = np.zeros(total_n_entity)
+        # programs of the prior and precision score tables used at inference
+        self.args.program_vocab = ProgramVocab(np.zeros((0, 3), dtype=np.int32), [])
+
+    def pad_representation(self, adj_mat: scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+        """
+        :return: adj_mat (entities X relations seen so far) padded with empty rows and columns to the shape of
+        self.entity_representation
+        """
+        adj_mat = scipy.sparse.csr_matrix(adj_mat, copy=True)
+        adj_mat.resize(self.entity_representation.shape)
+        return adj_mat
+
+    def save_score_table(self, nested_map: Dict, dir_name: str, map_name: str) -> ScoreTable:
+        """
+        Writes nested_map to dir_name/<map_name>.npz, keyed by ids of self.args.program_vocab, which is saved next to
+        it with its fingerprint (see load_score_table).
+        :return: the table
+        """
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        table = ScoreTable.from_nested_map(nested_map, self.args.program_vocab)
+        table.vocab_fingerprint = self.args.program_vocab.get_fingerprint()
+        table.save(os.path.join(dir_name, map_name + ".npz"))
+        # programs are only added to the vocab, so the saved vocab also matches the tables written before
+        self.args.program_vocab.save(dir_name)
+        write_vocab_fingerprint(dir_name, table.vocab_fingerprint)
+        return table
+
+    def build_nn_index(self, adj_mat: scipy.sparse.csr_matrix):
+        index_dir = os.path.join(self.args.output_dir, "nn_index")
+        if self.args.warm_start and IVFIndex.exists(index_dir):
+            logger.info("[WARM_START] Load nearest neighbor index")
+            self.nn_index = IVFIndex.load(index_dir)
+            self.nn_index.nprobe = self.args.ann_nprobe
+            return
+        logger.info(f"Build nearest neighbor index with {self.args.ann_num_lists} lists")
+        self.nn_index = IVFIndex.build(adj_mat, self.args.ann_num_lists, nprobe=self.args.ann_nprobe)
+        self.nn_index.save(index_dir)
 
     def process_seed_kb(self, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab,
                         known_true_triples, train_triples, valid_triples, test_triples):
@@ -1271,18 +1164,16 @@ class CBRWrapper:
             with open(os.path.join(self.args.output_dir, f'paths_{self.args.num_paths_to_collect}.pkl'), "wb") as fout:
                 pickle.dump(self.all_paths, fout)
         self.args.all_paths = self.all_paths
+        logger.info("Build answer index of the paths around entities")
+        self.answer_index = {e1: build_answer_index(paths) for e1, paths in self.all_paths.items()}
 
         # 3. Obtain entity cluster assignments
         # Calculate adjacency matrix
         logger.info("Calculate adjacency matrix")
-        adj_mat = read_graph_from_triples(train_triples, entity_vocab, rel_vocab)
-        adj_mat = np.sqrt(adj_mat)
-        l2norm = np.linalg.norm(adj_mat, axis=-1)
-        l2norm = np.clip(l2norm, np.finfo(np.float).eps, None)
-        adj_mat = adj_mat / l2norm.reshape(l2norm.shape[0], 1)
+        adj_mat = normalize_adj_mat(read_graph_from_triples(train_triples, entity_vocab, rel_vocab), use_sqrt=True)
 
         self.seen_entities.update(entity_vocab.keys())
-        self.entity_representation[:len(entity_vocab), :len(rel_vocab)] = adj_mat
+        self.entity_representation = self.pad_representation(adj_mat)
 
         if not self.args.just_preprocess:
             logger.info("Cluster entities")
@@ -1308,9 +1199,12 @@ class CBRWrapper:
             with open(os.path.join(self.args.output_dir, "cluster_assignments.pkl"), "wb") as fout:
                 pickle.dump(self.cluster_assignments, fout)
 
+            if self.args.ann_num_lists > 0:
+                self.build_nn_index(adj_mat)
+
         # 4. Create solver
         prob_cbr_agent = ProbCBR(args, train_map, {}, entity_vocab, rev_entity_vocab, rel_vocab,
-                                 rev_rel_vocab, {}, {}, self.args.all_paths, rel_ent_map)
+                                 rev_rel_vocab, {}, {}, self.args.all_paths, rel_ent_map, self.answer_index)
 
         # 5. Compute path prior map
         if self.args.warm_start:
@@ -1329,18 +1223,14 @@ class CBRWrapper:
                                                                    self.args.cluster_assignments)
 
             dir_name = os.path.join(self.args.output_dir, "t_{}".format(self.args.cluster_threshold))
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
             logger.info("Dumping path prior map at {}".format(dir_name))
-            with open(os.path.join(dir_name, "path_prior_map.pkl"), "wb") as fout:
-                pickle.dump(self.args.path_prior_map_per_relation, fout)
+            self.args.path_prior_table = self.save_score_table(self.args.path_prior_map_per_relation, dir_name,
+                                                               "path_prior_map")
 
             dir_name = os.path.join(self.args.output_dir, "K_1")
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
             logger.info("Dumping fallback path prior map at {}".format(dir_name))
-            with open(os.path.join(dir_name, "path_prior_map.pkl"), "wb") as fout:
-                pickle.dump(self.args.path_prior_map_per_relation_fallback, fout)
+            self.args.path_prior_table_fallback = \
+                self.save_score_table(self.args.path_prior_map_per_relation_fallback, dir_name, "path_prior_map")
 
         # 6. Compute path precision map
         if self.args.warm_start:
@@ -1376,34 +1266,29 @@ class CBRWrapper:
             self.fallback_precision_map = self.args.precision_map_fallback
 
             dir_name = os.path.join(self.args.output_dir, "t_{}".format(self.args.cluster_threshold))
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
             logger.info("Dumping path precision map at {}".format(dir_name))
-            with open(os.path.join(dir_name, "precision_map.pkl"), "wb") as fout:
-                pickle.dump(self.args.precision_map, fout)
+            self.args.precision_table = self.save_score_table(self.args.precision_map, dir_name, "precision_map")
 
             dir_name = os.path.join(self.args.output_dir, "K_1")
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
             logger.info("Dumping path precision map at {}".format(dir_name))
-            with open(os.path.join(dir_name, "precision_map.pkl"), "wb") as fout:
-                pickle.dump(self.args.precision_map_fallback, fout)
+            self.args.precision_table_fallback = self.save_score_table(self.args.precision_map_fallback, dir_name,
+                                                                       "precision_map")
 
         if not self.args.just_preprocess:
             main_step(self.args, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab, adj_mat,
                       train_map, dev_map, dev_entities, None, None, test_map, test_entities, None, None, self.all_paths,
-                      rel_ent_map)
+                      rel_ent_map, self.answer_index, nn_index=self.nn_index)
 
     def process_step(self, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab, known_true_triples,
                      all_train_triples, all_valid_triples, new_valid_triples, all_test_triples, new_test_triples,
                      stream_step):
-        def _get_affected_entities(_e_query, _r_query, _ans, _all_paths_around_e):
+        def _get_affected_entities(_e_query, _r_query, _ans, _answer_index_around_e):
             _affect_set = set()
-            for _path in _all_paths_around_e:
-                for _l, (_r, _e_dash) in enumerate(_path):
-                    if _e_dash == _ans and not (_l == 0 and _r == _r_query) \
-                            and not (_l > 0 and _r == _r_query and _path[_l - 1][1] == _e_query):
-                        _affect_set.update([_x for (_, _x) in _path[:_l + 1]])
+            for _path, _l in _answer_index_around_e.get(_ans, []):
+                _r = _path[_l][0]
+                if not (_l == 0 and _r == _r_query) \
+                        and not (_l > 0 and _r == _r_query and _path[_l - 1][1] == _e_query):
+                    _affect_set.update([_x for (_, _x) in _path[:_l + 1]])
             return _affect_set
 
         def _get_cluster_changes(_old_cluster_assignments, _new_cluster_assignments, _rev_entity_vocab):
@@ -1428,6 +1313,13 @@ class CBRWrapper:
             logger.info(f"{cluster_add_ctr} additions to clusters, {cluster_del_ctr} deletions to clusters")
             return _adds, _dels
 
+        def _get_modified_rows(_new_repr, _old_repr, _rtol=1e-5, _atol=1e-8):
+            # rows which are not np.allclose, without densifying the representations
+            _excess = abs(_new_repr - _old_repr) - _rtol * abs(_old_repr)
+            if _excess.shape[0] == 0:
+                return np.zeros(0, dtype=np.int64)
+            return np.nonzero(np.asarray(_excess.max(axis=1).todense()).reshape(-1) > _atol)[0]
+
         if self.args.just_preprocess and not (self.args.process_num == -1 or self.args.process_num == stream_step):
             # Important for later batches
             self.seen_entities = set(entity_vocab.keys())
@@ -1474,13 +1366,15 @@ class CBRWrapper:
             with open(all_paths_file_nm, "rb") as fin:
                 all_paths_updates = pickle.load(fin)
             self.all_paths.update(all_paths_updates)
+            for e1, paths in all_paths_updates.items():
+                self.answer_index[e1] = build_answer_index(paths)
 
             # Just compute AFFECTED entities set
             logger.info("Find AFFECTED entities around new entities")
             affected_neighbors = set()
             for e1 in tqdm(new_entities):
                 for (r, nn_ans) in train_adj_map[e1]:
-                    affect_ent = _get_affected_entities(e1, r, nn_ans, self.all_paths[e1])
+                    affect_ent = _get_affected_entities(e1, r, nn_ans, self.answer_index[e1])
                     affected_neighbors.update(affect_ent)
             affected_neighbors.difference_update(new_entities)
         else:
@@ -1488,13 +1382,14 @@ class CBRWrapper:
             logger.info("Sample paths around NEW entities")
             for ctr, e1 in enumerate(tqdm(new_entities)):
                 self.all_paths[e1] = get_paths(self.args, train_adj_map, e1, max_len=3)
+                self.answer_index[e1] = build_answer_index(self.all_paths[e1])
 
             # 2.3 Find AFFECTED entities
             logger.info("Find AFFECTED entities around new entities")
             affected_neighbors = set()
             for e1 in tqdm(new_entities):
                 for (r, nn_ans) in train_adj_map[e1]:
-                    affect_ent = _get_affected_entities(e1, r, nn_ans, self.all_paths[e1])
+                    affect_ent = _get_affected_entities(e1, r, nn_ans, self.answer_index[e1])
                     affected_neighbors.update(affect_ent)
             affected_neighbors.difference_update(new_entities)
 
@@ -1502,6 +1397,7 @@ class CBRWrapper:
             logger.info(f"Resample paths around {len(affected_neighbors)} AFFECTED entities")
             for ctr, e1 in enumerate(tqdm(affected_neighbors)):
                 self.all_paths[e1] = get_paths(self.args, train_adj_map, e1, max_len=3)
+                self.answer_index[e1] = build_answer_index(self.all_paths[e1])
 
             all_paths_file_nm = os.path.join(self.args.output_dir, f'paths_{self.args.num_paths_to_collect}.pkl')
             logger.info(f"Dumping collected paths to {all_paths_file_nm}")
@@ -1512,24 +1408,19 @@ class CBRWrapper:
 
         # 3 Obtain entity cluster assignments
         # Calculate adjacency matrix
-        adj_mat = read_graph_from_triples(all_train_triples, entity_vocab, rel_vocab)
-        adj_mat = np.sqrt(adj_mat)
-        l2norm = np.linalg.norm(adj_mat, axis=-1)
-        l2norm = np.clip(l2norm, np.finfo(np.float).eps, None)
-        adj_mat = adj_mat / l2norm.reshape(l2norm.shape[0], 1)
+        adj_mat = normalize_adj_mat(read_graph_from_triples(all_train_triples, entity_vocab, rel_vocab),
+                                    use_sqrt=True)
 
         if not self.args.just_preprocess:
             # 3.1 Find MODIFIED entities whose repr changed
-            modified_entities = list()
-            modified_entity_idx = list()
-            for idx, row in enumerate(adj_mat[:len(self.seen_entities)]):
-                if not np.allclose(row, self.entity_representation[idx][:len(rel_vocab)]):
-                    modified_entities.append(rev_entity_vocab[idx])
-                    modified_entity_idx.append(idx)
+            num_seen = len(self.seen_entities)
+            modified_entity_idx = _get_modified_rows(adj_mat[:num_seen],
+                                                     self.entity_representation[:num_seen, :len(rel_vocab)]).tolist()
+            modified_entities = [rev_entity_vocab[idx] for idx in modified_entity_idx]
             logger.info(f"Identified {len(modified_entity_idx)} MODIFIED entities")
 
             # 3.2 Update internal entity representations
-            self.entity_representation[:len(entity_vocab), :len(rel_vocab)] = adj_mat
+            self.entity_representation = self.pad_representation(adj_mat)
 
             # 3.3 Delete MODIFIED entities
             logger.info("Delete MODIFIED entities")
@@ -1547,6 +1438,11 @@ class CBRWrapper:
             assert new_entity_idx == np.arange(len(self.seen_entities), len(entity_vocab)).tolist()
             for idx in tqdm(new_entity_idx):
                 self.clustering_model.insert(idx, self.entity_representation[idx])
+            if self.nn_index is not None:
+                logger.info("Add MODIFIED and NEW entities to the nearest neighbor index")
+                changed_entity_idx = np.array(modified_entity_idx + new_entity_idx, dtype=np.int64)
+                self.nn_index.add(adj_mat[changed_entity_idx], changed_entity_idx)
+                self.nn_index.save(os.path.join(self.args.output_dir, "nn_index"))
 
             new_cluster_assignments = self.clustering_model.flat_clustering(threshold=self.args.cluster_threshold)
             new_cluster_assignments = new_cluster_assignments.astype(int)
@@ -1590,7 +1486,7 @@ class CBRWrapper:
 
         # 4. Create solver
         prob_cbr_agent = ProbCBR(args, train_map, {}, entity_vocab, rev_entity_vocab, rel_vocab,
-                                 rev_rel_vocab, {}, {}, self.args.all_paths, rel_ent_map)
+                                 rev_rel_vocab, {}, {}, self.args.all_paths, rel_ent_map, self.answer_index)
 
         # 5. Compute path prior map
         # 5.1 Compute path prior map for NEW and AFFECTED entities
@@ -1623,18 +1519,14 @@ class CBRWrapper:
 
             # dir_name = os.path.join(self.args.output_dir, "K_{}".format(self.args.num_clusters))
             dir_name = os.path.join(self.args.output_dir, "t_{}".format(self.args.cluster_threshold))
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
             logger.info("Dumping path prior map at {}".format(dir_name))
-            with open(os.path.join(dir_name, "path_prior_map.pkl"), "wb") as fout:
-                pickle.dump(self.args.path_prior_map_per_relation, fout)
+            self.args.path_prior_table = self.save_score_table(self.args.path_prior_map_per_relation, dir_name,
+                                                               "path_prior_map")
 
             dir_name = os.path.join(self.args.output_dir, "K_1")
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
             logger.info("Dumping fallback path prior map at {}".format(dir_name))
-            with open(os.path.join(dir_name, "path_prior_map.pkl"), "wb") as fout:
-                pickle.dump(self.args.path_prior_map_per_relation_fallback, fout)
+            self.args.path_prior_table_fallback = \
+                self.save_score_table(self.args.path_prior_map_per_relation_fallback, dir_name, "path_prior_map")
 
         # 6. Compute path precision map
         # 6.1 Compute path precision map for NEW and AFFECTED entities
@@ -1692,25 +1584,21 @@ class CBRWrapper:
 
             # dir_name = os.path.join(self.args.output_dir, "K_{}".format(self.args.num_clusters))
             dir_name = os.path.join(self.args.output_dir, "t_{}".format(self.args.cluster_threshold))
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
             logger.info("Dumping path precision map at {}".format(dir_name))
-            with open(os.path.join(dir_name, "precision_map.pkl"), "wb") as fout:
-                pickle.dump(self.args.precision_map, fout)
+            self.args.precision_table = self.save_score_table(self.args.precision_map, dir_name, "precision_map")
 
             dir_name = os.path.join(self.args.output_dir, "K_1")
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
             logger.info("Dumping path precision map at {}".format(dir_name))
-            with open(os.path.join(dir_name, "precision_map.pkl"), "wb") as fout:
-                pickle.dump(self.args.precision_map_fallback, fout)
+            self.args.precision_table_fallback = self.save_score_table(self.args.precision_map_fallback, dir_name,
+                                                                       "precision_map")
 
         self.seen_entities.update(entity_vocab.keys())
 
         if not self.args.just_preprocess:
             main_step(self.args, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab, adj_mat,
                       train_map, dev_map, dev_entities, new_dev_map, new_dev_entities, test_map, test_entities,
-                      new_test_map, new_test_entities, self.all_paths, rel_ent_map)
+                      new_test_map, new_test_entities, self.all_paths, rel_ent_map, self.answer_index,
+                      nn_index=self.nn_index)
 
 
 def main(args):
@@ -1764,6 +1652,17 @@ if __name__ == '__main__':
     parser.add_argument("--k_adj", type=int, default=5,
                         help="Number of nearest neighbors to consider based on adjacency matrix")
     parser.add_argument("--max_num_programs", type=int, default=1000)
+    parser.add_argument("--ann_num_lists", type=int, default=0,
+                        help="If set, neighbors are searched in an approximate (IVF) index with this many k-means "
+                             "lists instead of sorting the similarities to all the entities")
+    parser.add_argument("--ann_nprobe", type=int, default=8,
+                        help="Number of lists of the approximate index searched per query")
+    parser.add_argument("--ann_recall_queries", type=int, default=0,
+                        help="If set, recall@k_adj of the approximate index against the exact search is logged on "
+                             "this many query entities of every eval set")
+    parser.add_argument("--nn_cache_memory_mb", type=float, default=1024,
+                        help="Memory budget of the similarities computed at once when caching the nearest neighbors "
+                             "of the queries of a stream step")
     # Output modifier args
     parser.add_argument("--name_of_run", type=str, default="unset")
     parser.add_argument("--print_paths", action="store_true")
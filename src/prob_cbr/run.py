@@ -1,11 +1,11 @@
-import os
 import sys
-import pandas as pd
+import json
+from urllib.parse import urlencode
+from urllib.error import HTTPError
+from urllib.request import urlopen
 
-data_graph = pd.read_csv("/home/msinha/ProbCBRforMRN/prob-cbr-data/data/MRN_ind_with_CtD_len4/graph.txt", sep="\t", names=['e1','r','e2'])
-data_test = pd.read_csv("/home/msinha/ProbCBRforMRN/prob-cbr-data/data/MRN_ind_with_CtD_len4/test.txt", sep="\t", names=['e1','r','e2'])
-
-data = data_graph.append(data_test)
+# the model is kept loaded by src/prob_cbr/server.py, start it once before running this
+server_url = sys.argv[3] if len(sys.argv) > 3 else "http://127.0.0.1:8008"
 
 e1 = sys.argv[1]
 rel = sys.argv[2]
@@ -13,14 +13,16 @@ rel = sys.argv[2]
 #e1 = "CHEBI:6640"
 #rel = "indication"
 
-e2 =data[(data.e1==e1) & (data["r"]==rel)].e2.head(1)
-e2=e2.to_string(index=False)
+try:
+    with urlopen("{}/query?{}".format(server_url, urlencode({"e1": e1, "r": rel}))) as response:
+        result = json.loads(response.read().decode("utf-8"))
+except HTTPError as e:
+    if e.code != 400:
+        raise
+    # the model does not know the relation
+    result = None
 
-if e2 == 'Series([], )':
+if result is None:
     print("not found")
 else:
-    with open('/home/msinha/ProbCBRforMRN/prob-cbr-data/data/MRN_ind_with_CtD_len4/test5.txt', 'w') as f:
-        f.write(e1 + "\t" + rel + "\t" + e2)
-    os.system("python /home/msinha/ProbCBRforMRN/src/prob_cbr/pr_cbr10.py --dataset MRN_ind_with_CtD_len4 --data_dir prob-cbr-data/ --expt_dir ../prob-cbr-expts/ --test --test_file_name test5.txt   --max_num_programs 80  --k_adj 10 --linkage 0 --max_num_programs 5000 --max_path_len 4 --prevent_loops 1")
-    
-    
\ No newline at end of file
+    print(json.dumps(result))
@@ -0,0 +1,152 @@
+import os
+import json
+import logging
+import numpy as np
+from tqdm import tqdm
+from typing import *
+from src.prob_cbr.neighbors import NeighborCache
+
+logger = logging.getLogger()
+
+
+def get_screen_block_size(num_entities: int, memory_mb: float) -> int:
+    """
+    Number of head entities scored together, so that the dense block of scores (num_entities X block, float32)
+    and the top-k selection over it fit in memory_mb.
+    """
+    bytes_per_head = num_entities * 4 * 2  # scores + argpartition workspace
+    return max(1, int(memory_mb * 1024 * 1024 // bytes_per_head))
+
+
+def top_k_per_column(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param scores: num_candidates X num_heads
+    :return: top k candidate ids (num_heads X k, sorted by decreasing score, -1 where there are less than k candidates
+    with a positive score) and their scores
+    """
+    if scores.shape[0] == 0:
+        return np.full((scores.shape[1], k), -1, dtype=np.int64), np.zeros((scores.shape[1], k), dtype=scores.dtype)
+    k_eff = min(k, scores.shape[0])
+    top_ids = np.argpartition(-scores, k_eff - 1, axis=0)[:k_eff]
+    top_scores = np.take_along_axis(scores, top_ids, axis=0)
+    order = np.argsort(-top_scores, axis=0, kind="stable")
+    top_ids, top_scores = np.take_along_axis(top_ids, order, axis=0).T, np.take_along_axis(top_scores, order, axis=0).T
+    top_ids = np.where(top_scores > 0, top_ids, -1)
+    if k_eff < k:
+        top_ids = np.hstack([top_ids, np.full((top_ids.shape[0], k - k_eff), -1, dtype=top_ids.dtype)])
+        top_scores = np.hstack([top_scores, np.zeros((top_scores.shape[0], k - k_eff), dtype=top_scores.dtype)])
+    return top_ids, top_scores
+
+
+def screen(prob_cbr_agent, r: str, heads: List[str], top_k: int = 100, memory_mb: float = 1024,
+           candidate_ids: Optional[np.ndarray] = None) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    Scores every head entity against every candidate tail for relation r, with the same prior X precision program
+    scoring as do_symbolic_case_based_reasoning. Heads are processed in blocks (sized by memory_mb); the programs of
+    a block are executed together with sparse products over the relation matrices (see execute_programs_batch), and
+    the scores of the block are accumulated in a dense candidate X head matrix.
+    Only aggr_type2 = sum can be computed this way.
+    The nearest neighbors of the heads which are not in eval_vocab (ent_sim.pkl only has rows for the dev/test
+    entities) are searched among the entities with relation r, with the sparse entity X relation features.
+    :param prob_cbr_agent: ProbCBR with all its maps loaded
+    :param candidate_ids: entity ids which can be answers, all entities if None
+    :return: the heads which have at least one answer, the top_k candidate entity ids of each (-1 padded) and their
+    scores
+    """
+    args = prob_cbr_agent.args
+    per_relation_config = prob_cbr_agent.per_relation_config
+    aggr_type1 = args.aggr_type1 if per_relation_config is None else per_relation_config[r]["aggr_type1"]
+    aggr_type2 = args.aggr_type2 if per_relation_config is None else per_relation_config[r]["aggr_type2"]
+    if aggr_type2 != "sum":
+        raise NotImplementedError("Screening only supports aggr_type2 sum, got {}".format(aggr_type2))
+    if aggr_type1 not in ["none", "sum"]:
+        raise NotImplementedError("{} aggr_type1 is invalid".format(aggr_type1))
+    num_heads = len(heads)
+    heads = [e for e in heads if e in prob_cbr_agent.entity_vocab]
+    if len(heads) < num_heads:
+        logger.info("Skipping {} heads which are not in the entity vocab".format(num_heads - len(heads)))
+    new_heads = [prob_cbr_agent.entity_vocab[e] for e in heads if e not in prob_cbr_agent.eval_vocab]
+    if len(new_heads) > 0:
+        logger.info("Searching the nearest neighbors of {} heads which are not in eval_vocab".format(len(new_heads)))
+        prob_cbr_agent.set_neighbor_cache(NeighborCache.build(
+            [(e1, r) for e1 in new_heads], args.k_adj, prob_cbr_agent.relation_entities,
+            entity_vectors=prob_cbr_agent.get_entity_vectors(), memory_mb=memory_mb))
+    num_entities = len(prob_cbr_agent.entity_vocab)
+    block_size = get_screen_block_size(num_entities, memory_mb)
+    logger.info("Screening {} heads for relation {} in blocks of {}".format(len(heads), r, block_size))
+    all_top_ids, all_top_scores = [], []
+    learnt_programs = {}
+    for b_st in tqdm(range(0, len(heads), block_size)):
+        block_heads = heads[b_st:b_st + block_size]
+        clusters, ranked_programs = [], []
+        for e1 in block_heads:
+            c, programs = prob_cbr_agent.prepare_query(e1, r, [], learnt_programs)
+            clusters.append(c)
+            ranked_programs.append(programs)
+        results = prob_cbr_agent.execute_programs_batch(r, block_heads, clusters, ranked_programs)
+        scores = np.zeros((num_entities, len(block_heads)), dtype=np.float32)
+        for q_ctr, (answers, _) in enumerate(results):
+            for (ans_ids, ans_counts), path_score, _ in answers:
+                if aggr_type1 == "none":
+                    scores[ans_ids, q_ctr] += path_score  # just count once for a path type.
+                else:
+                    scores[ans_ids, q_ctr] += path_score * ans_counts  # aggregate for each path
+        if candidate_ids is not None:
+            scores = scores[candidate_ids]
+        top_ids, top_scores = top_k_per_column(scores, top_k)
+        if candidate_ids is not None:
+            top_ids = np.where(top_ids >= 0, candidate_ids[np.maximum(top_ids, 0)], -1)
+        all_top_ids.append(top_ids)
+        all_top_scores.append(top_scores)
+    if len(all_top_ids) == 0:
+        return heads, np.zeros((0, top_k), dtype=np.int64), np.zeros((0, top_k), dtype=np.float32)
+    top_ids, top_scores = np.vstack(all_top_ids), np.vstack(all_top_scores)
+    # heads without neighbors or without any program which reaches an answer
+    has_answers = top_ids[:, 0] >= 0 if top_k > 0 else np.zeros(len(heads), dtype=bool)
+    if not np.all(has_answers):
+        logger.info("{} of {} heads have no answers, they are not written".format(
+            int((~has_answers).sum()), len(heads)))
+    return [e for e, keep in zip(heads, has_answers.tolist()) if keep], top_ids[has_answers], top_scores[has_answers]
+
+
+def write_screen_results(output_dir: str, r: str, heads: List[str], top_ids: np.ndarray, top_scores: np.ndarray,
+                         rev_entity_vocab: Dict[int, str]):
+    """
+    Writes screen_<r>.npz (heads, top_ids, top_scores, entity_names) and screen_<r>.jsonl, one line per head with its
+    predicted answers.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    entity_names = np.array([rev_entity_vocab[e_ctr] for e_ctr in range(len(rev_entity_vocab))], dtype=str)
+    npz_file_name = os.path.join(output_dir, "screen_{}.npz".format(r))
+    np.savez(npz_file_name, heads=np.array(heads, dtype=str), top_ids=top_ids, top_scores=top_scores,
+             entity_names=entity_names)
+    jsonl_file_name = os.path.join(output_dir, "screen_{}.jsonl".format(r))
+    with open(jsonl_file_name, "w") as fout:
+        for e1, e_top_ids, e_top_scores in zip(heads, top_ids.tolist(), top_scores.tolist()):
+            predicted_answers = [[rev_entity_vocab[e2], score] for e2, score in zip(e_top_ids, e_top_scores) if e2 >= 0]
+            fout.write(json.dumps({"e1": e1, "r": r, "predicted_answers": predicted_answers}) + "\n")
+    logger.info("Screen results written to {} and {}".format(npz_file_name, jsonl_file_name))
+
+
+def run_screen(prob_cbr_agent, args):
+    """
+    Screen mode of pr_cbr10: heads are read from --screen_heads_file (one entity per line) or are all the entities
+    starting with --screen_head_prefix. Candidates can be restricted with --screen_candidate_prefix.
+    """
+    entity_vocab = prob_cbr_agent.entity_vocab
+    if args.screen_heads_file is not None:
+        with open(args.screen_heads_file) as fin:
+            heads = [line.strip() for line in fin if len(line.strip()) > 0]
+    else:
+        heads = sorted([e for e in entity_vocab if e.startswith(args.screen_head_prefix)])
+    candidate_ids = None
+    if args.screen_candidate_prefix is not None:
+        candidate_ids = np.array(sorted([e_id for e, e_id in entity_vocab.items()
+                                         if e.startswith(args.screen_candidate_prefix)]), dtype=np.int64)
+        if candidate_ids.shape[0] == 0:
+            raise ValueError("No entity starts with --screen_candidate_prefix {}".format(args.screen_candidate_prefix))
+    heads, top_ids, top_scores = screen(prob_cbr_agent, args.screen_relation, heads, args.screen_top_k,
+                                        args.screen_memory_mb, candidate_ids)
+    write_screen_results(args.screen_output_dir if args.screen_output_dir is not None else args.expt_dir,
+                         args.screen_relation, heads, top_ids, top_scores, prob_cbr_agent.rev_entity_vocab)
@@ -0,0 +1,387 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+from typing import *
+from src.prob_cbr.pr_cbr10 import get_parser, load_prob_cbr, load_node_names, NODE_NAMES_FILE
+
+logger = logging.getLogger()
+
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed bucket upper bounds, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float]):
+        self.name = name
+        self.description = description
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            b_ctr = 0
+            while b_ctr < len(self.buckets) and value > self.buckets[b_ctr]:
+                b_ctr += 1
+            self.counts[b_ctr] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self) -> List[str]:
+        with self.lock:
+            lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+            cum_count = 0
+            for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+                cum_count += count
+                lines.append("{}_bucket{{le=\"{}\"}} {}".format(self.name, bound, cum_count))
+            lines.append("{}_sum {}".format(self.name, self.sum))
+            lines.append("{}_count {}".format(self.name, self.count))
+        return lines
+
+
+class ServiceMetrics(object):
+    LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+    SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+    def __init__(self):
+        self.queue_depth = 0  # requests waiting to be batched
+        self.in_flight = 0  # requests batched but not answered yet
+        self.lock = threading.Lock()
+        self.latency = Histogram("prob_cbr_request_latency_seconds", "Time from arrival to answer of a query",
+                                 self.LATENCY_BUCKETS)
+        self.queue_wait = Histogram("prob_cbr_queue_wait_seconds", "Time a query waited before its batch started",
+                                    self.LATENCY_BUCKETS)
+        self.batch_size = Histogram("prob_cbr_batch_size", "Number of queries executed together", self.SIZE_BUCKETS)
+        self.queue_depth_seen = Histogram("prob_cbr_queue_depth", "Queue depth when a batch is formed",
+                                          self.SIZE_BUCKETS)
+        self.skipped_programs = Histogram("prob_cbr_skipped_programs",
+                                          "Programs not executed because a query stopped early (--anytime_top_k, "
+                                          "--query_deadline_ms)", [0] + self.SIZE_BUCKETS)
+
+    def add(self, queue_depth: int = 0, in_flight: int = 0):
+        with self.lock:
+            self.queue_depth += queue_depth
+            self.in_flight += in_flight
+
+    def render(self) -> str:
+        with self.lock:
+            lines = ["# TYPE prob_cbr_queue_depth_current gauge", "prob_cbr_queue_depth_current {}".format(
+                self.queue_depth), "# TYPE prob_cbr_in_flight gauge", "prob_cbr_in_flight {}".format(self.in_flight)]
+        for histogram in [self.latency, self.queue_wait, self.batch_size, self.queue_depth_seen,
+                          self.skipped_programs]:
+            lines += histogram.render()
+        return "\n".join(lines) + "\n"
+
+
+class QueryService(object):
+    """
+    Keeps a loaded ProbCBR in memory and answers (e1, r) queries with it.
+    ProbCBR hides the query edges from its train_map while answering, so queries are answered one at a time.
+    """
+
+    def __init__(self, prob_cbr_agent, node_names: Optional[Dict[str, str]] = None, top_k: Optional[int] = None):
+        self.prob_cbr_agent = prob_cbr_agent
+        self.node_names = node_names
+        self.top_k = top_k
+        self.lock = threading.Lock()
+        self.metrics = ServiceMetrics()
+
+    def check_relation(self, r: str):
+        """
+        Raises a ValueError if the model can not answer queries for relation r.
+        """
+        agent = self.prob_cbr_agent
+        if r not in agent.rel_vocab or (agent.per_relation_config is not None and r not in agent.per_relation_config):
+            raise ValueError("Unknown relation {}".format(r))
+
+    def answer(self, e1: str, r: str, top_k: Optional[int] = None) -> Dict:
+        """
+        :return: the query in the format of data.json (see ProbCBR.format_query_result)
+        """
+        self.check_relation(r)
+        arrival = time.monotonic()
+        with self.lock:
+            self.metrics.queue_wait.observe(time.monotonic() - arrival)
+            self.metrics.batch_size.observe(1)
+            num_queries = len(self.prob_cbr_agent.num_skipped_programs)
+            result = self.prob_cbr_agent.answer_query(e1, r, top_k=top_k if top_k is not None else self.top_k,
+                                                      node_names=self.node_names)
+            if len(self.prob_cbr_agent.num_skipped_programs) > num_queries:
+                self.metrics.skipped_programs.observe(self.prob_cbr_agent.num_skipped_programs[-1])
+        self.metrics.latency.observe(time.monotonic() - arrival)
+        return result
+
+    def answer_many(self, queries: List[Tuple[str, str, Optional[int]]]) -> List[Dict]:
+        return [self.answer(e1, r, top_k) for e1, r, top_k in queries]
+
+    def close(self):
+        pass
+
+
+class _Request(object):
+    __slots__ = ["e1", "r", "top_k", "future", "arrival"]
+
+    def __init__(self, e1: str, r: str, top_k: Optional[int]):
+        self.e1, self.r, self.top_k = e1, r, top_k
+        self.future = Future()
+        self.arrival = time.monotonic()
+
+
+class BatchingQueryService(QueryService):
+    """
+    Queues the incoming queries for up to batch_window_ms (counted from the first query of the batch) or until
+    max_batch_size queries are waiting, then groups them by relation. Each group runs on a pool of num_workers
+    threads as one ProbCBR.execute_programs_batch call, so that programs shared by the queries are executed once.
+    Gathering programs (prepare_query) edits train_map and is done under a lock; executing them only reads the
+    adjacency matrices and runs in parallel. Every query is answered through its own future as soon as its scores
+    are aggregated.
+    """
+
+    def __init__(self, prob_cbr_agent, node_names: Optional[Dict[str, str]] = None, top_k: Optional[int] = None,
+                 batch_window_ms: float = 10, max_batch_size: int = 64, num_workers: int = 2):
+        super().__init__(prob_cbr_agent, node_names, top_k)
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def submit(self, e1: str, r: str, top_k: Optional[int] = None) -> Future:
+        self.check_relation(r)
+        request = _Request(e1, r, top_k if top_k is not None else self.top_k)
+        self.metrics.add(queue_depth=1)
+        self.queue.put(request)
+        return request.future
+
+    def answer(self, e1: str, r: str, top_k: Optional[int] = None) -> Dict:
+        return self.submit(e1, r, top_k).result()
+
+    def answer_many(self, queries: List[Tuple[str, str, Optional[int]]]) -> List[Dict]:
+        for _, r, _ in queries:
+            self.check_relation(r)
+        # submit everything first, so that the queries can share batches
+        futures = [self.submit(e1, r, top_k) for e1, r, top_k in queries]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.queue.put(None)
+        self.collector.join()
+        self.pool.shutdown(wait=True)
+
+    def _collect(self):
+        stop = False
+        while not stop:
+            request = self.queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = request.arrival + self.batch_window
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+            self.metrics.queue_depth_seen.observe(len(batch) + self.queue.qsize())
+            self.metrics.add(queue_depth=-len(batch), in_flight=len(batch))
+            requests_by_relation = defaultdict(list)
+            for request in batch:
+                requests_by_relation[request.r].append(request)
+            for r, requests in requests_by_relation.items():
+                self.pool.submit(self._run_batch, r, requests)
+
+    def _run_batch(self, r: str, requests: List[_Request]):
+        agent = self.prob_cbr_agent
+        start = time.monotonic()
+        self.metrics.batch_size.observe(len(requests))
+        try:
+            prepared, e2_lists = [], []  # prepared: (request, cluster, ranked programs)
+            with self.lock:
+                for request in requests:
+                    self.metrics.queue_wait.observe(start - request.arrival)
+                    e2_list = agent.get_known_answers(request.e1, r)
+                    e2_lists.append(e2_list)
+                    if request.e1 in agent.entity_vocab:
+                        c, programs = agent.prepare_query(request.e1, r, e2_list, {})
+                        prepared.append((request, c, programs))
+            if agent.uses_anytime_execution():
+                # the deadline counts from the arrival of the query
+                results = []
+                for request, c, programs in prepared:
+                    deadline = request.arrival + agent.args.query_deadline_ms / 1000 \
+                        if agent.args.query_deadline_ms > 0 else None
+                    answers, not_executed_programs, num_skipped = agent.execute_programs_anytime(
+                        request.e1, r, c, programs, max_branch=agent.args.max_branch,
+                        top_k=agent.get_anytime_top_k(request.top_k), deadline=deadline)
+                    self.metrics.skipped_programs.observe(num_skipped)
+                    results.append((answers, not_executed_programs))
+            elif len(prepared) == 1:
+                request, c, programs = prepared[0]
+                results = [agent.execute_programs(request.e1, r, c, programs, max_branch=agent.args.max_branch)]
+            elif len(prepared) > 1:
+                results = agent.execute_programs_batch(r, [q[0].e1 for q in prepared], [q[1] for q in prepared],
+                                                       [q[2] for q in prepared])
+            else:
+                results = []
+            answers_by_request = {id(request): answers for (request, _, _), (answers, _) in zip(prepared, results)}
+            for request, e2_list in zip(requests, e2_lists):
+                predicted_answers = agent.finish_query(r, answers_by_request[id(request)], request.top_k) \
+                    if id(request) in answers_by_request else {}
+                request.future.set_result(agent.format_query_result(request.e1, r, e2_list, predicted_answers,
+                                                                    request.top_k, self.node_names))
+                self._done(request)
+        except Exception as e:
+            logger.exception("Batch of {} queries for relation {} failed".format(len(requests), r))
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+                    self._done(request)
+
+    def _done(self, request: _Request):
+        self.metrics.add(in_flight=-1)
+        self.metrics.latency.observe(time.monotonic() - request.arrival)
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health
+    GET  /metrics (Prometheus text format)
+    GET  /query?e1=<entity>&r=<relation>[&top_k=<k>]
+    POST /query with a json body {"e1": .., "r": .., "top_k": ..}, or a list of such queries
+    """
+    service = None  # QueryService, set by make_server
+
+    def _send_json(self, code: int, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, e: Exception):
+        logger.exception("Query {} failed".format(self.path))
+        self._send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+    @staticmethod
+    def _parse_query(query: Dict) -> Tuple[str, str, Optional[int]]:
+        if not isinstance(query, dict) or "e1" not in query or "r" not in query:
+            raise ValueError("A query needs e1 and r")
+        return query["e1"], query["r"], int(query["top_k"]) if query.get("top_k") is not None else None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif url.path == "/metrics":
+            body = self.service.metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path == "/query":
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            try:
+                self._send_json(200, self.service.answer(*self._parse_query(query)))
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+            except Exception as e:
+                self._send_error(e)
+        else:
+            self._send_json(404, {"error": "Unknown path {}".format(url.path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/query":
+            self._send_json(404, {"error": "Unknown path {}".format(url.path)})
+            return
+        try:
+            queries = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if isinstance(queries, list):
+                self._send_json(200, self.service.answer_many([self._parse_query(query) for query in queries]))
+            else:
+                self._send_json(200, self.service.answer(*self._parse_query(queries)))
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            self._send_error(e)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        logger.info("{} - {}".format(self.address_string(), format % args))
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def make_server(service: QueryService, host: str = "127.0.0.1", port: int = 8008, unix_socket: Optional[str] = None):
+    handler = type("BoundQueryRequestHandler", (QueryRequestHandler,), {"service": service})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(args):
+    prob_cbr_agent = load_prob_cbr(args)
+    node_names = None
+    if args.node_names_file is not None and os.path.exists(args.node_names_file):
+        node_names = load_node_names(args.node_names_file)
+    if args.batch_window_ms > 0:
+        service = BatchingQueryService(prob_cbr_agent, node_names, args.server_top_k, args.batch_window_ms,
+                                       args.server_max_batch_size, args.server_workers)
+    else:
+        service = QueryService(prob_cbr_agent, node_names, args.server_top_k)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    logger.info("Serving queries on {}".format(args.unix_socket if args.unix_socket is not None
+                                                 else "http://{}:{}".format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--unix_socket", type=str, default=None, help="Serve on this unix socket instead of TCP")
+    parser.add_argument("--node_names_file", type=str, default=NODE_NAMES_FILE,
+                        help="csv with id and name columns, used to name entities in the responses")
+    parser.add_argument("--server_top_k", type=int, default=None,
+                        help="Default number of predicted answers returned per query (all if not set)")
+    parser.add_argument("--batch_window_ms", type=float, default=10,
+                        help="Queue queries for up to this long and execute the ones with the same relation together. "
+                             "0 answers them one by one")
+    parser.add_argument("--server_max_batch_size", type=int, default=64,
+                        help="A batch is started as soon as this many queries are waiting")
+    parser.add_argument("--server_workers", type=int, default=2, help="Number of batches executed in parallel")
+    args = parser.parse_args()
+    args.use_path_counts = (args.use_path_counts == 1)
+    main(args)
@@ -0,0 +1,353 @@
+"""
+A snapshot is a directory with everything load_prob_cbr builds before inference, stored as .npy arrays which are
+memory-mapped at load time:
+    manifest.json: version, config, fingerprints of the input files, content hash of the snapshot files
+    entity_names.npy, relation_names.npy: vocabs (ids are positions), followed by names only seen in the eval maps
+    eval_entities.npy, eval_rows.npy: eval_vocab
+    maps/<name>_*.npy: train_map, eval_map, all_kg_map and rel_ent_map (see pack_list_map)
+    adj/{in,out}_*.npy: the per relation adjacency matrices of ProbCBR and of its ProgramTrieExecutor
+    nearest_neighbors.npy, cluster_assignments.npy
+    paths/: the PathStore
+    score_tables/<name>/: prior and precision maps and ranked programs, partitioned per relation (see
+        score_table.save_partitioned)
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import numpy as np
+import scipy.sparse
+from typing import *
+from src.prob_cbr.data.packed_map import pack_list_map, PackedListMap
+from src.prob_cbr.data.path_store import PathStore
+from src.prob_cbr.data.score_table import PartitionedScoreTable
+from src.prob_cbr.data.ranked_programs import PartitionedRankedProgramTable
+
+logger = logging.getLogger()
+
+SNAPSHOT_VERSION = 3
+MANIFEST_FILE_NAME = "manifest.json"
+PAIR_KEY_MAPS = ["train_map", "eval_map", "all_kg_map"]  # (entity, relation) -> entities
+# args attribute -> class it is loaded with
+SCORE_TABLES = {"path_prior_map_per_relation": PartitionedScoreTable,
+                "path_prior_map_per_relation_fallback": PartitionedScoreTable,
+                "precision_map": PartitionedScoreTable,
+                "precision_map_fallback": PartitionedScoreTable,
+                "ranked_programs": PartitionedRankedProgramTable}
+
+
+def file_sha256(file_name: str) -> str:
+    sha = hashlib.sha256()
+    with open(file_name, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def expand_input_files(input_files: List[str]) -> List[str]:
+    """
+    Directories are replaced by the files they contain.
+    """
+    file_names = []
+    for file_name in input_files:
+        if os.path.isdir(file_name):
+            file_names += sorted([os.path.join(file_name, f) for f in os.listdir(file_name)
+                                  if os.path.isfile(os.path.join(file_name, f))])
+        else:
+            file_names.append(file_name)
+    return file_names
+
+
+def fingerprint_inputs(input_files: List[str]) -> Dict[str, Optional[Dict]]:
+    """
+    :return: file name -> size, modification time and sha256 of the file (None if it does not exist)
+    """
+    fingerprints = {}
+    for file_name in expand_input_files(input_files):
+        if not os.path.exists(file_name):
+            fingerprints[file_name] = None
+            continue
+        stat = os.stat(file_name)
+        fingerprints[file_name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                   "sha256": file_sha256(file_name)}
+    return fingerprints
+
+
+def get_changed_inputs(fingerprints: Dict[str, Optional[Dict]], input_files: List[str]) -> List[str]:
+    """
+    Compares the input files with the fingerprints recorded in a snapshot. Files are only hashed again if their
+    size is the same but their modification time changed.
+    :return: the files which were added, removed or changed since the snapshot was written
+    """
+    file_names = expand_input_files(input_files)
+    changed = sorted(set(file_names).symmetric_difference(fingerprints.keys()))
+    for file_name in file_names:
+        if file_name not in fingerprints:
+            continue
+        fingerprint = fingerprints[file_name]
+        if not os.path.exists(file_name) or fingerprint is None:
+            if os.path.exists(file_name) or fingerprint is not None:
+                changed.append(file_name)
+            continue
+        stat = os.stat(file_name)
+        if stat.st_size != fingerprint["size"]:
+            changed.append(file_name)
+        elif stat.st_mtime_ns != fingerprint["mtime_ns"] and file_sha256(file_name) != fingerprint["sha256"]:
+            changed.append(file_name)
+    return changed
+
+
+def hash_snapshot(snapshot_dir: str, file_names: List[str]) -> str:
+    """
+    sha256 of the snapshot files (relative names and contents).
+    """
+    sha = hashlib.sha256()
+    for file_name in sorted(file_names):
+        sha.update(file_name.encode("utf-8"))
+        sha.update(bytes.fromhex(file_sha256(os.path.join(snapshot_dir, file_name))))
+    return sha.hexdigest()
+
+
+def get_snapshot_files(snapshot_dir: str) -> List[str]:
+    file_names = []
+    for root, _, files in os.walk(snapshot_dir):
+        for f in files:
+            file_name = os.path.relpath(os.path.join(root, f), snapshot_dir)
+            if file_name != MANIFEST_FILE_NAME:
+                file_names.append(file_name)
+    return sorted(file_names)
+
+
+def _pair_key_codec(name_index: Dict[str, int], rel_index: Dict[str, int], names: List[str],
+                    relation_names: List[str]) -> Tuple[Callable[[Tuple[str, str]], int], Callable[[int], Tuple]]:
+    num_relations = len(relation_names)
+
+    def encode_key(key: Tuple[str, str]) -> int:
+        e_ctr, r_ctr = name_index.get(key[0], -1), rel_index.get(key[1], -1)
+        return e_ctr * num_relations + r_ctr if e_ctr >= 0 and r_ctr >= 0 else -1
+
+    def decode_key(code: int) -> Tuple[str, str]:
+        return names[code // num_relations], relation_names[code % num_relations]
+
+    return encode_key, decode_key
+
+
+def _save_csr_stack(dir_name: str, prefix: str, mats: Dict[str, scipy.sparse.csr_matrix], relation_names: List[str]):
+    """
+    Stacks the (num_entities X num_entities) matrix of every relation: the matrix of relation r_ctr has the
+    indptr row r_ctr, and its indices/data start at nnz_offsets[r_ctr].
+    """
+    mats = [mats[r] for r in relation_names]
+    for mat in mats:
+        mat.sum_duplicates()
+    nnz_offsets = np.zeros(len(mats) + 1, dtype=np.int64)
+    np.cumsum([mat.nnz for mat in mats], out=nnz_offsets[1:])
+    # the index dtype scipy would pick, so that the loaded matrices do not need to be converted
+    max_index = max([mat.nnz for mat in mats] + [max(mat.shape) for mat in mats])
+    idx_dtype = np.int32 if max_index < np.iinfo(np.int32).max else np.int64
+    indptr = np.vstack([mat.indptr.astype(idx_dtype) for mat in mats])
+    indices = np.concatenate([mat.indices.astype(idx_dtype) for mat in mats])
+    data = np.concatenate([mat.data for mat in mats])
+    for name, arr in [("indptr", indptr), ("indices", indices), ("data", data), ("nnz_offsets", nnz_offsets)]:
+        np.save(os.path.join(dir_name, "{}_{}.npy".format(prefix, name)), arr, allow_pickle=False)
+
+
+def _load_csr_stack(dir_name: str, prefix: str, relation_names: List[str], num_entities: int,
+                    mmap_mode: Optional[str]) -> Dict[str, scipy.sparse.csr_matrix]:
+    arrays = {name: np.load(os.path.join(dir_name, "{}_{}.npy".format(prefix, name)), mmap_mode=mmap_mode,
+                            allow_pickle=False) for name in ["indptr", "indices", "data", "nnz_offsets"]}
+    nnz_offsets = np.asarray(arrays["nnz_offsets"]).tolist()
+    mats = {}
+    for r_ctr, r in enumerate(relation_names):
+        st, en = nnz_offsets[r_ctr], nnz_offsets[r_ctr + 1]
+        mat = scipy.sparse.csr_matrix((arrays["data"][st:en], arrays["indices"][st:en], arrays["indptr"][r_ctr]),
+                                      shape=(num_entities, num_entities), copy=False)
+        mat.has_canonical_format = True  # saved after sum_duplicates
+        mats[r] = mat
+    return mats
+
+
+def export_snapshot(prob_cbr_agent, snapshot_dir: str, input_files: List[str], config: Dict):
+    """
+    Writes everything a loaded ProbCBR (see pr_cbr10.load_prob_cbr) uses into snapshot_dir.
+    :param input_files: files (or directories) the agent was loaded from, fingerprinted to detect stale snapshots
+    :param config: arguments the loaded data depends on, a snapshot is only used with the same config
+    """
+    args = prob_cbr_agent.args
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    for sub_dir in ["maps", "adj", "score_tables"]:
+        if not os.path.exists(os.path.join(snapshot_dir, sub_dir)):
+            os.makedirs(os.path.join(snapshot_dir, sub_dir))
+    num_entities, num_relations = len(prob_cbr_agent.entity_vocab), len(prob_cbr_agent.rel_vocab)
+    names = [prob_cbr_agent.rev_entity_vocab[e_ctr] for e_ctr in range(num_entities)]
+    relation_names = [prob_cbr_agent.rev_rel_vocab[r_ctr] for r_ctr in range(num_relations)]
+    name_index = {e: e_ctr for e_ctr, e in enumerate(names)}
+    rel_index = {r: r_ctr for r_ctr, r in enumerate(relation_names)}
+    assert len(name_index) == num_entities and len(rel_index) == num_relations, "vocab ids are not contiguous"
+    list_maps = {"train_map": prob_cbr_agent.train_map, "eval_map": prob_cbr_agent.eval_map,
+                 "all_kg_map": args.all_kg_map}
+    # entities and relations of the eval maps may not be in the vocab
+    extra_entities = [e for list_map in list_maps.values() for (e1, _), e2_list in list_map.items()
+                      for e in [e1] + list(e2_list)] + list(prob_cbr_agent.eval_vocab.keys()) + \
+        [e for e_list in prob_cbr_agent.rel_ent_map.values() for e in e_list]
+    for e in extra_entities:
+        if e not in name_index:
+            name_index[e] = len(names)
+            names.append(e)
+    for r in [r for list_map in list_maps.values() for (_, r) in list_map.keys()] + \
+             list(prob_cbr_agent.rel_ent_map.keys()):
+        if r not in rel_index:
+            rel_index[r] = len(relation_names)
+            relation_names.append(r)
+    np.save(os.path.join(snapshot_dir, "entity_names.npy"), np.array(names, dtype=str), allow_pickle=False)
+    np.save(os.path.join(snapshot_dir, "relation_names.npy"), np.array(relation_names, dtype=str),
+            allow_pickle=False)
+    eval_items = list(prob_cbr_agent.eval_vocab.items())
+    np.save(os.path.join(snapshot_dir, "eval_entities.npy"),
+            np.array([name_index[e] for e, _ in eval_items], dtype=np.int64), allow_pickle=False)
+    np.save(os.path.join(snapshot_dir, "eval_rows.npy"), np.array([row for _, row in eval_items], dtype=np.int64),
+            allow_pickle=False)
+
+    encode_key, _ = _pair_key_codec(name_index, rel_index, names, relation_names)
+    list_maps["rel_ent_map"] = prob_cbr_agent.rel_ent_map
+    for map_name, list_map in list_maps.items():
+        arrays = pack_list_map(list_map, encode_key if map_name in PAIR_KEY_MAPS else rel_index.__getitem__,
+                               name_index)
+        for name, arr in arrays.items():
+            np.save(os.path.join(snapshot_dir, "maps", "{}_{}.npy".format(map_name, name)), arr, allow_pickle=False)
+
+    _save_csr_stack(os.path.join(snapshot_dir, "adj"), "in", prob_cbr_agent.sparse_adj_mats,
+                    relation_names[:num_relations])
+    _save_csr_stack(os.path.join(snapshot_dir, "adj"), "out", prob_cbr_agent.executor.out_adj_mats,
+                    relation_names[:num_relations])
+    np.save(os.path.join(snapshot_dir, "nearest_neighbors.npy"), np.asarray(prob_cbr_agent.nearest_neighbor_1_hop),
+            allow_pickle=False)
+    np.save(os.path.join(snapshot_dir, "cluster_assignments.npy"), np.asarray(args.cluster_assignments),
+            allow_pickle=False)
+    prob_cbr_agent.all_paths.save(os.path.join(snapshot_dir, "paths"))
+    vocab_fingerprint = prob_cbr_agent.all_paths.program_vocab.get_fingerprint()
+    score_tables = []
+    for table_name in SCORE_TABLES:
+        if getattr(args, table_name, None) is not None:
+            # the tables were checked against (or converted with) the program vocab of the path store when loaded
+            getattr(args, table_name).save_partitioned(os.path.join(snapshot_dir, "score_tables", table_name),
+                                                       as_arrays=True, vocab_fingerprint=vocab_fingerprint)
+            score_tables.append(table_name)
+
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": config,
+        "num_entities": num_entities,
+        "num_relations": num_relations,
+        "score_tables": score_tables,
+        "per_relation_config": prob_cbr_agent.per_relation_config,
+        "inputs": fingerprint_inputs(input_files),
+        "content_hash": hash_snapshot(snapshot_dir, get_snapshot_files(snapshot_dir)),
+    }
+    with open(os.path.join(snapshot_dir, MANIFEST_FILE_NAME), "w") as fout:
+        json.dump(manifest, fout, indent=1)
+    logger.info("Snapshot written to {} ({})".format(snapshot_dir, manifest["content_hash"]))
+
+
+def check_snapshot(snapshot_dir: str, input_files: List[str], config: Dict, verify_content: bool = False) \
+        -> Optional[Dict]:
+    """
+    :return: the manifest of the snapshot, None if it is missing or stale, i.e. written by another version, with
+    another config, from input files which changed since, or (if verify_content) if its files do not match the
+    content hash
+    """
+    manifest_file_name = os.path.join(snapshot_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_file_name):
+        logger.info("No snapshot found at {}".format(snapshot_dir))
+        return None
+    with open(manifest_file_name) as fin:
+        manifest = json.load(fin)
+    if manifest["version"] != SNAPSHOT_VERSION:
+        logger.info("Snapshot {} has version {}, expected {}".format(snapshot_dir, manifest["version"],
+                                                                     SNAPSHOT_VERSION))
+        return None
+    if manifest["config"] != json.loads(json.dumps(config)):
+        logger.info("Snapshot {} was written with config {}, not {}".format(snapshot_dir, manifest["config"], config))
+        return None
+    changed = get_changed_inputs(manifest["inputs"], input_files)
+    if len(changed) > 0:
+        logger.info("Snapshot {} is stale, these inputs changed: {}".format(snapshot_dir, ", ".join(changed)))
+        return None
+    if verify_content and hash_snapshot(snapshot_dir, get_snapshot_files(snapshot_dir)) != manifest["content_hash"]:
+        logger.info("Snapshot {} does not match its content hash".format(snapshot_dir))
+        return None
+    return manifest
+
+
+def load_snapshot(snapshot_dir: str, input_files: List[str], config: Dict, verify_content: bool = False,
+                  mmap_mode: Optional[str] = "r", path_cache_size: int = 0) -> Optional[Dict]:
+    """
+    Loads a snapshot written by export_snapshot, memory-mapping its arrays.
+    :return: None if the snapshot is missing or stale (see check_snapshot). Otherwise a dict with the arguments of
+    ProbCBR (train_map, eval_map, entity_vocab, rev_entity_vocab, rel_vocab, rev_rel_vocab, eval_vocab,
+    eval_rev_vocab, all_paths, rel_ent_map, per_relation_config, sparse_adj_mats, out_adj_mats) and all_kg_map,
+    nearest_neighbors, cluster_assignments and the score tables
+    """
+    manifest = check_snapshot(snapshot_dir, input_files, config, verify_content)
+    if manifest is None:
+        return None
+    num_entities, num_relations = manifest["num_entities"], manifest["num_relations"]
+    names = np.load(os.path.join(snapshot_dir, "entity_names.npy"), allow_pickle=False).tolist()
+    relation_names = np.load(os.path.join(snapshot_dir, "relation_names.npy"), allow_pickle=False).tolist()
+    name_index = {e: e_ctr for e_ctr, e in enumerate(names)}
+    rel_index = {r: r_ctr for r_ctr, r in enumerate(relation_names)}
+    entity_vocab = {e: name_index[e] for e in names[:num_entities]}
+    rel_vocab = {r: rel_index[r] for r in relation_names[:num_relations]}
+    eval_entities = np.load(os.path.join(snapshot_dir, "eval_entities.npy"), allow_pickle=False).tolist()
+    eval_rows = np.load(os.path.join(snapshot_dir, "eval_rows.npy"), allow_pickle=False).tolist()
+    eval_vocab = {names[e_ctr]: row for e_ctr, row in zip(eval_entities, eval_rows)}
+
+    encode_key, decode_key = _pair_key_codec(name_index, rel_index, names, relation_names)
+    list_maps = {}
+    for map_name in PAIR_KEY_MAPS + ["rel_ent_map"]:
+        arrays = {name: np.load(os.path.join(snapshot_dir, "maps", "{}_{}.npy".format(map_name, name)),
+                                mmap_mode=mmap_mode, allow_pickle=False)
+                  for name in ["key_codes", "indptr", "values", "sorted_order"]}
+        if map_name in PAIR_KEY_MAPS:
+            list_maps[map_name] = PackedListMap(arrays, encode_key, decode_key, names, default_factory=list)
+        else:
+            list_maps[map_name] = PackedListMap(arrays, lambda r: rel_index.get(r, -1),
+                                                relation_names.__getitem__, names, default_factory=list)
+    # copy-on-write, so that scipy can still fix up the matrices in place if it needs to
+    adj_mmap_mode = "c" if mmap_mode is not None else None
+    snapshot = {
+        "train_map": list_maps["train_map"],
+        "eval_map": list_maps["eval_map"],
+        "all_kg_map": list_maps["all_kg_map"],
+        "rel_ent_map": list_maps["rel_ent_map"],
+        "entity_vocab": entity_vocab,
+        "rev_entity_vocab": {e_ctr: e for e, e_ctr in entity_vocab.items()},
+        "rel_vocab": rel_vocab,
+        "rev_rel_vocab": {r_ctr: r for r, r_ctr in rel_vocab.items()},
+        "eval_vocab": eval_vocab,
+        "eval_rev_vocab": {row: e for e, row in eval_vocab.items()},
+        "all_paths": PathStore.load(os.path.join(snapshot_dir, "paths"), entity_vocab, mmap_mode=mmap_mode,
+                                    cache_size=path_cache_size),
+        "per_relation_config": manifest["per_relation_config"],
+        "sparse_adj_mats": _load_csr_stack(os.path.join(snapshot_dir, "adj"), "in", relation_names[:num_relations],
+                                           num_entities, adj_mmap_mode),
+        "out_adj_mats": _load_csr_stack(os.path.join(snapshot_dir, "adj"), "out", relation_names[:num_relations],
+                                        num_entities, adj_mmap_mode),
+        "nearest_neighbors": np.load(os.path.join(snapshot_dir, "nearest_neighbors.npy"), mmap_mode=mmap_mode,
+                                     allow_pickle=False),
+        "cluster_assignments": np.load(os.path.join(snapshot_dir, "cluster_assignments.npy"), mmap_mode=mmap_mode,
+                                       allow_pickle=False),
+    }
+    for table_name in SCORE_TABLES:
+        snapshot[table_name] = SCORE_TABLES[table_name](os.path.join(snapshot_dir, "score_tables", table_name),
+                                                        mmap_mode=mmap_mode) \
+            if table_name in manifest["score_tables"] else None
+        if snapshot[table_name] is not None and not snapshot[table_name].matches(snapshot["all_paths"].program_vocab):
+            logger.info("Snapshot {} is stale, {} was written for another program vocab".format(snapshot_dir,
+                                                                                                table_name))
+            return None
+    logger.info("Loaded snapshot {} ({})".format(snapshot_dir, manifest["content_hash"]))
+    return snapshot
@@ -1,14 +1,37 @@
 import scipy.sparse
 import numpy as np
+from collections import defaultdict
 from typing import *
 from src.prob_cbr.data.data_utils import read_graph
 
 
+def normalize_adj_mat(adj_mat: scipy.sparse.csr_matrix, use_sqrt: bool = False) -> scipy.sparse.csr_matrix:
+    """
+    L2 normalizes the rows of a sparse entity X relation matrix, rows without any edge stay 0.
+    :param use_sqrt: take the square root of the edge counts first
+    """
+    adj_mat = scipy.sparse.csr_matrix(adj_mat, dtype=np.float64, copy=True)
+    if use_sqrt:
+        adj_mat.data = np.sqrt(adj_mat.data)
+    l2norm = np.sqrt(np.asarray(adj_mat.multiply(adj_mat).sum(axis=1)).reshape(-1))
+    l2norm = np.clip(l2norm, np.finfo(np.float64).eps, None)
+    adj_mat.data /= np.repeat(l2norm, np.diff(adj_mat.indptr))
+    return adj_mat
+
+
 def get_adj_mat(kg_file, entity_vocab, rel_vocab):
     adj_mat = read_graph(kg_file, entity_vocab, rel_vocab)
-    l2norm = np.linalg.norm(adj_mat, axis=-1)
-    adj_mat = adj_mat / l2norm.reshape(l2norm.shape[0], 1)
-    return adj_mat
+    return normalize_adj_mat(adj_mat)
+
+
+def calc_sparse_sim(adj_mat: scipy.sparse.csr_matrix, query_entities: np.ndarray) -> np.ndarray:
+    """
+    :param adj_mat: N X R normalized sparse matrix
+    :param query_entities: b indices of query entities
+    :return: b X N inner products, computed with a sparse X sparse product
+    """
+    query_entities_vec = adj_mat[np.asarray(query_entities, dtype=np.int64)]
+    return (query_entities_vec @ adj_mat.T).toarray()
 
 
 def get_programs(e: str, ans: str, all_paths_around_e: List[List[str]]):
@@ -24,6 +47,28 @@ def get_programs(e: str, ans: str, all_paths_around_e: List[List[str]]):
     return all_programs
 
 
+def build_answer_index(all_paths_around_e: Iterable[Tuple[Tuple[str, str], ...]]) \
+        -> Dict[str, List[Tuple[Tuple[Tuple[str, str], ...], int]]]:
+    """
+    Inverted index of the subgraph around e: maps every entity reached by a path to the (path, hop) positions where
+    it is reached, in the same order as get_programs visits them.
+    """
+    answer_index = defaultdict(list)
+    for path in all_paths_around_e:
+        for l, (_, e_dash) in enumerate(path):
+            answer_index[e_dash].append((path, l))
+    return answer_index
+
+
+def get_programs_from_index(ans: str, answer_index: Dict[str, List[Tuple[Tuple[Tuple[str, str], ...], int]]]):
+    """
+    Same as get_programs, using the answer index of the subgraph surrounding e
+    """
+    if ans not in answer_index:
+        return []
+    return [[x for (x, _) in path[:l + 1]] for path, l in answer_index[ans]]
+
+
 def execute_one_program(sparse_adj_mats: Dict[str, scipy.sparse.csr_matrix], entity_vocab: Dict[str, int], e: str,
                         path: List[str]) -> np.ndarray:
     """
@@ -39,6 +84,22 @@ def execute_one_program(sparse_adj_mats: Dict[str, scipy.sparse.csr_matrix], ent
     return final_counts
 
 
+def execute_program_batch(sparse_adj_mats: Dict[str, scipy.sparse.csr_matrix], head_ids: np.ndarray,
+                          path: List[str]) -> scipy.sparse.csr_matrix:
+    """
+    Executes one program from a batch of entities at once, with one SpMM per relation of the program.
+    :param head_ids: entity ids to start from
+    :return: N X len(head_ids) sparse matrix, column j is execute_one_program from entity head_ids[j]
+    """
+    num_entities = next(iter(sparse_adj_mats.values())).shape[0]
+    ent_mat = scipy.sparse.csr_matrix((np.ones(head_ids.shape[0], dtype=np.uint32),
+                                       (head_ids, np.arange(head_ids.shape[0]))),
+                                      shape=(num_entities, head_ids.shape[0]))
+    for r in path:
+        ent_mat = sparse_adj_mats[r] * ent_mat
+    return ent_mat
+
+
 def create_sparse_adj_mats(train_map, entity_vocab, rel_vocab):
     sparse_adj_mats = {}
     csr_data, csr_row, csr_col = {}, {}, {}